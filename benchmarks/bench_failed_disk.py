@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+
+"""
+Benchmarks for the parse and report hot paths of failed_disk.py
+
+Each stage (strip, parse_*, hr_disk_size, print_*, fleet aggregation) is
+timed on the recorded captures and on synthetic data scaled from 4 to 256
+disks per server and from 10 to 10,000 servers; the peak memory
+allocated by each stage is measured with tracemalloc
+
+The results are compared with the baseline stored by a previous run
+with --save, a stage slower than the baseline by more than --threshold
+is reported as a regression (and the exit code is 1 with --check)
+
+Usage:
+bench_failed_disk.py [--quick] [--save] [--check] [--filter STRING]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import failed_disk  # noqa: E402
+import fixtures  # noqa: E402
+
+default_baseline = os.path.join(here, "baseline.json")
+disk_counts = [4, 16, 64, 256]
+fleet_sizes = [10, 100, 1000, 10000]
+# the fleets are built cycling over this many distinct synthetic servers,
+# 10,000 full omreport dumps would take hundreds of MB
+fleet_pool = 200
+# the disk states of the synthetic servers, with enough failures to
+# print all the templates
+server_profile = {"failed": 0.1, "predictive": 0.1, "rebuilding": 0.05, "ready": 0.02}
+
+
+def measure(func, setup=None, min_time=0.2, min_calls=3, memory=True):
+    """
+    Call func (after setup, which is not timed) until min_time has passed
+    and at least min_calls times; return the best time of a single call
+    and the peak memory allocated by one call in bytes
+    """
+    best = None
+    spent = 0.0
+    calls = 0
+    while calls < min_calls or spent < min_time:
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        spent += elapsed
+        calls += 1
+        if elapsed > min_time:
+            # a single call is slow enough, one is representative
+            break
+    peak = 0
+    if memory:
+        if setup:
+            setup()
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, peak
+
+
+def reset_lists(this_server):
+    """
+    Empty the lists filled by parse_omreport_disks, as curses_progress does
+    """
+    this_server.list_all = []
+    this_server.list_failed = []
+    this_server.list_predictive = []
+    this_server.list_notinuse = []
+    this_server.list_rebuilding = []
+    this_server.list_needreplacement = []
+
+
+def bench_server(name, host, hwdisk, hinv, omreport, results, args):
+    """
+    Time the parsing and rendering of a single server
+    """
+    this_server = failed_disk.server_object(hwdisk, hinv, omreport, host)
+    devnull = open(os.devnull, "w")
+
+    def render(method):
+        def call():
+            with redirect_stdout(devnull):
+                method()
+
+        return call
+
+    def clear_cache():
+        failed_disk.normalise_capacity.cache_clear()
+
+    raw_capacities = [
+        [line.decode().split(": ", 1)[1].split(" (")[0]]
+        for line in omreport
+        if line.startswith(b"Capacity")
+    ]
+    stages = [
+        ("strip", lambda: failed_disk.strip(hwdisk), None),
+        ("parse_hwdisk", this_server.parse_hwdisk, None),
+        ("parse_hinv", this_server.parse_hinv, None),
+        (
+            "parse_omreport_disks",
+            this_server.parse_omreport_disks,
+            lambda: reset_lists(this_server),
+        ),
+        (
+            "hr_disk_size.cold",
+            lambda: [failed_disk.hr_disk_size(c) for c in raw_capacities],
+            clear_cache,
+        ),
+        (
+            "hr_disk_size.warm",
+            lambda: [failed_disk.hr_disk_size(c) for c in raw_capacities],
+            None,
+        ),
+        ("print_location", render(this_server.print_location), None),
+        ("print_compact", render(this_server.print_compact), None),
+        ("print_serialn", render(this_server.print_serialn), None),
+        ("print_result", render(this_server.print_result), None),
+    ]
+    for stage, func, setup in stages:
+        key = "%s[%s]" % (stage, name)
+        if args.filter and args.filter not in key:
+            continue
+        results[key] = measure(func, setup, args.min_time, memory=args.memory)
+        report(key, results[key], args.baseline_data, args.threshold)
+    devnull.close()
+
+
+def bench_fleet(size, pool, results, args):
+    """
+    Time building the server objects of a fleet, aggregating the demand
+    of disks and printing the consolidated delivery requests
+    """
+    hosts = [(fixtures.host_name(i),) + pool[i % len(pool)][1:] for i in range(size)]
+    servers = []
+    devnull = open(os.devnull, "w")
+
+    def build():
+        servers[:] = [
+            failed_disk.server_object(hwdisk, hinv, omreport, host)
+            for host, hwdisk, hinv, omreport in hosts
+        ]
+
+    def order():
+        with redirect_stdout(devnull):
+            failed_disk.print_bulk_order(failed_disk.aggregate_demand(servers, True))
+
+    stages = [
+        ("fleet.build", build),
+        ("fleet.aggregate", lambda: failed_disk.aggregate_demand(servers, True)),
+        ("fleet.order", order),
+    ]
+    for stage, func in stages:
+        key = "%s[%s]" % (stage, size)
+        if args.filter and args.filter not in key:
+            continue
+        if not servers:
+            build()  # the other stages need the server objects
+        results[key] = measure(func, None, args.min_time, memory=args.memory)
+        report(key, results[key], args.baseline_data, args.threshold)
+    devnull.close()
+
+
+def hr_time(seconds):
+    if seconds < 1e-3:
+        return "%.1f us" % (seconds * 1e6)
+    if seconds < 1:
+        return "%.2f ms" % (seconds * 1e3)
+    return "%.2f s" % seconds
+
+
+regressions = []
+
+
+def report(key, result, baseline, threshold):
+    """
+    Print the result of a stage and the comparison with the baseline
+    """
+    seconds, peak = result
+    line = "%-34s %12s %12s" % (key, hr_time(seconds), "%.1f KiB" % (peak / 1024.0))
+    if key in baseline:
+        change = seconds / baseline[key]["seconds"] - 1
+        line += "  %+7.1f%%" % (change * 100)
+        if change > threshold:
+            line += "  REGRESSION"
+            regressions.append(key)
+    print(line)
+    sys.stdout.flush()
+
+
+def arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the parse and report paths of failed_disk.py"
+    )
+    parser.add_argument(
+        "--baseline", default=default_baseline, help="default %(default)s"
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="store the results as the new baseline"
+    )
+    parser.add_argument(
+        "--check", action="store_true", help="exit with 1 if there are regressions"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="slowdown reported as a regression (default %(default)s = 25%%)",
+    )
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="skip the largest sizes (256 disks, 10,000 servers)",
+    )
+    parser.add_argument("--filter", help="only the stages containing FILTER")
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.2,
+        help="minimum time spent on each stage in seconds (default %(default)s)",
+    )
+    parser.add_argument(
+        "--no-memory",
+        dest="memory",
+        action="store_false",
+        help="do not measure the memory with tracemalloc",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = arguments()
+    args.baseline_data = {}
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as baseline_file:
+            args.baseline_data = json.load(baseline_file)["results"]
+    # print_result prints all the templates
+    failed_disk.template_yes = True
+    results = {}
+    print("%-34s %12s %12s  %s" % ("Stage", "Time", "Peak memory", "vs baseline"))
+    bench_server("recorded", *fixtures.recorded(), results=results, args=args)
+    rng = random.Random(0)
+    for count in disk_counts[:-1] if args.quick else disk_counts:
+        bench_server(
+            "%s disks" % count,
+            *fixtures.synthetic_host("abc01a", count, rng, **server_profile),
+            results=results,
+            args=args
+        )
+    pool = list(fixtures.synthetic_fleet(fleet_pool, seed=0))
+    for size in fleet_sizes[:-1] if args.quick else fleet_sizes:
+        bench_fleet(size, pool, results, args)
+    if args.save:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "date": time.strftime("%Y-%m-%d %H:%M"),
+                    "results": dict(
+                        (key, {"seconds": seconds, "peak_bytes": peak})
+                        for key, (seconds, peak) in results.items()
+                    ),
+                },
+                baseline_file,
+                indent=1,
+                sort_keys=True,
+            )
+        print("\nBaseline saved in %s" % args.baseline)
+    if regressions:
+        print("\n%s regression(s): %s" % (len(regressions), ", ".join(regressions)))
+        if args.check:
+            sys.exit(1)
+    # That's all folks!
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+"""
+Import-time guard for failed_disk.py
+
+Run python -X importtime -c "import failed_disk" a few times and report
+the time spent importing the module and what it pulls in; fail (exit
+code 1) if one of the modules deferred to where they are used is
+imported at start-up, or if the import is slower than --budget
+
+Usage:
+bench_importtime.py [--runs N] [--budget MS]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+package_dir = os.path.dirname(here)
+
+# modules failed_disk.py must not import at start-up
+deferred = ["curses", "socket", "subprocess", "argparse", "datetime", "sqlite3"]
+
+
+def importtime(module):
+    """
+    Return {imported module: cumulative import time in us} for one
+    import of module in a new interpreter
+    """
+    env = dict(os.environ)
+    # we want to measure the start-up with the bytecode cached,
+    # as it happens on the admin box
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import %s" % module],
+        cwd=package_dir,
+        env=env,
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        check=True,
+    ).stderr.decode()
+    result = {}
+    for line in output.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        fields = line.split("|")
+        result[fields[2].strip()] = int(fields[1])
+    return result
+
+
+def arguments():
+    parser = argparse.ArgumentParser(description="Import-time guard for failed_disk")
+    parser.add_argument("--runs", type=int, default=10, help="default %(default)s")
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=20.0,
+        help="maximum import time in ms (default %(default)s)",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = arguments()
+    importtime("failed_disk")  # warm up, write the bytecode cache
+    runs = [importtime("failed_disk") for _ in range(args.runs)]
+    times = sorted(run["failed_disk"] for run in runs)
+    median = times[len(times) // 2] / 1000.0
+    print(
+        "import failed_disk: median %.2f ms, best %.2f ms" % (median, times[0] / 1000.0)
+    )
+    # the slowest modules imported, from the last run
+    print("\nSlowest imports (cumulative):")
+    slowest = sorted(runs[-1].items(), key=lambda x: x[1], reverse=True)
+    for name, cumulative in slowest[:10]:
+        print("%-30s %8.2f ms" % (name, cumulative / 1000.0))
+    errors = []
+    imported = set(name.strip() for name in runs[-1])
+    for module in deferred:
+        if module in imported:
+            errors.append("%s is imported at start-up" % module)
+    if median > args.budget:
+        errors.append("import takes %.2f ms, budget %.2f ms" % (median, args.budget))
+    if errors:
+        print("\nERROR: " + "\nERROR: ".join(errors))
+        sys.exit(1)
+    print("\nOK")
+    # That's all folks!
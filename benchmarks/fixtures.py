@@ -0,0 +1,242 @@
+"""
+Fixtures for the benchmarks: the recorded captures in recorded/ and
+synthetic Xymon pages (hw-disk, hinv) and omreport dumps
+
+The synthetic data follows the layout of the recorded captures, so that
+the parsing methods of failed_disk.server_object take the same paths
+"""
+
+import os
+import random
+
+recorded_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recorded")
+
+# (capacity as shown by omreport, product ID, bus protocol, media)
+disk_models = [
+    ("418.63 GB", "ST3450857SS", "SAS", "HDD"),
+    ("558.38 GB", "ST3600057SS", "SAS", "HDD"),
+    ("931.00 GB", "ST1000NM0033", "SATA", "HDD"),
+    ("1,117.25 GB", "ST1200MM0088", "SAS", "HDD"),
+    ("1,862.50 GB", "ST2000NM0033", "SATA", "HDD"),
+    ("3,725.50 GB", "ST4000NM0023", "SAS", "HDD"),
+    ("7,451.50 GB", "ST8000NM0075", "SAS", "HDD"),
+    ("446.63 GB", "MZ7KM480HMHQ", "SATA", "SSD"),
+    ("1,787.88 GB", "PX05SVB192", "SAS", "SSD"),
+]
+
+# colour of the hw-disk line for each state
+state_colours = {"Online": "green", "Ready": "yellow", "Rebuilding": "yellow"}
+
+omreport_header = """List of Physical Disks on Controller PERC H710P Mini (Embedded)
+
+Controller PERC H710P Mini (Embedded)
+"""
+
+omreport_block = """ID                              : {id}
+Status                          : {status}
+Name                            : Physical Disk {id}
+State                           : {state}
+Power Status                    : Spun Up
+Bus Protocol                    : {bus}
+Media                           : {media}
+Part of Cache Pool              : Not Applicable
+Remaining Rated Write Endurance : Not Applicable
+Failure Predicted               : {predicted}
+Revision                        : YS0A
+Driver Version                  : Not Applicable
+Model Number                    : Not Applicable
+T10 PI Capable                  : No
+Certified                       : Yes
+Encryption Capable              : No
+Encrypted                       : Not Applicable
+Progress                        : {progress}
+Mirror Set ID                   : Not Applicable
+Capacity                        : {capacity} ({size} bytes)
+Used RAID Disk Space            : {capacity} ({size} bytes)
+Available RAID Disk Space       : 0.00 GB (0 bytes)
+Hot Spare                       : No
+Vendor ID                       : DELL(tm)
+Product ID                      : {product}
+Serial No.                      : {serial}
+Part Number                     : CN0T871K7262236Q05J4A00
+Negotiated Speed                : 6.00 Gbps
+Capable Speed                   : 6.00 Gbps
+PCIe Negotiated Link Width      : Not Applicable
+PCIe Maximum Link Width         : Not Applicable
+Sector Size                     : 512B
+Device Write Cache              : Not Applicable
+Manufacture Day                 : 04
+Manufacture Week                : 36
+Manufacture Year                : 2012
+SAS Address                     : 5000C5005E1B8A{index:02X}
+"""
+
+hwdisk_header = (
+    "{host}|hw-disk|{colour}|OL|1526370000|1526380000|1526381800|0|0|"
+    "10.0.0.1|-1||||\n"
+    "{colour} Tue May 15 10:00:00 2018 - RAID status\n\n"
+    "Controller 0 (PERC H710P Mini) is Ok\n"
+    "&{vd_colour} Virtual Disk 0 (RAID-{raid}) is {vd_state}:\n"
+)
+
+hwdisk_line = (
+    "&{colour} Physical Disk {id} ({bus} {media} {capacity} {product} "
+    "S/N {serial}) is {state}{extra}\n"
+)
+
+hinv_page = (
+    "{host}|hinv|green|OL|1526370000|1526380000|1526381800|0|0|"
+    "10.0.0.1|-1||||\n"
+    "green Tue May 15 10:00:00 2018 - Hardware inventory\n\n"
+    "Rack location:   {location}, R{rack}, position: {ru}\n"
+    "HW type : PowerEdge R720 \n"
+    "Serial : {asset} \n"
+    "HW warranty (epoch) : 1600000000\n"
+)
+
+
+def synthetic_disks(
+    count, rng, failed=0.02, predictive=0.02, rebuilding=0.01, ready=0.005
+):
+    """
+    Return a list of count disks, each disk is a dict with the fields
+    shown by omreport; the probability of each state is given by the
+    arguments, all the disks of a server are of the same model
+    """
+    capacity, product, bus, media = rng.choice(disk_models)
+    size = int(float(capacity.split()[0].replace(",", "")) * 1024**3)
+    disks = []
+    for index in range(count):
+        disk = {
+            "index": index,
+            "id": "0:1:%s" % index,
+            "status": "Ok",
+            "state": "Online",
+            "bus": bus,
+            "media": media,
+            "predicted": "No",
+            "progress": "Not Applicable",
+            "capacity": capacity,
+            "size": size,
+            "product": product,
+            "serial": "%s%05d" % (product[:3], rng.randint(0, 99999)),
+        }
+        draw = rng.random()
+        if draw < failed:
+            disk["state"], disk["status"] = "Failed", "Critical"
+        elif draw < failed + rebuilding:
+            disk["state"] = "Rebuilding"
+            disk["status"] = "Non-Critical"
+            disk["progress"] = "%s%%" % rng.randint(1, 99)
+        elif draw < failed + rebuilding + ready:
+            disk["state"] = "Ready"
+        elif draw < failed + rebuilding + ready + predictive:
+            disk["predicted"], disk["status"] = "Yes", "Non-Critical"
+        disks.append(disk)
+    return disks
+
+
+def omreport_dump(disks):
+    """
+    Return the omreport output for the disks, as pull_omreport returns it
+    (a list of lines in bytes)
+    """
+    text = omreport_header + "\n".join(omreport_block.format(**d) for d in disks)
+    return [line.encode() for line in (text + "\n").splitlines(True)]
+
+
+def hwdisk_page(host, disks, raid=5):
+    """
+    Return the Xymon hw-disk page for the disks
+    """
+    if any(d["state"] == "Failed" for d in disks):
+        colour, vd_colour, vd_state = "red", "red", "Degraded"
+    elif any(d["state"] != "Online" or d["predicted"] != "No" for d in disks):
+        colour, vd_colour, vd_state = "yellow", "yellow", "Degraded"
+    else:
+        colour, vd_colour, vd_state = "green", "green", "Ok"
+    page = hwdisk_header.format(
+        host=host, colour=colour, vd_colour=vd_colour, vd_state=vd_state, raid=raid
+    )
+    for d in disks:
+        extra = ""
+        line_colour = state_colours.get(d["state"], "red")
+        if d["state"] == "Rebuilding":
+            extra = " (Progress: %s)" % d["progress"]
+        elif d["predicted"] != "No":
+            extra = ", Failure Predicted"
+            line_colour = "yellow"
+        page += hwdisk_line.format(colour=line_colour, extra=extra, **d)
+    return page
+
+
+def host_name(index, clusters="abc"):
+    """
+    Return a valid hostname for index, three letters, two digits and the
+    cluster letter: 0 -> aaa00a, 1 -> aaa01b, 101 -> aab01c
+    """
+    prefix = index // 100
+    letters = ""
+    for _ in range(3):
+        letters = chr(ord("a") + prefix % 26) + letters
+        prefix //= 26
+    return "%s%02d%s" % (letters, index % 100, clusters[index % len(clusters)])
+
+
+def xymon_raw(page):
+    """
+    Wrap a page as query_xymon returns it (the str of a list of chunks)
+    """
+    return str([page.encode()])
+
+
+def synthetic_pages(host, disk_count, rng, **profile):
+    """
+    Return (disks, hw-disk page, hinv page) for a synthetic host, the
+    pages as the Xymon server sends them
+    """
+    disks = synthetic_disks(disk_count, rng, **profile)
+    hinv = hinv_page.format(
+        host=host,
+        location="DC Location %s" % host[-1].upper(),
+        rack=rng.randint(1, 40),
+        ru=rng.randint(1, 42),
+        asset="%07X" % rng.randint(0, 0xFFFFFFF),
+    )
+    return disks, hwdisk_page(host, disks), hinv
+
+
+def synthetic_host(host, disk_count, rng, **profile):
+    """
+    Return (host, hw-disk, hinv, omreport) for a synthetic host, the
+    Xymon pages as query_xymon returns them and omreport as
+    pull_omreport returns it
+    """
+    disks, hwdisk, hinv = synthetic_pages(host, disk_count, rng, **profile)
+    return host, xymon_raw(hwdisk), xymon_raw(hinv), omreport_dump(disks)
+
+
+def synthetic_fleet(count, seed=0, disk_counts=(4, 8, 12, 24), **profile):
+    """
+    Generate count synthetic hosts, see synthetic_host
+    """
+    rng = random.Random(seed)
+    for index in range(count):
+        yield synthetic_host(host_name(index), rng.choice(disk_counts), rng, **profile)
+
+
+def recorded(host="prx11a"):
+    """
+    Return (host, hw-disk, hinv, omreport) from the recorded captures
+    """
+    captures = []
+    for test in ("hw-disk", "hinv", "omreport"):
+        with open(os.path.join(recorded_dir, "%s.%s" % (host, test)), "rb") as capture:
+            captures.append(capture.read())
+    hwdisk, hinv, omreport = captures
+    return (
+        host,
+        str([hwdisk]),
+        str([hinv]),
+        omreport.splitlines(True),
+    )
@@ -0,0 +1,565 @@
+#!/usr/bin/python3
+
+"""
+Simulate a fleet of servers to load-test failed_disk.py without touching
+production: a local Xymon server answering "xymondlog HOST.hw-disk" and
+"xymondlog HOST.hinv" for N synthetic hosts, and an ssh_runner
+fake_transport answering omreport with the same disks
+
+The hosts are fixtures.host_name(0) to host_name(N - 1) and each one is
+generated from the seed and its name, so the Xymon pages and omreport
+agree whatever the order of the queries. The profile sets:
+- the fraction of the disks failed, in predictive failure, rebuilding
+  and ready (--failed, --predictive, --rebuilding, --ready)
+- the latency of Xymon and of SSH (each answer waits the latency
+  +/- --jitter, the --slow fraction of the hosts is --slow-factor
+  times slower)
+- the fraction of the hosts unreachable in SSH (--unreachable)
+An unknown host gets an empty page, as from Xymon; the status and
+combo messages (failed_disk.py --publish) are recorded
+
+- serve: run the Xymon server on --port (11984) and write the hosts in
+  --hosts-file, then XYMSRV=127.0.0.1 failed_disk.py -x --fleet FILE
+- bench: time failed_disk.collect_fleet end to end on 10 to 10,000
+  hosts for each number of --workers, and check that the disks found
+  are the disks generated; --agents compares it with the sweep through
+  fleet_agent.py, --publish times failed_disk.py --publish
+
+Usage:
+fleet_sim.py serve [--count N] [--port 11984] [--hosts-file FILE] [profile]
+fleet_sim.py bench [--quick] [--workers 8,32,128] [--agents] [--publish]
+                   [--xymon-only] [profile]
+"""
+
+import argparse
+import os
+import random
+import socketserver
+import sys
+import threading
+import time
+from contextlib import redirect_stderr, redirect_stdout
+from functools import lru_cache
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import failed_disk  # noqa: E402
+import fixtures  # noqa: E402
+import ssh_runner  # noqa: E402
+
+fleet_sizes = [10, 100, 1000, 10000]
+default_workers = [8, 32, 128]
+# the pages of this many hosts are kept, the queries of a host
+# (hw-disk, hinv, omreport) come close to each other
+host_cache = 4096
+
+
+class sim_fleet:
+    """
+    The synthetic hosts and their profile, the answers of the Xymon
+    server and of the fake SSH transport
+    """
+
+    def __init__(
+        self,
+        count,
+        seed=0,
+        disk_counts=(4, 8, 12, 24),
+        xymon_latency=0.0,
+        ssh_latency=0.0,
+        jitter=0.0,
+        slow=0.0,
+        slow_factor=10.0,
+        unreachable=0.0,
+        **profile
+    ):
+        self.hosts = [fixtures.host_name(index) for index in range(count)]
+        self.known = set(self.hosts)
+        self.seed = seed
+        self.disk_counts = disk_counts
+        self.xymon_latency = xymon_latency
+        self.ssh_latency = ssh_latency
+        self.jitter = jitter
+        self.slow = slow
+        self.slow_factor = slow_factor
+        self.unreachable = unreachable
+        self.profile = profile
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+        # (host, test): (colour, text) of the status messages received
+        self.published = {}
+        self.host = lru_cache(maxsize=host_cache)(self.generate)
+
+    def generate(self, host):
+        """
+        Return the dict of host: disks, hw-disk and hinv pages, omreport
+        output in bytes, slow and unreachable
+        """
+        rng = random.Random("%s:%s" % (self.seed, host))
+        disks, hwdisk, hinv = fixtures.synthetic_pages(
+            host, rng.choice(self.disk_counts), rng, **self.profile
+        )
+        return {
+            "disks": disks,
+            "hw-disk": hwdisk.encode(),
+            "hinv": hinv.encode(),
+            "omreport": b"".join(fixtures.omreport_dump(disks)),
+            "slow": rng.random() < self.slow,
+            "unreachable": rng.random() < self.unreachable,
+        }
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def delay(self, latency, host):
+        """
+        Return the seconds host waits before answering
+        """
+        if not latency:
+            return 0.0
+        seconds = latency * (1 + self.jitter * (2 * self.rng.random() - 1))
+        if host in self.known and self.host(host)["slow"]:
+            seconds *= self.slow_factor
+        return max(seconds, 0.0)
+
+    def record_status(self, message):
+        """
+        Record a status message, "status[+LIFETIME] host.test colour text"
+        """
+        words = message.split(None, 3)
+        if len(words) < 3 or not words[0].startswith("status") or "." not in words[1]:
+            self.count("xymon.unsupported")
+            return
+        host, test = words[1].rsplit(".", 1)
+        self.count("xymon.status")
+        with self.lock:
+            self.published[(host.replace(",", "."), test)] = (
+                words[2],
+                words[3] if len(words) > 3 else "",
+            )
+
+    def xymon_answer(self, message):
+        """
+        Return (answer, seconds to wait) for a message to Xymon;
+        status and combo messages are recorded, without answer
+        """
+        if message.startswith("combo\n"):
+            self.count("xymon.combo")
+            for status in message[len("combo\n") :].split("\n\n"):
+                if status.strip():
+                    self.record_status(status)
+            return b"", self.delay(self.xymon_latency, None)
+        if message.startswith("status"):
+            self.record_status(message)
+            return b"", self.delay(self.xymon_latency, None)
+        words = message.split()
+        if len(words) != 2 or words[0] != "xymondlog" or "." not in words[1]:
+            self.count("xymon.unsupported")
+            return b"", 0.0
+        host, test = words[1].rsplit(".", 1)
+        self.count("xymon.%s" % test)
+        if host not in self.known or test not in ("hw-disk", "hinv"):
+            return b"", self.delay(self.xymon_latency, host)
+        return self.host(host)[test], self.delay(self.xymon_latency, host)
+
+    def ssh_answer(self, host, command):
+        """
+        The responder of the fake_transport, see ssh_runner.fake_transport
+        """
+        self.count("ssh")
+        delay = self.delay(self.ssh_latency, host)
+        if host not in self.known:
+            error = "ssh: Could not resolve hostname %s: Name or service not known\n"
+            return 255, b"", (error % host).encode(), delay
+        if self.host(host)["unreachable"]:
+            error = "ssh: connect to host %s port 22: Connection timed out\n"
+            return 255, b"", (error % host).encode(), delay
+        if "omreport storage pdisk" not in command:
+            return 127, b"", b"sudo: command not found\n", delay
+        return 0, self.host(host)["omreport"], b"", delay
+
+    def expected(self, hosts):
+        """
+        Return the disks generated for hosts, by state, as failed_disk
+        should find them: {"failed": N, "predictive": N, "rebuilding": N}
+        """
+        total = {"failed": 0, "predictive": 0, "rebuilding": 0}
+        for host in hosts:
+            for disk in self.host(host)["disks"]:
+                if disk["state"] == "Failed":
+                    total["failed"] += 1
+                elif disk["state"] == "Rebuilding":
+                    total["rebuilding"] += 1
+                elif disk["predicted"] != "No":
+                    total["predictive"] += 1
+        return total
+
+
+class xymon_handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # the client sends the whole message and shuts down its side
+        data = b""
+        while True:
+            chunk = self.request.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        answer, delay = self.server.fleet.xymon_answer(data.decode("ascii", "replace"))
+        if delay:
+            time.sleep(delay)
+        if answer:
+            self.request.sendall(answer)
+
+
+class xymon_server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    # the sweeps open fleet_workers connections at the same time
+    request_queue_size = 1024
+
+
+def start(fleet, port=0):
+    """
+    Start the Xymon server of fleet in a thread, return (server, port)
+    """
+    server = xymon_server(("127.0.0.1", port), xymon_handler)
+    server.fleet = fleet
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+
+def disks_found(servers):
+    """
+    Return the disks failed_disk found in the servers, as sim_fleet.expected
+    """
+    return {
+        "failed": sum(len(s.list_failed) for s in servers),
+        "predictive": sum(len(s.list_predictive) for s in servers),
+        "rebuilding": sum(len(s.list_rebuilding) for s in servers),
+    }
+
+
+def make_fleet(args, count, wan=0.0):
+    """
+    Return the sim_fleet of the command line; wan is the round trip
+    added when the fleet is far: one for each Xymon query, four for
+    each SSH run (TCP, key exchange, authentication, the command)
+    """
+    return sim_fleet(
+        count,
+        seed=args.seed,
+        xymon_latency=args.xymon_latency + wan,
+        ssh_latency=args.ssh_latency + 4 * wan,
+        jitter=args.jitter,
+        slow=args.slow,
+        slow_factor=args.slow_factor,
+        unreachable=args.unreachable,
+        failed=args.failed,
+        predictive=args.predictive,
+        rebuilding=args.rebuilding,
+        ready=args.ready,
+    )
+
+
+def use_fleet(fleet, xymon_port, workers):
+    """
+    Point failed_disk at the Xymon server on xymon_port and at the fake
+    SSH transport of fleet
+    """
+    failed_disk.xymon_server = "127.0.0.1"
+    failed_disk.xymon_port = xymon_port
+    failed_disk.fleet_workers = workers
+    # no circuit breaker, the unreachable hosts must be tried in every run
+    ssh_runner.configure(
+        ssh_runner.fake_transport(fleet.ssh_answer),
+        max_parallel=max(workers, ssh_runner.max_parallel),
+        breaker=False,
+    )
+
+
+def run_agent(args, count, xymon_port, workers, pipe):
+    """
+    An agent standing in for a site, in its own process: it uses the
+    Xymon server on xymon_port and answers SSH with the LAN latency
+    """
+    import fleet_agent
+
+    use_fleet(make_fleet(args, count), xymon_port, workers)
+    server = fleet_agent.make_server("127.0.0.1:0")
+    pipe.send(server.server_address[1])
+    server.serve_forever()
+
+
+def start_agent(args, count, xymon_port, workers):
+    """
+    Start an agent process, return (process, address)
+    """
+    import multiprocessing
+
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.get_context("fork").Process(
+        target=run_agent, args=(args, count, xymon_port, workers, child), daemon=True
+    )
+    process.start()
+    return process, "127.0.0.1:%s" % parent.recv()
+
+
+def bench_publish(fleet, servers):
+    """
+    Time publish_status on servers, print it with the number of
+    combo messages; return False if a server is not published
+    """
+    with fleet.lock:
+        fleet.published.clear()
+        fleet.stats.pop("xymon.combo", None)
+    start_time = time.perf_counter()
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        failed_disk.publish_status(servers)
+    elapsed = time.perf_counter() - start_time
+    published = [
+        (s.server, failed_disk.publish_test) in fleet.published for s in servers
+    ]
+    print(
+        "%23s %9.2fs %10.0f %8s  %s published in %s combo messages"
+        % (
+            "publish",
+            elapsed,
+            len(servers) / elapsed,
+            published.count(False),
+            published.count(True),
+            fleet.stats.get("xymon.combo", 0),
+        )
+    )
+    return all(published)
+
+
+def bench(fleet, sizes, modes, ssh=True, publish=False):
+    """
+    Time each mode, (name, collect function, numbers of workers), on
+    the first hosts of fleet for each size, and with publish the
+    publishing of the results; return False if the disks found differ
+    from the disks generated or if a server is not published
+    """
+    ok = True
+    devnull = open(os.devnull, "w")
+    print(
+        "%7s %-7s %7s %10s %10s %8s  %s"
+        % (
+            "Hosts",
+            "Mode",
+            "Workers",
+            "Time",
+            "Hosts/s",
+            "Errors",
+            "Failed/predictive found",
+        )
+    )
+    for size in sizes:
+        hosts = fleet.hosts[:size]
+        # the unreachable hosts have the disks from Xymon
+        expected = fleet.expected(hosts)
+        for mode, collect, workers in modes:
+            for count in workers:
+                failed_disk.fleet_workers = count
+                start_time = time.perf_counter()
+                # the SSH errors of the unreachable hosts are expected
+                with redirect_stderr(devnull):
+                    servers = collect(hosts, ssh)
+                elapsed = time.perf_counter() - start_time
+                found = disks_found(servers)
+                check = "ok"
+                if found["failed"] != expected["failed"] or (
+                    found["predictive"] != expected["predictive"]
+                ):
+                    check = "expected %s/%s" % (
+                        expected["failed"],
+                        expected["predictive"],
+                    )
+                    ok = False
+                print(
+                    "%7s %-7s %7s %9.2fs %10.0f %8s  %s/%s %s"
+                    % (
+                        size,
+                        mode,
+                        count,
+                        elapsed,
+                        size / elapsed,
+                        size - len(servers),
+                        found["failed"],
+                        found["predictive"],
+                        check,
+                    )
+                )
+                if publish:
+                    ok = bench_publish(fleet, servers) and ok
+                sys.stdout.flush()
+    devnull.close()
+    return ok
+
+
+def arguments():
+    """
+    Parse arguments and return help message if the script is invoked with -h
+    """
+    parser = argparse.ArgumentParser(
+        description="Simulate a fleet (Xymon and SSH) to load-test failed_disk.py",
+        prog="fleet_sim",
+    )
+    parser.add_argument("command", choices=["serve", "bench"])
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=fleet_sizes[-1],
+        help="number of hosts (default %(default)s)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--port", type=int, help="Xymon port (serve: 11984, bench: a free port)"
+    )
+    parser.add_argument("--hosts-file", metavar="FILE", help="(serve) write the hosts")
+    parser.add_argument(
+        "--quick", action="store_true", help="(bench) skip the 10,000 hosts"
+    )
+    parser.add_argument(
+        "--workers",
+        default=",".join(str(w) for w in default_workers),
+        help="(bench) failed_disk.fleet_workers to try (default %(default)s)",
+    )
+    parser.add_argument(
+        "--agents",
+        action="store_true",
+        help="(bench) compare the sweep from far (--wan-latency) with the "
+        "sweep through an agent process for each cluster (see fleet_agent.py)",
+    )
+    parser.add_argument(
+        "--publish",
+        action="store_true",
+        help="(bench) also time failed_disk.py --publish after each sweep",
+    )
+    parser.add_argument(
+        "--xymon-only",
+        action="store_true",
+        help="(bench) do not run omreport, as failed_disk.py -x",
+    )
+    profile = parser.add_argument_group("profile")
+    for state, default in (
+        ("failed", 0.02),
+        ("predictive", 0.02),
+        ("rebuilding", 0.01),
+        ("ready", 0.005),
+    ):
+        profile.add_argument(
+            "--%s" % state,
+            type=float,
+            default=default,
+            help="fraction of the disks %s (default %%(default)s)" % state,
+        )
+    profile.add_argument(
+        "--xymon-latency",
+        type=float,
+        default=0.005,
+        help="seconds before Xymon answers (default %(default)s)",
+    )
+    profile.add_argument(
+        "--ssh-latency",
+        type=float,
+        default=0.05,
+        help="seconds for the SSH handshake and omreport (default %(default)s)",
+    )
+    profile.add_argument(
+        "--wan-latency",
+        type=float,
+        default=0.03,
+        help="(bench --agents) round trip between the coordinator and "
+        "the sites (default %(default)s)",
+    )
+    profile.add_argument(
+        "--jitter",
+        type=float,
+        default=0.2,
+        help="the latencies vary by this fraction (default %(default)s)",
+    )
+    profile.add_argument(
+        "--slow",
+        type=float,
+        default=0.01,
+        help="fraction of the hosts --slow-factor times slower (default %(default)s)",
+    )
+    profile.add_argument("--slow-factor", type=float, default=10.0)
+    profile.add_argument(
+        "--unreachable",
+        type=float,
+        default=0.0,
+        help="fraction of the hosts unreachable in SSH (default %(default)s)",
+    )
+    args = parser.parse_args()
+    try:
+        args.workers = [int(w) for w in args.workers.split(",")]
+    except ValueError:
+        parser.error("--workers: expected numbers separated by commas")
+    return args
+
+
+if __name__ == "__main__":
+    args = arguments()
+    sizes = [size for size in fleet_sizes if size <= args.count]
+    if args.command == "bench" and args.quick:
+        sizes = [size for size in sizes if size < fleet_sizes[-1]]
+    count = max(sizes + [args.count]) if args.command == "bench" else args.count
+    fleet = make_fleet(args, count)
+    if args.command == "serve":
+        server, port = start(fleet, 11984 if args.port is None else args.port)
+        if args.hosts_file:
+            with open(args.hosts_file, "w") as hosts_file:
+                hosts_file.write("\n".join(fleet.hosts) + "\n")
+        print(
+            "Xymon simulator with %s hosts on 127.0.0.1:%s, XYMSRV=127.0.0.1 "
+            "XYMONDPORT=%s" % (len(fleet.hosts), port, port)
+        )
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+        for name, count in sorted(fleet.stats.items()):
+            print("%-20s %s" % (name, count))
+        colours = [colour for colour, text in fleet.published.values()]
+        for colour in sorted(set(colours)):
+            print("%-20s %s" % ("published " + colour, colours.count(colour)))
+        sys.exit()
+    servers = []
+    if args.agents:
+        import fleet_agent
+
+        # the sites query this server, with the LAN latency, the
+        # coordinator the far one; the agents start before anything
+        # runs in this process
+        servers.append(start(fleet, 0))
+        agents = {}
+        for letter in sorted(
+            set(failed_disk.get_cluster_letter(h) for h in fleet.hosts)
+        ):
+            process, agents[letter] = start_agent(
+                args, count, servers[0][1], max(args.workers)
+            )
+        fleet = make_fleet(args, count, args.wan_latency)
+        modes = [
+            ("direct", failed_disk.collect_fleet, args.workers),
+            (
+                "agents",
+                lambda hosts, ssh: fleet_agent.sweep(hosts, ssh, agents),
+                [max(args.workers)],
+            ),
+        ]
+    else:
+        modes = [("direct", failed_disk.collect_fleet, args.workers)]
+    servers.append(start(fleet, args.port or 0))
+    use_fleet(fleet, servers[-1][1], max(args.workers))
+    ok = bench(fleet, sizes, modes, not args.xymon_only, args.publish)
+    for server, port in servers:
+        server.shutdown()
+    if not ok:
+        sys.exit(1)
+    # That's all folks!
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+"""
+A local tracker with the part of the JIRA REST API tickets.py uses,
+to develop and test it without a real tracker
+
+- POST /rest/api/2/issue/bulk creates the issues (OPS-1, OPS-2, ...),
+  an issue without summary fails as JIRA does (status 400, the others
+  are created)
+- GET /rest/api/2/search?jql=labels in ("a", "b") finds the issues
+  (AND statusCategory != Done is accepted, the issues are all open)
+- GET /stub/stats returns the issues created, the requests and the
+  connections, to check the batching and the connection reuse
+--fail-rate answers a fraction of the bulk requests with 503 and
+--drop-rate creates the issues and then drops the connection without
+answering, to exercise the retries
+
+Usage:
+tracker_stub.py [--port 8080] [--fail-rate R] [--drop-rate R]
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class tracker_handler(BaseHTTPRequestHandler):
+    # keep the connections open, as the tracker does
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.stats["connections"] += 1
+
+    def log_message(self, format, *args):
+        pass  # quiet
+
+    def reply(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        with self.server.lock:
+            self.server.stats["requests"] += 1
+        if url.path == "/stub/stats":
+            self.reply(200, dict(self.server.stats, issues=len(self.server.issues)))
+        elif url.path == "/rest/api/2/search":
+            jql = parse_qs(url.query).get("jql", [""])[0]
+            # the issues of the stub are all open, the status is ignored
+            match = re.match(r"labels in \((.*)\)( AND statusCategory != Done)?$", jql)
+            if not match:
+                self.reply(400, {"errorMessages": ["unsupported JQL: %s" % jql]})
+                return
+            labels = set(re.findall(r'"([^"]+)"', match.group(1)))
+            with self.server.lock:
+                issues = [
+                    {"key": key, "fields": {"labels": fields.get("labels", [])}}
+                    for key, fields in self.server.issues.items()
+                    if labels & set(fields.get("labels", []))
+                ]
+            self.reply(200, {"total": len(issues), "issues": issues})
+        else:
+            self.reply(404, {"errorMessages": ["not found"]})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.server.lock:
+            self.server.stats["requests"] += 1
+        if self.path != "/rest/api/2/issue/bulk":
+            self.reply(404, {"errorMessages": ["not found"]})
+            return
+        if random.random() < self.server.fail_rate:
+            self.reply(503, {"errorMessages": ["busy"]}, [("Retry-After", "0")])
+            return
+        issues = []
+        errors = []
+        with self.server.lock:
+            for number, update in enumerate(body.get("issueUpdates", [])):
+                fields = update.get("fields", {})
+                if not fields.get("summary"):
+                    errors.append(
+                        {
+                            "status": 400,
+                            "failedElementNumber": number,
+                            "elementErrors": {
+                                "errors": {"summary": "You must specify a summary"}
+                            },
+                        }
+                    )
+                    continue
+                self.server.counter += 1
+                key = "%s-%s" % (fields["project"]["key"], self.server.counter)
+                self.server.issues[key] = fields
+                issues.append({"id": str(self.server.counter), "key": key})
+        if random.random() < self.server.drop_rate:
+            # created, but the client never knows
+            self.close_connection = True
+            return
+        self.reply(400 if errors else 201, {"issues": issues, "errors": errors})
+
+
+def start(port=0, fail_rate=0.0, drop_rate=0.0):
+    """
+    Start the stub in a thread, return (server, url)
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), tracker_handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.issues = {}
+    server.counter = 0
+    server.stats = {"requests": 0, "connections": 0}
+    server.fail_rate = fail_rate
+    server.drop_rate = drop_rate
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%s" % server.server_address[1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stub of the tracker")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    server, url = start(args.port, args.fail_rate, args.drop_rate)
+    print("Tracker stub on %s, TICKETS_URL=%s" % (url, url))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+    # That's all folks!
@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+
+"""
+Check that the expected members (for example the servers of a cluster)
+are listed in the output of a command run on each host
+
+This is the Python version of checkserver: the command runs on all the
+hosts at the same time (see ssh_runner.py) and the output is split in
+tokens, a member is present only if one of the tokens is exactly its
+name (server01 does not match server010)
+
+For each host print the members missing and the extra ones, the tokens
+matching --pattern which are not expected; exit with 1 if a member is
+missing or a host could not be checked
+
+Usage:
+checkserver.py [--hosts FILE] [--expected FILE] [--command CMD] [host ...]
+"""
+
+import argparse
+import json
+import re
+import sys
+
+import ssh_runner
+
+# the command run on each host, its output lists the members #CHANGEME
+default_command = "cat checkserver_test.txt"
+# the members expected when --expected is not given #CHANGEME
+default_expected = ["server0%s" % i for i in range(1, 10)]
+# the tokens which look like a member, to report the extra ones #CHANGEME
+default_pattern = r"server\d+"
+
+
+def read_list(filename):
+    """
+    Read a list of names from filename, one per line,
+    the empty lines and the lines starting with # are skipped
+    """
+    with open(filename) as list_file:
+        return [
+            line.strip()
+            for line in list_file
+            if line.strip() and not line.startswith("#")
+        ]
+
+
+def tokens(output):
+    """
+    Split the output of the command in a set of tokens (names made of
+    letters, digits, dots, dashes and underscores, starting and ending
+    with a letter, a digit or an underscore: "server01." is server01)
+    """
+    return set(re.findall(r"\w(?:[\w.-]*\w)?", output))
+
+
+def compare(expected, output, pattern=default_pattern):
+    """
+    Return the members missing from output and the extra ones
+    (the tokens matching pattern which are not expected), sorted
+    """
+    found = tokens(output)
+    member = re.compile(pattern)
+    missing = expected - found
+    extra = set(t for t in found - expected if member.fullmatch(t))
+    return sorted(missing), sorted(extra)
+
+
+def check_output(ssh, expected, pattern):
+    """
+    Compare the output of a run (a ssh_result) with the expected members
+    """
+    if ssh.returncode != 0:
+        return {"host": ssh.host, "error": ssh.error(), "missing": [], "extra": []}
+    missing, extra = compare(expected, ssh.output(), pattern)
+    return {"host": ssh.host, "error": None, "missing": missing, "extra": extra}
+
+
+def check_hosts(hosts, command, expected, pattern=default_pattern):
+    """
+    Run command on all the hosts at the same time and return the
+    reports (see check_output) in the same order as hosts
+    """
+    expected = set(expected)
+    return [
+        check_output(ssh, expected, pattern)
+        for ssh in ssh_runner.run_many(hosts, command, deadline=60)
+    ]
+
+
+def print_reports(reports):
+    """
+    Print the reports, the hosts with problems only
+    """
+    problems = 0
+    for report in reports:
+        if report["error"]:
+            print("%s: ERROR %s" % (report["host"], report["error"]))
+        elif report["missing"] or report["extra"]:
+            if report["missing"]:
+                print("%s: missing %s" % (report["host"], " ".join(report["missing"])))
+            if report["extra"]:
+                print("%s: extra %s" % (report["host"], " ".join(report["extra"])))
+        else:
+            continue
+        problems += 1
+    print("\nDone, %s host(s) checked, %s with problems" % (len(reports), problems))
+
+
+def arguments():
+    """
+    Parse arguments and return help message if the script is invoked with -h
+    """
+    parser = argparse.ArgumentParser(
+        description="Check the expected members in the output of a command "
+        "run on each host",
+        prog="checkserver",
+    )
+    parser.add_argument("hosts", nargs="*", help="the hosts to check")
+    parser.add_argument("--hosts", dest="hosts_file", metavar="FILE")
+    parser.add_argument(
+        "--expected", metavar="FILE", help="the expected members, one per line"
+    )
+    parser.add_argument("--command", default=default_command)
+    parser.add_argument(
+        "--pattern",
+        default=default_pattern,
+        help="the tokens reported as extra if not expected (default %(default)s)",
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="print the reports as JSON lines"
+    )
+    args = parser.parse_args()
+    if args.hosts_file:
+        args.hosts += read_list(args.hosts_file)
+    if not args.hosts:
+        parser.error("give at least one host or --hosts FILE")
+    return args
+
+
+if __name__ == "__main__":
+    args = arguments()
+    expected = read_list(args.expected) if args.expected else default_expected
+    reports = check_hosts(args.hosts, args.command, expected, args.pattern)
+    if args.json:
+        for report in reports:
+            print(json.dumps(report))
+    else:
+        print_reports(reports)
+    if any(r["error"] or r["missing"] for r in reports):
+        sys.exit(1)
+    # That's all folks!
@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+
+"""
+Remove the directories older than 3 days, Python version of delete_dir.sh
+
+Same rules as delete_dir.sh: the entries checked are the directories
+two levels below $directory ("$directory"/*/*, the hidden entries are
+skipped at both levels as the glob does), a directory is removed
+if its ctime is older than --days and its path does not contain KEEP
+
+- the directories are scanned with os.scandir, no process per entry
+- the old directories are removed by a pool of --workers threads
+- --dry-run only reports what would be removed
+- the log file gets one JSON line per directory removed (with the bytes
+  freed) and a summary line with the disk usage before and after
+
+Usage:
+delete_dir.py [--days N] [--dry-run] [--workers N] [--log FILE] [directory]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+
+directory = "/foo/bar/"  # CHANGE
+logfile = "/var/log/delete_script.log"
+# the directories with this in the path are never removed
+keep_marker = "KEEP"
+
+
+def old_directories(top, max_age, now=None):
+    """
+    Generate (path, age in seconds) for the directories in top/*/*
+    older than max_age seconds and without keep_marker in the path
+    """
+    if now is None:
+        now = time.time()
+    with os.scandir(top) as first_level:
+        # the glob * skips the hidden entries
+        parents = [
+            e.path
+            for e in first_level
+            if not e.name.startswith(".") and e.is_dir(follow_symlinks=False)
+        ]
+    for parent in parents:
+        try:
+            with os.scandir(parent) as second_level:
+                for entry in second_level:
+                    # hidden, the glob does not see it
+                    if entry.name.startswith("."):
+                        continue
+                    # it's a file (or a link) do nothing
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                    # contains keep do nothing
+                    if keep_marker in entry.path:
+                        continue
+                    age = now - entry.stat(follow_symlinks=False).st_ctime
+                    if age > max_age:
+                        yield entry.path, age
+        except OSError as error:
+            sys.stderr.write("ERROR: %s\n" % error)
+
+
+def disk_bytes(path):
+    """
+    Return the space used on disk by path and everything below it
+    """
+    total = 0
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    stat = entry.stat(follow_symlinks=False)
+                    total += stat.st_blocks * 512
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+        except OSError:
+            pass  # gone or not readable, count what we can
+    return total + os.stat(path, follow_symlinks=False).st_blocks * 512
+
+
+def remove_tree(path):
+    """
+    Remove path and everything below it as shutil.rmtree does, return
+    the space it used on disk; the sizes are added up during the
+    removal, the tree is walked only once
+    """
+    total = os.stat(path, follow_symlinks=False).st_blocks * 512
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                total += remove_tree(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_blocks * 512
+                os.unlink(entry.path)
+    os.rmdir(path)
+    return total
+
+
+def remove(path, age, dry_run=False):
+    """
+    Remove path (unless dry_run), return the log record
+    """
+    record = {
+        "time": int(time.time()),
+        "event": "would_remove" if dry_run else "removed",
+        "path": path,
+        "age_days": round(age / 86400.0, 1),
+    }
+    try:
+        if dry_run:
+            record["bytes"] = disk_bytes(path)
+        else:
+            record["bytes"] = remove_tree(path)
+    except OSError as error:
+        record["event"] = "error"
+        record["error"] = str(error)
+    return record
+
+
+def hr_size(size):
+    for unit in ("B", "K", "M", "G", "T"):
+        if abs(size) < 1024 or unit == "T":
+            return "%.1f%s" % (size, unit) if unit != "B" else "%d%s" % (size, unit)
+        size /= 1024.0
+
+
+def df(path):
+    """
+    Return the disk usage of the filesystem of path as a dict
+    """
+    usage = shutil.disk_usage(path)
+    return {"total": usage.total, "used": usage.used, "free": usage.free}
+
+
+def sweep(top, days=3, dry_run=False, workers=8, log=None):
+    """
+    Remove the old directories in top, write a JSON line for each one
+    in log (a file object) and return the summary
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    before = df(top)
+    start = time.time()
+    removed = errors = freed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(remove, path, age, dry_run)
+            for path, age in old_directories(top, days * 86400, start)
+        ]
+        for future in futures:
+            record = future.result()
+            if record["event"] == "error":
+                errors += 1
+            else:
+                removed += 1
+                freed += record["bytes"]
+            if log:
+                log.write(json.dumps(record) + "\n")
+    summary = {
+        "time": int(time.time()),
+        "event": "summary",
+        "directory": top,
+        "dry_run": dry_run,
+        "removed": removed,
+        "errors": errors,
+        "bytes": freed,
+        "seconds": round(time.time() - start, 2),
+        "before": before,
+        "after": df(top),
+    }
+    if log:
+        log.write(json.dumps(summary) + "\n")
+    return summary
+
+
+def print_summary(summary):
+    """
+    Print the summary and the disk usage before and after, as df -h does
+    """
+    print(
+        "%s %s directories, %s freed, %s errors in %ss"
+        % (
+            "Would remove" if summary["dry_run"] else "Removed",
+            summary["removed"],
+            hr_size(summary["bytes"]),
+            summary["errors"],
+            summary["seconds"],
+        )
+    )
+    print("\n%-8s %8s %8s %8s %5s  %s" % ("", "Size", "Used", "Avail", "Use%", "Path"))
+    for when in ("before", "after"):
+        usage = summary[when]
+        print(
+            "%-8s %8s %8s %8s %4d%%  %s"
+            % (
+                when,
+                hr_size(usage["total"]),
+                hr_size(usage["used"]),
+                hr_size(usage["free"]),
+                100 * usage["used"] // usage["total"] if usage["total"] else 0,
+                summary["directory"],
+            )
+        )
+
+
+def arguments():
+    """
+    Parse arguments and return help message if the script is invoked with -h
+    """
+    parser = argparse.ArgumentParser(
+        description="Remove the directories in DIRECTORY/*/* older than --days "
+        "and without %s in the path" % keep_marker,
+        prog="delete_dir",
+    )
+    parser.add_argument("directory", nargs="?", default=directory)
+    parser.add_argument(
+        "--days", type=float, default=3, help="default %(default)s days"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only print what would be removed"
+    )
+    parser.add_argument("--workers", type=int, default=8, help="default %(default)s")
+    parser.add_argument("--log", default=logfile, help="default %(default)s")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    return args
+
+
+if __name__ == "__main__":
+    args = arguments()
+    if not os.path.isdir(args.directory):
+        sys.exit("ERROR: %s is not a directory" % args.directory)
+    with open(args.log, "a") as log:
+        summary = sweep(args.directory, args.days, args.dry_run, args.workers, log)
+    print_summary(summary)
+    if summary["errors"]:
+        sys.exit(1)
+    # That's all folks!
@@ -0,0 +1,273 @@
+#!/usr/bin/python3
+
+"""
+Keep the history of the disks parsed by failed_disk.py in a SQLite
+database and answer questions about it, for example:
+which disk models fail most, how long do rebuilds take on cluster B,
+which disks were in predictive failure last month
+
+The database is append-only, each run of failed_disk.py with --history
+adds one row for each disk it has seen (a snapshot)
+
+Usage:
+disk_history.py failures [--since DATE] [--until DATE]
+disk_history.py rebuilds [--cluster LETTER] [--since DATE] [--until DATE]
+disk_history.py predictive [--since DATE] [--until DATE]
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+# where the history is stored if not specified otherwise
+default_db = os.path.expanduser("~/.failed_disk/history.sqlite")
+
+schema = """
+CREATE TABLE IF NOT EXISTS disk_snapshot (
+    ts INTEGER NOT NULL,
+    host TEXT NOT NULL,
+    cluster TEXT NOT NULL,
+    disk_id TEXT NOT NULL,
+    serial TEXT NOT NULL,
+    product TEXT NOT NULL,
+    capacity TEXT NOT NULL,
+    bus TEXT NOT NULL,
+    state TEXT NOT NULL,
+    status TEXT NOT NULL,
+    predicted TEXT NOT NULL,
+    progress TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS disk_snapshot_host ON disk_snapshot (host, ts);
+CREATE INDEX IF NOT EXISTS disk_snapshot_serial ON disk_snapshot (serial, ts);
+CREATE INDEX IF NOT EXISTS disk_snapshot_ts ON disk_snapshot (ts);
+"""
+
+# the states failed_disk.py does not consider a failure
+# (see server_object.parse_omreport_disks)
+healthy_states = ("Online", "Ready", "Rebuilding")
+
+
+def open_history(filename=default_db):
+    """
+    Open (and create if needed) the history database, return the connection
+    """
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    conn = sqlite3.connect(filename)
+    # WAL lets the queries run while a sweep is writing
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(schema)
+    return conn
+
+
+def snapshot_rows(servers, timestamp):
+    """
+    Generate one row for each disk of each server_object
+    """
+    for this_server in servers:
+        for n in this_server.list_all:
+            # see server_object.parse_omreport_disks for the tuple layout
+            yield (
+                timestamp,
+                this_server.server,
+                this_server.letter,
+                n[0][0],
+                n[9][0],
+                n[8][0],
+                n[7],
+                n[3][0],
+                n[2][0],
+                n[1][0],
+                n[5][0],
+                n[6][0],
+            )
+
+
+def record_snapshot(conn, servers, timestamp=None):
+    """
+    Append the disks of all the servers to the history in a single
+    transaction; return the number of rows written
+    """
+    if timestamp is None:
+        timestamp = int(time.time())
+    with conn:
+        cursor = conn.executemany(
+            "INSERT INTO disk_snapshot VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            snapshot_rows(servers, timestamp),
+        )
+    return cursor.rowcount
+
+
+def query_failure_rates(conn, since=0, until=None):
+    """
+    Return, for each disk model, the number of disks seen, the number of
+    disks seen failed and the failure rate, most failing first
+    """
+    if until is None:
+        until = int(time.time())
+    rows = conn.execute(
+        """
+        SELECT product, capacity,
+               COUNT(DISTINCT serial),
+               COUNT(DISTINCT CASE WHEN state NOT IN (?, ?, ?) THEN serial END)
+        FROM disk_snapshot
+        WHERE ts BETWEEN ? AND ?
+        GROUP BY product, capacity
+        """,
+        healthy_states + (since, until),
+    ).fetchall()
+    result = [(p, c, seen, failed, failed / seen) for p, c, seen, failed in rows]
+    return sorted(result, key=lambda x: (x[4], x[3]), reverse=True)
+
+
+def query_rebuild_durations(conn, cluster=None, since=0, until=None):
+    """
+    Return the rebuilds seen in the history as a list of tuples
+    (cluster, host, serial, started, finished, seconds)
+
+    A rebuild starts with the first snapshot in state Rebuilding and
+    finishes with the next snapshot Online, the precision depends on
+    how often the snapshots are taken
+    """
+    if until is None:
+        until = int(time.time())
+    query = """
+        SELECT cluster, host, serial, ts, state
+        FROM disk_snapshot
+        WHERE ts BETWEEN ? AND ?
+    """
+    params = [since, until]
+    if cluster:
+        query += " AND cluster = ?"
+        params.append(cluster)
+    query += " ORDER BY host, serial, ts"
+    rebuilds = []
+    started = {}  # (host, serial): ts of the first snapshot in Rebuilding
+    for c, host, serial, ts, state in conn.execute(query, params):
+        key = (host, serial)
+        if state == "Rebuilding":
+            started.setdefault(key, ts)
+        elif key in started:
+            start = started.pop(key)
+            if state == "Online":
+                rebuilds.append((c, host, serial, start, ts, ts - start))
+            # any other state means the rebuild did not complete
+    return rebuilds
+
+
+def query_predictive(conn, since=0, until=None):
+    """
+    Return the disks seen in predictive failure as a list of tuples
+    (host, disk ID, serial, product, first seen, last seen)
+    """
+    if until is None:
+        until = int(time.time())
+    return conn.execute(
+        """
+        SELECT host, disk_id, serial, product, MIN(ts), MAX(ts)
+        FROM disk_snapshot
+        WHERE ts BETWEEN ? AND ? AND predicted != 'No'
+        GROUP BY host, disk_id, serial, product
+        ORDER BY host, disk_id
+        """,
+        (since, until),
+    ).fetchall()
+
+
+def to_epoch(string):
+    """
+    Convert a date (YYYY-MM-DD or YYYY-MM-DD HH:MM) or an epoch to an epoch
+    """
+    if string.isdigit():
+        return int(string)
+    for date_format in ("%Y-%m-%d", "%Y-%m-%d %H:%M"):
+        try:
+            return int(time.mktime(datetime.strptime(string, date_format).timetuple()))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("invalid date: %s" % string)
+
+
+def hr_time(epoch):
+    return str(datetime.fromtimestamp(epoch))
+
+
+def hr_duration(seconds):
+    return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+
+
+def arguments():
+    """
+    Parse arguments and return help message if the script is invoked with -h
+    """
+    parser = argparse.ArgumentParser(
+        description="Query the history of the disks recorded by failed_disk.py",
+        prog="disk_history",
+    )
+    parser.add_argument(
+        "--db", default=default_db, help="history database (default %(default)s)"
+    )
+    parser.add_argument(
+        "query",
+        choices=["failures", "rebuilds", "predictive"],
+        help="failure rate by disk model, rebuild durations, "
+        "disks in predictive failure",
+    )
+    parser.add_argument("--since", type=to_epoch, default=0, help="YYYY-MM-DD")
+    parser.add_argument("--until", type=to_epoch, help="YYYY-MM-DD")
+    parser.add_argument("--cluster", help="only this cluster (rebuilds)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = arguments()
+    if not os.path.exists(args.db):
+        sys.exit("ERROR: %s does not exist, run failed_disk.py --history\n" % args.db)
+    history = open_history(args.db)
+    if args.query == "failures":
+        print(
+            "%-20s %-10s %8s %8s %8s"
+            % ("Product ID", "Capacity", "Seen", "Failed", "Rate")
+        )
+        for product, capacity, seen, failed, rate in query_failure_rates(
+            history, args.since, args.until
+        ):
+            print(
+                "%-20s %-10s %8s %8s %7.2f%%"
+                % (product, capacity, seen, failed, rate * 100)
+            )
+    elif args.query == "rebuilds":
+        rebuilds = query_rebuild_durations(
+            history, args.cluster and args.cluster.upper(), args.since, args.until
+        )
+        for cluster, host, serial, started, finished, seconds in rebuilds:
+            print(
+                "%s %-10s %-12s %s  %s"
+                % (cluster, host, serial, hr_time(started), hr_duration(seconds))
+            )
+        if rebuilds:
+            durations = [r[5] for r in rebuilds]
+            print(
+                "\nRebuilds: %s  min %s  avg %s  max %s"
+                % (
+                    len(durations),
+                    hr_duration(min(durations)),
+                    hr_duration(sum(durations) // len(durations)),
+                    hr_duration(max(durations)),
+                )
+            )
+    else:
+        for host, disk_id, serial, product, first, last in query_predictive(
+            history, args.since, args.until
+        ):
+            print(
+                "%-10s %-8s %-12s %-14s %s - %s"
+                % (host, disk_id, serial, product, hr_time(first), hr_time(last))
+            )
+    history.close()
+    # That's all folks!
@@ -11,14 +11,15 @@ Giuseppe Cunsolo, January-May 2018
 """
 
 # from X import Y
-import socket
-import argparse
-import subprocess
+# socket, subprocess, argparse, datetime and curses are imported where they
+# are used, the script starts faster when it does not need them (-c does not
+# need curses, the batch mode parses the arguments once for many servers)
 import sys
+import os
 import re
-from datetime import datetime
-from time import sleep
-import curses
+import threading
+from functools import lru_cache, wraps
+from time import monotonic, sleep, time
 
 # some variables we are going to use through the script
 # they are all here to make it easier to change them
@@ -51,6 +52,180 @@ datacenter_info = {
     ),
 }
 
+# marketed disk sizes in (decimal) GB, HDD and SSD, used by
+# normalise_capacity to convert the capacity reported by omreport
+disksize_marketed = [
+    120,
+    146,
+    200,
+    240,
+    256,
+    300,
+    400,
+    450,
+    480,
+    500,
+    512,
+    600,
+    800,
+    900,
+    960,
+    1000,
+    1200,
+    1600,
+    1800,
+    1920,
+    2000,
+    2400,
+    3000,
+    3200,
+    3840,
+    4000,
+    6000,
+    6400,
+    7680,
+    8000,
+    10000,
+    12000,
+    14000,
+    15360,
+    16000,
+    18000,
+    20000,
+]
+# extra options for ssh, for example the connection sharing
+# (ControlMaster) the daemon mode keeps warm
+ssh_options = []
+# seconds to connect, seconds for the whole omreport run (see ssh_runner)
+ssh_connect_timeout = 10
+ssh_deadline = 120
+# the Xymon server, XYMSRV and XYMONDPORT as in the Xymon environment #CHANGEME
+xymon_server = os.environ.get("XYMSRV", "abcd")
+xymon_port = int(os.environ.get("XYMONDPORT", "11984"))
+# the Xymon test --publish sends the state of the disks to, the servers
+# in each combo message and its maximum size (xymond drops the messages
+# bigger than MAXMSG_STATUS, 256 KB by default)
+publish_test = "diskdetail"
+publish_batch = 200
+publish_max_bytes = 200000
+# number of hosts queried at the same time in fleet mode
+fleet_workers = 32
+# directory where the raw captures are saved (--archive) for --from-dir
+archive_dir = ""
+# maximum relative distance between the capacity reported and
+# the marketed size (0.03 = 3%)
+disksize_tolerance = 0.03
+
+# these are set by main() from the command line
+server = ""
+stop_with_error = ""
+template_yes = False
+
+# per-stage timings, enabled with --timings/--trace or with the
+# environment variables FAILED_DISK_TIMINGS=1 and FAILED_DISK_TRACE=file
+timings_enabled = bool(os.environ.get("FAILED_DISK_TIMINGS"))
+trace_file = os.environ.get("FAILED_DISK_TRACE", "")
+# list of (stage, host, start, duration, bytes, thread id)
+timings = []
+
+
+def record_timing(stage, host, start, size=0):
+    """
+    Record the time spent in stage since start (from monotonic())
+    """
+    timings.append(
+        (stage, host, start, monotonic() - start, size, threading.get_ident())
+    )
+
+
+def timed(func):
+    """
+    Decorator, record the time spent in func when the timings are enabled;
+    for pull_omreport record also the bytes received (query_xymon records
+    its own timing, its result is the str() of the chunks received)
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not (timings_enabled or trace_file):
+            return func(*args, **kwargs)
+        start = monotonic()
+        result = func(*args, **kwargs)
+        # the host is the first argument of the functions, or the
+        # server of the object for the methods
+        host = getattr(args[0], "server", args[0]) if args else ""
+        if isinstance(result, list) and result and isinstance(result[0], bytes):
+            size = sum(len(line) for line in result)
+        else:
+            size = 0
+        record_timing(func.__name__, host if isinstance(host, str) else "", start, size)
+        return result
+
+    return wrapper
+
+
+def report_timings():
+    """
+    Print the per-stage breakdown of the timings on stderr and,
+    if requested, write them in trace_file (Chrome trace format)
+    """
+    if not timings:
+        return
+    stages = {}
+    for stage, host, start, duration, size, tid in timings:
+        stages.setdefault(stage, []).append((duration, size, host))
+    out = sys.stderr
+    out.write(bcolors.BOLD + " Timings ".center(80, "=") + bcolors.ENDC + "\n")
+    out.write(
+        "%-24s %6s %10s %10s %10s %12s\n"
+        % ("Stage", "Calls", "Total", "Mean", "Max", "Bytes")
+    )
+    # the stages which took most of the time first
+    for stage, values in sorted(
+        stages.items(), key=lambda x: sum(v[0] for v in x[1]), reverse=True
+    ):
+        durations = [v[0] for v in values]
+        out.write(
+            "%-24s %6s %9.3fs %9.3fs %9.3fs %12s\n"
+            % (
+                stage,
+                len(values),
+                sum(durations),
+                sum(durations) / len(durations),
+                max(durations),
+                sum(v[1] for v in values),
+            )
+        )
+    # in fleet mode show the hosts which drive the tail latency
+    hosts = [t for t in timings if t[0] == "collect_server"]
+    if len(hosts) > 1:
+        out.write("\nSlowest hosts:\n")
+        for stage, host, start, duration, size, tid in sorted(
+            hosts, key=lambda x: x[3], reverse=True
+        )[:10]:
+            out.write("%-24s %9.3fs\n" % (host, duration))
+    out.write(bcolors.BOLD + "-" * 80 + bcolors.ENDC + "\n")
+    if trace_file:
+        import json
+
+        origin = min(t[2] for t in timings)
+        events = [
+            {
+                "name": stage,
+                "cat": "failed_disk",
+                "ph": "X",
+                "ts": int((start - origin) * 1e6),
+                "dur": int(duration * 1e6),
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"host": host, "bytes": size},
+            }
+            for stage, host, start, duration, size, tid in timings
+        ]
+        with open(trace_file, "w") as trace:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace)
+        out.write("Trace written in %s\n" % trace_file)
+
 
 class bcolors:
     """
@@ -74,17 +249,32 @@ class server_object:
     parsed and easy to consume
     """
 
-    def __init__(self, hwdisk, hinv, omreport):
-        self.hwdisk = strip(hwdisk)
-        self.hinv = strip(hinv)
+    def __init__(self, hwdisk, hinv, omreport, host=None, parsed=None):
+        if parsed:
+            # already parsed elsewhere (see to_dict), nothing to strip
+            hwdisk, hinv = parsed["hwdisk"], ""
+            omreport = None if parsed["stop_with_error"] else []
+            host = parsed["server"]
+        else:
+            hwdisk, hinv = strip(hwdisk), strip(hinv)
+        self.hwdisk = hwdisk
+        self.hinv = hinv
         self.omreport = omreport
-        self.stop_with_error = stop_with_error
+        # the hostname defaults to the server given on the command line;
+        # in fleet mode each object is created with its own hostname
+        self.server = host if host else server
+        self.letter = get_cluster_letter(self.server)
+        # pull_omreport returns None when it cannot ssh to the server
+        self.stop_with_error = "SSH" if omreport is None else ""
         # init some object variables
         self.failed = False
         self.pred_failure = False
         self.not_in_use = False
         self.rebuilding = False
         self.print_templates = False
+        # where the information about the disks comes from: omreport or,
+        # when we cannot ssh to the server, the xymon hw-disk test
+        self.disk_source = "omreport"
         # create a list of information we gather from the xymon hwdisk test
         # and init a empty dict which will contain all the data
         self.hwdisk_list = ["RAID type", "RAID status", "Test status"]
@@ -116,11 +306,24 @@ class server_object:
         #
         # kick in the parsing methods
         # self.omreport_p = self.parse_omreport_disks()
+        if parsed:
+            self.hwdisk_data = parsed["hwdisk_data"]
+            self.server_details = parsed["server_details"]
+            self.disk_source = parsed["disk_source"]
+            # JSON has no tuples
+            self.list_all = [tuple(disk) for disk in parsed["disks"]]
+            self.sort_disks()
+            return
         self.parse_hwdisk()
         self.parse_hinv()
-        if stop_with_error != "SSH":
+        if self.stop_with_error != "SSH":
             self.parse_omreport_disks()
+        else:
+            # cannot ssh to the server, build the list of disks
+            # from the xymon test instead
+            self.parse_hwdisk_disks()
 
+    @timed
     def parse_hwdisk(self):
         """
         Parse xymon hwdisk test and extract the result of the test
@@ -142,12 +345,49 @@ class server_object:
             self.hwdisk_data["Test status"] = ""
         # TODO in the next version of the script these
         # should be tested singularly
-        # TODO
-        # if failed to ssh to the server build the list of failed disk based on
-        # the xymon test
-        # else:
-        # just gather information about the test (RAID, RAID status etc)
 
+    @timed
+    def parse_hwdisk_disks(self):
+        """
+        Parse the lines about the physical disks in the xymon hwdisk test
+        and build the same list of disks parse_omreport_disks builds;
+        used when we cannot ssh to the server
+        """
+        # a line of the xymon test looks like this
+        # green Physical Disk 0:1:0 (SAS HDD 558.38 GB ST3600057SS S/N 3SK15JJK) is Online
+        # with " (Progress: 37%)" or ", Failure Predicted" at the end
+        # when the disk is rebuilding or in predictive failure
+        status = {"green": "Ok", "yellow": "Non-Critical", "red": "Critical"}
+        result = []
+        for found in re.findall(
+            r"^(\w+)\sPhysical\sDisk\s(\S+)\s\((\w+)\s(\w+)\s(.*\sT?G?B)\s(\w+)"
+            r"\sS/N\s(\w+)\)\sis\s(\w+)(.*)$",
+            self.hwdisk,
+            re.MULTILINE,
+        ):
+            colour, disk_id, bus, media, capacity, product, serial, state, extra = found
+            progress = re.findall(r"Progress:\s(.*)\)", extra)
+            # same layout as the tuple in parse_omreport_disks
+            result.append(
+                (
+                    [disk_id],
+                    [status.get(colour, "Unknown")],
+                    [state],
+                    [bus],
+                    [media],
+                    ["Yes" if "Failure Predicted" in extra else "No"],
+                    progress if progress else ["Not Applicable"],
+                    hr_disk_size([capacity]),
+                    [product],
+                    [serial],
+                )
+            )
+        if result:
+            self.disk_source = "Xymon"
+        self.list_all = result
+        self.sort_disks()
+
+    @timed
     def parse_hinv(self):
         """
         Parse xymon hinv test and extract information about the server
@@ -156,36 +396,9 @@ class server_object:
         # Fix a bug where sometimes Xymon will put ",b '
         # in the middle of Rack location
         self.hinv = self.hinv.replace("\", b'", "")
-        try:
-            self.server_details["Location"] = re.findall(
-                r".*Rack location:\s+(.*),\s\w", self.hinv, re.MULTILINE
-            )[0].split(", ")[0]
-            self.server_details["Rack"] = re.findall(
-                r".*Rack location:\s+(.*),\s\w", self.hinv, re.MULTILINE
-            )[0].split(", ")[1]
-            # here we need to extract 1 or 2 RU, therefore the |
-            # test for 2 RUs first, if that doesn't match extract 1 RU
-            self.server_details["RU"] = re.findall(
-                r".*position:\s(\d*,\d*|\d*)", self.hinv, re.MULTILINE
-            )[0]
-            self.server_details["Asset tag"] = re.findall(
-                r".*Serial\s:\s(\w*)\s+\n", self.hinv, re.MULTILINE
-            )[0]
-            self.server_details["Server model"] = re.findall(
-                r".*HW type\s:\s(.*)\s+\n", self.hinv, re.MULTILINE
-            )[0].strip()
-        except IndexError:
-            print("Something important is missing from the hinv!")
-        # TODO in the next version of the script these values
-        # should be tested singularly
-        try:
-            self.server_details["Warranty epoch"] = re.findall(
-                r".*HW\swarranty\s\(epoch\)\s\:\s(\d+).*", self.hinv, re.MULTILINE
-            )[0]
-        except IndexError:
-            # Warranty epoch is empty in the hinv
-            self.server_details["Warranty epoch"] = ""
+        self.server_details = hinv_details(self.hinv)
 
+    @timed
     def parse_omreport_disks(self):
         """
         Parse omreport and extract information about disks
@@ -253,10 +466,31 @@ class server_object:
         # now result is populated with the full list of disks
         # we will need this outside the function
         self.list_all = result
-        # build the list of disks failed/in predictive failure/
-        #                         rebuilding/not in the raid
-        # and set the state variables accordingly
-        for enclose in result:
+        self.sort_disks()
+
+    def to_dict(self):
+        """
+        Return the parsed information in JSON types, without the raw
+        hinv and omreport; server_object(None, None, None, parsed=dict)
+        builds the object again without parsing (see fleet_agent.py)
+        """
+        return {
+            "server": self.server,
+            "hwdisk": self.hwdisk,
+            "hwdisk_data": self.hwdisk_data,
+            "server_details": self.server_details,
+            "stop_with_error": self.stop_with_error,
+            "disk_source": self.disk_source,
+            "disks": self.list_all,
+        }
+
+    def sort_disks(self):
+        """
+        Build the list of disks failed/in predictive failure/
+        rebuilding/not in the raid from self.list_all
+        and set the state variables accordingly
+        """
+        for enclose in self.list_all:
             # check separately for failures and predictive failures
             # also checks for disks not failed AND not in the RAID (Ready)
             if enclose[2] == ["Ready"]:  # the disk is not in use
@@ -289,7 +523,7 @@ class server_object:
         print and refresh information about disk rebuilding
         """
         # stop if the server is offline
-        if stop_with_error == "SSH":
+        if self.stop_with_error == "SSH":
             print(
                 bcolors.FAIL
                 + "The server may be offline!"
@@ -304,6 +538,8 @@ class server_object:
         #
         # we need to wrap the next part in curses
         # for a sane handling of screen refresh
+        import curses
+
         curses.wrapper(self.curses_progress)
         # Print a summary that will stay on screen
         # after the curses finished
@@ -319,6 +555,35 @@ class server_object:
             print("Progress:".ljust(20), n[6][0])
         close_section()
 
+    def refresh_omreport(self):
+        """
+        Pull a new omreport, refresh self.omreport within the object,
+        clear all the lists and states to avoid duplicates and
+        then trigger the parse method again
+        """
+        self.list_all = []
+        self.list_failed = []
+        self.list_predictive = []
+        self.list_notinuse = []
+        self.list_rebuilding = []
+        self.list_needreplacement = []
+        self.failed = False
+        self.pred_failure = False
+        self.not_in_use = False
+        self.rebuilding = False
+        #
+        rack = None
+        if "Rack" in self.server_details:
+            rack = "%s/%s" % (
+                self.server_details["Location"],
+                self.server_details["Rack"],
+            )
+        self.omreport = pull_omreport(self.server, rack)
+        # the server may have gone offline (or come back)
+        self.stop_with_error = "SSH" if self.omreport is None else ""
+        if self.stop_with_error != "SSH":
+            self.parse_omreport_disks()
+
     def curses_progress(self, sc):
         """
         Print the progress of disk rebuilding; refresh every 60s
@@ -328,6 +593,8 @@ class server_object:
         # must be an even number (30, 60, 120)
         refresh_rate = 60
         dont_exit_the_loop = True
+        from datetime import datetime
+
         #
         # if scrollok(False) and the list of disks rebuilding goes outside
         # the terminal size it fails with:
@@ -342,7 +609,7 @@ class server_object:
             counter += 1
             sc.addstr(
                 "Server: %s\t\tTime: %s\t\t(%s)\n"
-                % (server, str(datetime.now().strftime("%H:%M:%S")), counter)
+                % (self.server, str(datetime.now().strftime("%H:%M:%S")), counter)
             )
             sc.addstr("Rebuilding: %s\n" % len(self.list_rebuilding))
             for n in self.list_rebuilding:
@@ -359,20 +626,7 @@ class server_object:
             )
             # sc.addstr("%s %s %s %s" % (0, 0, curses.LINES - 1, curses.COLS - 1))  # DEBUG
             sc.refresh()
-            #
-            # pull a new omreport, refresh self.omreport within the object
-            # clear all the lists to avoid duplicates and
-            # then trigger the parse method again
-            #
-            self.list_all = []
-            self.list_failed = []
-            self.list_predictive = []
-            self.list_notinuse = []
-            self.list_rebuilding = []
-            self.list_needreplacement = []
-            #
-            self.omreport = pull_omreport(server)
-            self.parse_omreport_disks()
+            self.refresh_omreport()
             #
             # instead of waiting (sleep) for refresh_rate seconds and
             # check if the key 'q' is pressed, check every 1 second
@@ -391,10 +645,13 @@ class server_object:
                     pass
                 sleep(1)
 
+    @timed
     def print_location(self):
         """
         Print the server location and warranty information
         """
+        from datetime import datetime
+
         open_section("Server location")
         for i in self.hinv_list:
             print(i + ":".ljust(20 - len(i)), self.server_details[i])
@@ -405,21 +662,37 @@ class server_object:
             )
         else:
             print("\nThe Warranty epoch is missing\n")
-        print("\nURL:\n%s" % datacenter_info[letter][2])
+        print("\nURL:\n%s" % datacenter_info[self.letter][2])
         close_section()
 
-    def print_serialn(self):
+    def print_offline_warning(self):
         """
-        Print the full status, model, serial numbers for all the disks
-        as requested by the user with the argument -s/--serial
+        Warn the user when we cannot ssh to the server
         """
-        if stop_with_error == "SSH":
+        if self.stop_with_error != "SSH":
+            return
+        if self.disk_source == "Xymon":
+            print(
+                bcolors.FAIL
+                + "The server may be offline!"
+                + bcolors.ENDC
+                + " The information about the disks comes from the Xymon test.\n"
+            )
+        else:
             print(
                 bcolors.FAIL
                 + "The server may be offline!"
                 + bcolors.ENDC
                 + " The following information may not be accurate.\n"
             )
+
+    @timed
+    def print_serialn(self):
+        """
+        Print the full status, model, serial numbers for all the disks
+        as requested by the user with the argument -s/--serial
+        """
+        self.print_offline_warning()
         open_section("Disk information and serial numbers")
         for i in self.hwdisk_list:
             print(i + ":".ljust(20 - len(i)), self.hwdisk_data[i])
@@ -436,18 +709,13 @@ class server_object:
             print("Serial No.:".ljust(20), n[9][0])
         close_section()
 
+    @timed
     def print_compact(self):
         """
         Print a compact report as requested by the user with
         the argument -c/--compact
         """
-        if stop_with_error == "SSH":
-            print(
-                bcolors.FAIL
-                + "The server may be offline!"
-                + bcolors.ENDC
-                + " The following information may not be accurate.\n"
-            )
+        self.print_offline_warning()
         open_section("Compact report")
         for i in ["Location", "Rack", "RU", "Asset tag", "Server model"]:
             print(i + ":".ljust(20 - len(i)), self.server_details[i])
@@ -460,18 +728,68 @@ class server_object:
         print("Rebuilding:".ljust(20), len(self.list_rebuilding))
         close_section()
 
+    def jira_ticket(self):
+        """
+        Return the body of the JIRA ticket for the disks to replace,
+        printed by print_result and filed by tickets.py
+        """
+        from datetime import datetime
+
+        lines = [
+            "URL1?HOST=%s&SERVICE=disk\n" % self.server,
+            "URL2?HOST=%s&SERVICE=log\n" % self.server,
+            "{code:java}",
+            self.hwdisk.replace("\n\n\n", ""),  # cut the 3x\n at the end
+            "{code}",
+        ]
+        # the server model, asset tag, warranty
+        lines.append("-----\n{code:java}")
+        lines.append(
+            "%s %s" % ("Server model:".ljust(20), self.server_details["Server model"])
+        )
+        lines.append(
+            "%s %s" % ("Asset tag:".ljust(20), self.server_details["Asset tag"])
+        )
+        if self.server_details["Warranty epoch"]:
+            lines.append(
+                "%s %s"
+                % (
+                    "Warranty:".ljust(20),
+                    datetime.fromtimestamp(int(self.server_details["Warranty epoch"])),
+                )
+            )
+        else:
+            lines.append("%s %s" % ("Warranty:".ljust(20), "no information available"))
+        lines.append("{code}")
+        # the failed disks, the disks in predictive failure and the disks
+        # not in the RAID; Capacity n[7] is the only item already a string
+        for present, title, disks in (
+            (self.failed, "Failed disk(s)", self.list_failed),
+            (self.pred_failure, "Predictive failure disk(s)", self.list_predictive),
+            (self.not_in_use, "Disks not in use in the RAID", self.list_notinuse),
+        ):
+            if not present:
+                continue
+            lines.append("-----\n{code:java}")
+            lines.append("%s: %s" % (title, len(disks)))
+            for n in disks:
+                lines.append("\n%s %s" % ("ID:".ljust(20), n[0][0]))
+                lines.append("%s %s" % ("Status:".ljust(20), n[1][0]))
+                lines.append("%s %s" % ("State:".ljust(20), n[2][0]))
+                lines.append("%s %s" % ("Serial No.:".ljust(20), n[9][0]))
+                lines.append("%s %s" % ("Capacity:".ljust(20), n[7]))
+                lines.append("%s %s" % ("Bus Protocol:".ljust(20), n[3][0]))
+                lines.append("%s %s" % ("Failure Predicted:".ljust(20), n[5][0]))
+            lines.append("{code}")
+        return "\n".join(lines)
+
+    @timed
     def print_result(self):
         """
         Print information about disks and template for replacement
         based on the arg flags (-t, etc)
         """
-        if stop_with_error == "SSH":
-            print(
-                bcolors.FAIL
-                + "The server may be offline!"
-                + bcolors.ENDC
-                + " The following information may not be accurate.\n"
-            )
+        self.print_offline_warning()
         # Print the information from Xymon test
         open_section("Xymon test")
         for i in self.hwdisk_list:
@@ -501,64 +819,7 @@ class server_object:
         if self.print_templates or template_yes:
             # Print a template for JIRA ticket
             open_section("Template: JIRA Ticket")
-            print("URL1?HOST=%s&SERVICE=disk\n" % server)
-            print("URL2?HOST=%s&SERVICE=log\n" % server)
-            print("{code:java}")
-            print(self.hwdisk.replace("\n\n\n", ""))  # cut the 3x\n at the end
-            print("{code}")
-            # Print the server model, asset tag, warranty for the JIRA ticket
-            print("-----\n{code:java}")
-            print("Server model:".ljust(20), self.server_details["Server model"])
-            print("Asset tag:".ljust(20), self.server_details["Asset tag"])
-            if self.server_details["Warranty epoch"]:
-                print(
-                    "Warranty:".ljust(20),
-                    datetime.fromtimestamp(int(self.server_details["Warranty epoch"])),
-                )
-            else:
-                print("Warranty:".ljust(20), "no information available")
-            print("{code}")
-            # Print the list of failed disks
-            # when printing Capacity n[7] remember that is the only
-            # item which is already a string
-            if self.failed:
-                print("-----\n{code:java}")
-                print("Failed disk(s): %s" % len(self.list_failed))
-                for n in self.list_failed:
-                    print("\n" + "ID:".ljust(20), n[0][0])
-                    print("Status:".ljust(20), n[1][0])
-                    print("State:".ljust(20), n[2][0])
-                    print("Serial No.:".ljust(20), n[9][0])
-                    print("Capacity:".ljust(20), n[7])
-                    print("Bus Protocol:".ljust(20), n[3][0])
-                    print("Failure Predicted:".ljust(20), n[5][0])
-                print("{code}")
-            # Print the list of disks in predictive failure
-            if self.pred_failure:
-                print("-----\n{code:java}")
-                print("Predictive failure disk(s): %s" % len(self.list_predictive))
-                for n in self.list_predictive:
-                    print("\n" + "ID:".ljust(20), n[0][0])
-                    print("Status:".ljust(20), n[1][0])
-                    print("State:".ljust(20), n[2][0])
-                    print("Serial No.:".ljust(20), n[9][0])
-                    print("Capacity:".ljust(20), n[7])
-                    print("Bus Protocol:".ljust(20), n[3][0])
-                    print("Failure Predicted:".ljust(20), n[5][0])
-                print("{code}")
-            # Print the list of disks not in the RAID
-            if self.not_in_use:
-                print("-----\n{code:java}")
-                print("Disks not in use in the RAID: %s" % len(self.list_notinuse))
-                for n in self.list_notinuse:
-                    print("\n" + "ID:".ljust(20), n[0][0])
-                    print("Status:".ljust(20), n[1][0])
-                    print("State:".ljust(20), n[2][0])
-                    print("Serial No.:".ljust(20), n[9][0])
-                    print("Capacity:".ljust(20), n[7])
-                    print("Bus Protocol:".ljust(20), n[3][0])
-                    print("Failure Predicted:".ljust(20), n[5][0])
-                print("{code}")
+            print(self.jira_ticket())
             close_section()
 
             # Print the email template for parcel delivery
@@ -577,8 +838,8 @@ class server_object:
                     + " %s HDD to Cluster %s %s\n"
                     % (
                         self.list_all[0][7] + " " + self.list_all[0][3][0],
-                        letter,
-                        datacenter_info[letter][0],
+                        self.letter,
+                        datacenter_info[self.letter][0],
                     )
                 )
 
@@ -601,11 +862,11 @@ Please ship <N>x %s disks as per subject please.
                     % (
                         self.list_all[0][7] + " " + self.list_all[0][3][0],
                         self.list_all[0][7] + " " + self.list_all[0][3][0],
-                        letter,
-                        datacenter_info[letter][0],
+                        self.letter,
+                        datacenter_info[self.letter][0],
                         self.server_details["Location"],
-                        datacenter_info[letter][3],
-                        datacenter_info[letter][4],
+                        datacenter_info[self.letter][3],
+                        datacenter_info[self.letter][4],
                     )
                 )
             except IndexError:
@@ -626,22 +887,29 @@ Please ship <N>x %s disks as per subject please.
                 + bcolors.ENDC
                 + "\n\n"
             )
-            if self.list_needreplacement and stop_with_error != "SSH":
-                # if the list is not empty AND we can connect to the server
-                # (= the disk info is populated) print the SH template
-                # with the real information, print a template for each disk
+            if self.list_needreplacement:
+                # if the list is not empty (= the disk info is populated,
+                # from omreport or from the xymon test if we cannot connect
+                # to the server) print the SH template with the real
+                # information, print a template for each disk
                 for i in self.list_needreplacement:
                     self.print_sh_template(False, i)
-            elif stop_with_error == "SSH":
-                sys.exit("The server is offline!")
-                # TODO
-                # if cannot connect to the server print an empty template
-            else:
+            elif self.list_all:
                 # else, print the mock information
                 self.print_sh_template()
+            else:
+                # no information about the disks at all
+                print(
+                    bcolors.FAIL
+                    + "The server may be offline!"
+                    + bcolors.ENDC
+                    + " Xymon has no information about the disks either,"
+                    + " unable to print this section.\n"
+                )
             print(template_closing)
             close_section()
 
+    @timed
     def print_sh_template(self, mock=True, disk=()):
         """
         Print the disk replacement template;
@@ -680,7 +948,7 @@ Please ship <N>x %s disks as per subject please.
         print("1. take one disk of size %s from <...>" % replace_vars[0])
         print(
             "2. locate the server > %s < and replace disk in bay %s (Serial number: %s)"
-            % (server, replace_vars[1], replace_vars[2])
+            % (self.server, replace_vars[1], replace_vars[2])
         )
         print(
             """
@@ -692,7 +960,7 @@ Please ship <N>x %s disks as per subject please.
 
 3. label the broken disk as "FAILED" """
             % (
-                server,
+                self.server,
                 self.server_details["Rack"],
                 self.server_details["RU"],
                 self.server_details["Asset tag"],
@@ -709,13 +977,16 @@ def arguments():
     # version = "0.1 - January 2018"
     # version = "0.2 - April 2018"
     # version = "0.3 - May 2018"
-    version = "0.3.1 - May 2018"  # Fixed duplicate entries when using -p
+    # version = "0.3.1 - May 2018"  # Fixed duplicate entries when using -p
+    version = "0.4 - October 2026"  # Fleet mode, bulk delivery requests
     prg_description = "Pull the information about failed disk(s) and print templates to raise a JIRA ticket, Smart Hands requests, etc."
     # #
+    import argparse
+
     parser = argparse.ArgumentParser(
         description=prg_description, prog="failed_disk script"
     )
-    parser.add_argument("server", help="The server hostname, ex: prx11a")
+    parser.add_argument("server", nargs="?", help="The server hostname, ex: prx11a")
     parser.add_argument(
         "-v", "--version", action="version", version="%(prog)s version " + version
     )
@@ -740,18 +1011,195 @@ def arguments():
         help="print the templates even if there is no disk failed or in predictive failure",
         action="store_true",
     )
+    parser.add_argument(
+        "-f",
+        "--fleet",
+        metavar="FILE",
+        help="read the list of servers from FILE, one per line ('-' for stdin), "
+        "and print the report of each server (batch mode)",
+    )
+    parser.add_argument(
+        "-o",
+        "--order",
+        help="with --fleet, print one consolidated delivery request per datacenter",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--visit",
+        help="with --fleet, print one Smart Hands ticket per datacenter "
+        "with all the disks to replace, ordered by rack and RU",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--predictive",
+        help="with --order or --visit, also replace disks in predictive failure",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--history",
+        metavar="FILE",
+        nargs="?",
+        const="",
+        help="record the disks in the history database (see disk_history.py)",
+    )
+    parser.add_argument(
+        "--inventory",
+        metavar="FILE",
+        nargs="?",
+        const="",
+        help="record the servers in the inventory database (see hw_inventory.py), "
+        "--visit uses it for the servers whose hinv is missing",
+    )
+    parser.add_argument(
+        "--tickets",
+        metavar="FILE",
+        nargs="?",
+        const="",
+        help="file the JIRA tickets for the disks not in an open ticket "
+        "(see tickets.py), FILE is the index of the tickets",
+    )
+    parser.add_argument(
+        "--timings",
+        help="print the time spent in each stage on stderr "
+        "(or set FAILED_DISK_TIMINGS=1)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="write the timings in FILE in Chrome trace format "
+        "(or set FAILED_DISK_TRACE=FILE)",
+    )
+    parser.add_argument(
+        "-w",
+        "--watch",
+        help="poll the server(s) and print the changes of the disks "
+        "as JSON lines, until interrupted",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=60,
+        help="with --watch, seconds between the polls (default %(default)s)",
+    )
+    parser.add_argument(
+        "-x",
+        "--xymon-only",
+        help="do not connect to the server(s), take the information "
+        "about the disks from the Xymon test",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--from-dir",
+        metavar="DIR",
+        help="do not query Xymon and the server(s), replay the captures in DIR "
+        "($host.hw-disk, $host.hinv, $host.omreport); without a server or "
+        "--fleet all the servers in DIR are replayed as a fleet",
+    )
+    parser.add_argument(
+        "--archive",
+        metavar="DIR",
+        help="save the captures of the server(s) in DIR, for --from-dir",
+    )
+    parser.add_argument(
+        "--publish",
+        help="send the state of the disks of the server(s) to Xymon as the "
+        "%s test, in batches" % publish_test,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--agents",
+        help="with --fleet, collect the servers of each cluster through "
+        "the agent in its datacenter (see fleet_agent.py)",
+        action="store_true",
+    )
     args = parser.parse_args()
     """
     perform sanity check on arguments
     """
+    # we need either a server or a list of servers, not both; --from-dir
+    # alone replays all the servers in the directory
+    if args.server and args.fleet:
+        sys.exit("ERROR: Provide either a server or a list of servers (--fleet)\n")
+    if not (args.server or args.fleet or args.from_dir):
+        sys.exit("ERROR: Provide either a server or a list of servers (--fleet)\n")
+    many = args.fleet or (args.from_dir and not args.server)
+    # the consolidated delivery request needs a fleet, the progress
+    # screen only follows one server
+    if args.order and not many:
+        sys.exit("ERROR: --order can only be used with --fleet\n")
+    if args.visit and not many:
+        sys.exit("ERROR: --visit can only be used with --fleet\n")
+    if many and args.progress:
+        sys.exit("ERROR: --progress cannot be used with --fleet\n")
+    # the captures do not change, there is nothing to follow
+    if args.from_dir and (args.progress or args.watch or args.archive):
+        sys.exit("ERROR: You have selected incompatible options\n")
+    # publish only what has just been collected
+    if args.publish and (args.from_dir or args.watch):
+        sys.exit("ERROR: You have selected incompatible options\n")
+    # the agents collect live, on their side
+    if args.agents and (not args.fleet or args.from_dir or args.watch or args.archive):
+        sys.exit("ERROR: --agents can only be used with --fleet\n")
+    if args.from_dir and not os.path.isdir(args.from_dir):
+        sys.exit("ERROR: %s is not a directory\n" % args.from_dir)
+    # -p and --watch need to connect to the server
+    if args.xymon_only and (args.progress or args.watch):
+        sys.exit("ERROR: You have selected incompatible options\n")
+    # --watch only prints the events
+    if args.watch and any(
+        [
+            args.template,
+            args.serial,
+            args.progress,
+            args.compact,
+            args.order,
+            args.visit,
+            args.tickets is not None,
+        ]
+    ):
+        sys.exit("ERROR: You have selected incompatible options\n")
+    if args.predictive and not (args.order or args.visit or args.tickets is not None):
+        sys.exit(
+            "ERROR: --predictive can only be used with --order, --visit or --tickets\n"
+        )
     # check that server is a string of 3 characters followed by 2 numbers
-    if not re.match("[a-z][a-z][a-z][0-9][0-9][a-z]+", args.server):
+    if args.server and not re.match("[a-z][a-z][a-z][0-9][0-9][a-z]+", args.server):
         sys.exit("ERROR: Server not valid\n")
     # check for incompatible options: only 1 option can be selected
     # between -c/-s/-p/-t
     if sum([args.template, args.serial, args.progress, args.compact]) > 1:
         sys.exit("ERROR: You have selected incompatible options\n")
-    return args.server, args.template, args.serial, args.progress, args.compact
+    # and none of them with --order/--visit
+    if sum([args.order, args.visit]) > 1 or (
+        (args.order or args.visit)
+        and any([args.template, args.serial, args.progress, args.compact])
+    ):
+        sys.exit("ERROR: You have selected incompatible options\n")
+    return (
+        args.server,
+        args.template,
+        args.serial,
+        args.progress,
+        args.compact,
+        args.fleet,
+        args.order,
+        args.predictive,
+        args.history,
+        args.timings,
+        args.trace,
+        args.watch,
+        args.interval,
+        args.xymon_only,
+        args.visit,
+        args.inventory,
+        args.from_dir,
+        args.archive,
+        args.tickets,
+        args.agents,
+        args.publish,
+    )
 
 
 def query_xymon(host, test):
@@ -759,14 +1207,18 @@ def query_xymon(host, test):
     Query Xymon for $host.$test
     returns a string
     """
+    import socket
+
     # initialise variable data, we can do this in two different ways
     # data = '' # data is a string
     data = []  # data is a list
-    xserver = "abcd"
     parameter = "xymondlog " + host + "." + test
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     # sock.settimeout(10)
-    sock.connect((xserver, 11984))
+    start = monotonic()
+    sock.connect((xymon_server, xymon_port))
+    if timings_enabled or trace_file:
+        record_timing("query_xymon.connect", host, start)
     sock.send(parameter.encode("ascii", "xmlcharrefreplace"))
     sock.shutdown(socket.SHUT_WR)
     """
@@ -783,29 +1235,52 @@ def query_xymon(host, test):
     End of the loop
     """
     sock.close()
+    if timings_enabled or trace_file:
+        # the bytes received, not the length of the str() returned
+        record_timing("query_xymon", host, start, sum(len(c) for c in data))
     # return data                # data is a string
     return str(data)  # data is a list
 
 
-def pull_omreport(server):
+@timed
+def pull_omreport(server, rack=None):
     """
-    User subprocess to connect to $server and run the command
-    "omreport storage pdisk controller=0" with sudo
+    Use ssh_runner to connect to $server and run the command
+    "omreport storage pdisk controller=0" with sudo;
+    rack lets the circuit breaker skip a rack which is down
     """
+    import ssh_runner
+
     # use the global variable stop_with_error
     global stop_with_error
     #
     command = "sudo omreport storage pdisk controller=0"
-    ssh = subprocess.Popen(
-        ["ssh", "%s" % server, command],
-        shell=False,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+    # bounded connection time and deadline, retries on connection
+    # failures, the servers (racks) recently unreachable are skipped
+    ssh = ssh_runner.run(
+        server,
+        command,
+        options=ssh_options,
+        rack=rack,
+        connect_timeout=ssh_connect_timeout,
+        deadline=ssh_deadline,
     )
-    result = ssh.stdout.readlines()
+    if (timings_enabled or trace_file) and ssh.first_line is not None:
+        # the first line arrives after the SSH handshake and once omreport
+        # has done its job on the server
+        timings.append(
+            (
+                "pull_omreport.first_line",
+                server,
+                ssh.started,
+                ssh.first_line,
+                0,
+                threading.get_ident(),
+            )
+        )
+    result = ssh.stdout
     if result == []:  # print the error and exit gracefully
-        error = ssh.stderr.readlines()
-        sys.stderr.write("ERROR: %s\n" % strip(str(error)))
+        sys.stderr.write("ERROR: %s\n" % ssh.error())
         stop_with_error = "SSH"
         # if cannot ssh to the server do NOT exit
         # print the error, assign the variable stop_with_error and
@@ -819,6 +1294,54 @@ def pull_omreport(server):
         return result
 
 
+def hinv_details(hinv):
+    """
+    Extract the details of a server from the (stripped) xymon hinv test:
+    Location, Rack, RU, Asset tag, Server model, Warranty epoch
+    Return a dict, the details missing from the hinv are not in it
+    """
+    server_details = {}
+    try:
+        server_details["Location"] = re.findall(
+            r".*Rack location:\s+(.*),\s\w", hinv, re.MULTILINE
+        )[0].split(", ")[0]
+        server_details["Rack"] = re.findall(
+            r".*Rack location:\s+(.*),\s\w", hinv, re.MULTILINE
+        )[0].split(", ")[1]
+        # here we need to extract 1 or 2 RU, therefore the |
+        # test for 2 RUs first, if that doesn't match extract 1 RU
+        server_details["RU"] = re.findall(
+            r".*position:\s(\d*,\d*|\d*)", hinv, re.MULTILINE
+        )[0]
+        server_details["Asset tag"] = re.findall(
+            r".*Serial\s:\s(\w*)\s+\n", hinv, re.MULTILINE
+        )[0]
+        server_details["Server model"] = re.findall(
+            r".*HW type\s:\s(.*)\s+\n", hinv, re.MULTILINE
+        )[0].strip()
+    except IndexError:
+        print("Something important is missing from the hinv!")
+    # TODO in the next version of the script these values
+    # should be tested singularly
+    try:
+        server_details["Warranty epoch"] = re.findall(
+            r".*HW\swarranty\s\(epoch\)\s\:\s(\d+).*", hinv, re.MULTILINE
+        )[0]
+    except IndexError:
+        # Warranty epoch is empty in the hinv
+        server_details["Warranty epoch"] = ""
+    return server_details
+
+
+def get_rack(hinv):
+    """
+    Return the datacenter location and the rack of a server from
+    the raw xymon hinv test ("DC Location A/R12"), None if missing
+    """
+    found = re.findall(r".*Rack location:\s+(.*?),\s(\w+),", strip(hinv))
+    return "%s/%s" % found[0] if found else None
+
+
 def strip(string):
     """
     Strip a string of all the extra characters, HTML tags for a cleaner output
@@ -862,13 +1385,21 @@ def strip(string):
     return string
 
 
+def get_cluster_letter(server):
+    """
+    Extract the cluster letter from the server hostname,
+    for example prx11a is in cluster A
+    """
+    return re.search("[a-z][a-z][a-z][0-9][0-9](.*)", server).group(1).upper()
+
+
 def get_cluster_info(server):
     """
     get the cluster letter and based on that assign variables like
     datacenter address, link to racktables etc
     """
     #
-    cluster_letter = re.search("[a-z][a-z][a-z][0-9][0-9](.*)", server).group(1).upper()
+    cluster_letter = get_cluster_letter(server)
     # check if it's a valid cluster
     if cluster_letter not in datacenter_info:
         sys.exit("ERROR: I don't have cluster %s in my list.\n" % cluster_letter)
@@ -887,29 +1418,785 @@ def get_cluster_info(server):
     return cluster_letter
 
 
+def read_hosts(filename):
+    """
+    Read the list of hosts for the fleet mode from filename, one host
+    per line; "-" reads from stdin, empty lines and comments are skipped
+    """
+    if filename == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open(filename) as hostfile:
+            lines = hostfile.readlines()
+    hosts = []
+    for line in lines:
+        host = line.split("#")[0].strip()
+        if not host:
+            continue
+        error = check_host(host)
+        if error:
+            sys.stderr.write("ERROR: %s, skipping %s\n" % (error, host))
+        else:
+            hosts.append(host)
+    return hosts
+
+
+def check_host(host):
+    """
+    Same sanity check we do on the command line, return
+    the error or an empty string if host is valid
+    """
+    if not re.match("[a-z][a-z][a-z][0-9][0-9][a-z]+", host):
+        return "Server not valid"
+    if get_cluster_letter(host) not in datacenter_info:
+        return "I don't have cluster %s in my list" % get_cluster_letter(host)
+    return ""
+
+
+@timed
+def collect_server(host, ssh=True):
+    """
+    Query Xymon and the server itself and return the server_object for $host;
+    with ssh=False only Xymon is queried
+    """
+    result_hwdisk = query_xymon(host, "hw-disk")
+    result_hinv = query_xymon(host, "hinv")
+    omreport = pull_omreport(host, get_rack(result_hinv)) if ssh else None
+    if archive_dir:
+        archive_server(archive_dir, host, result_hwdisk, result_hinv, omreport)
+    return server_object(result_hwdisk, result_hinv, omreport, host)
+
+
+def collect_fleet(hosts, ssh=True):
+    """
+    Build the server_object for all the hosts, fleet_workers at a time;
+    the time is spent waiting on Xymon and SSH, threads are enough
+    Return a list of server_object, the hosts which failed are skipped
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    servers = []
+    with ThreadPoolExecutor(max_workers=fleet_workers) as pool:
+        futures = [(host, pool.submit(collect_server, host, ssh)) for host in hosts]
+        for host, future in futures:
+            try:
+                servers.append(future.result())
+            except (OSError, IndexError) as error:
+                # cannot reach Xymon or the data is garbage, report and go on
+                sys.stderr.write("ERROR: %s: %s\n" % (host, error))
+    return servers
+
+
+def read_capture(filename):
+    """
+    Return the content of a capture (bytes) read in one go, None if
+    the file is not there
+    """
+    try:
+        with open(filename, "rb") as capture:
+            return capture.read()
+    except FileNotFoundError:
+        return None
+
+
+def capture_hosts(directory):
+    """
+    Return the hosts with a capture in directory (a $host.hw-disk file);
+    the names which are not valid hosts are reported and skipped, as
+    read_hosts does
+    """
+    hosts = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".hw-disk"):
+            continue
+        host = name[: -len(".hw-disk")]
+        error = check_host(host)
+        if error:
+            sys.stderr.write("ERROR: %s, skipping %s\n" % (error, name))
+        else:
+            hosts.append(host)
+    return hosts
+
+
+def replay_server(directory, host, ssh=True):
+    """
+    Build the server_object for $host from the captures in directory,
+    $host.hw-disk, $host.hinv and $host.omreport; the omreport capture
+    is missing or empty when the server could not be reached, the disks
+    are then taken from the Xymon test, as in live mode
+    """
+    start = monotonic()
+    captures = []
+    for test in ("hw-disk", "hinv"):
+        data = read_capture(os.path.join(directory, "%s.%s" % (host, test)))
+        if data is None:
+            raise OSError("no %s capture for %s in %s" % (test, host, directory))
+        # the same string query_xymon returns
+        captures.append(str([data]))
+    omreport = (
+        read_capture(os.path.join(directory, "%s.omreport" % host)) if ssh else None
+    )
+    # the lines, as pull_omreport returns them
+    omreport = omreport.splitlines(True) if omreport else None
+    this_server = server_object(captures[0], captures[1], omreport, host)
+    if timings_enabled or trace_file:
+        record_timing("replay_server", host, start)
+    return this_server
+
+
+def replay_chunk(directory, hosts, ssh=True):
+    """
+    Run in a worker process: replay the hosts, return a list of
+    (host, server_object or None, error) and the timings recorded
+    """
+    # the timings recorded before the fork belong to the parent
+    first = len(timings)
+    replayed = []
+    for host in hosts:
+        try:
+            this_server = replay_server(directory, host, ssh)
+            # the raw omreport is only needed for the parsing,
+            # do not pickle it back to the parent
+            if this_server.omreport:
+                this_server.omreport = []
+            replayed.append((host, this_server, None))
+        except Exception as error:
+            # a bad capture spoils only its host, not the whole replay
+            replayed.append((host, None, "%s: %s" % (type(error).__name__, error)))
+    return replayed, timings[first:]
+
+
+def replay_fleet(directory, hosts, ssh=True):
+    """
+    Build the server_object for all the hosts from the captures in
+    directory; parsing is CPU bound, the hosts are split in chunks
+    parsed by a pool of processes (one per CPU)
+    Return a list of server_object, the hosts which failed are skipped
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    workers = os.cpu_count() or 1
+    if workers == 1 or len(hosts) < 2:
+        # nothing to gain from a pool, only the pickling
+        results = [replay_chunk(directory, hosts, ssh)[0]]
+    else:
+        # a few chunks per worker, big enough to make the pickling worth it
+        size = max(1, min(64, len(hosts) // (workers * 4)))
+        chunks = [hosts[i : i + size] for i in range(0, len(hosts), size)]
+        results = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for replayed, chunk_timings in pool.map(
+                replay_chunk,
+                [directory] * len(chunks),
+                chunks,
+                [ssh] * len(chunks),
+            ):
+                results.append(replayed)
+                timings.extend(chunk_timings)
+    servers = []
+    for replayed in results:
+        for host, this_server, error in replayed:
+            if error:
+                sys.stderr.write("ERROR: %s: %s\n" % (host, error))
+            else:
+                servers.append(this_server)
+    return servers
+
+
+def archive_server(directory, host, hwdisk, hinv, omreport):
+    """
+    Save the raw captures of $host in directory, in the layout --from-dir
+    reads; omreport is None when the server could not be reached
+    """
+    import ast
+
+    os.makedirs(directory, exist_ok=True)
+    for test, data in (
+        # query_xymon returns the str() of the list of chunks received
+        ("hw-disk", b"".join(ast.literal_eval(hwdisk))),
+        ("hinv", b"".join(ast.literal_eval(hinv))),
+        ("omreport", b"".join(omreport or [])),
+    ):
+        # write and rename, a replay never sees a half written capture
+        filename = os.path.join(directory, "%s.%s" % (host, test))
+        with open(filename + ".tmp", "wb") as capture:
+            capture.write(data)
+        os.replace(filename + ".tmp", filename)
+
+
+def pending_disks(this_server, predictive=False):
+    """
+    Return the disks of this_server that need a replacement,
+    failed and, if requested, in predictive failure
+    """
+    disks = list(this_server.list_needreplacement)
+    if predictive:
+        disks += this_server.list_predictive
+    return disks
+
+
+@timed
+def aggregate_demand(servers, predictive=False):
+    """
+    Group the disks that need a replacement (failed and, if requested,
+    in predictive failure) of all the servers by cluster letter,
+    capacity and bus protocol; return a dict, for example:
+    {"A": {("600 GB", "SAS"): [(server, disk), (server, disk)]}}
+    """
+    demand = {}
+    for this_server in servers:
+        for disk in pending_disks(this_server, predictive):
+            key = (disk[7], disk[3][0])  # (capacity, bus protocol)
+            cluster = demand.setdefault(this_server.letter, {})
+            cluster.setdefault(key, []).append((this_server.server, disk))
+    return demand
+
+
+@timed
+def print_bulk_order(demand):
+    """
+    Print one consolidated email to request a delivery for each datacenter,
+    with the number of disks of each capacity and bus protocol
+    """
+    if not demand:
+        print("No disks need a replacement.\n")
+        return
+    for cluster in sorted(demand):
+        # sort by capacity and bus protocol
+        orders = sorted(demand[cluster].items())
+        open_section("Template: Email to request a delivery (Cluster %s)" % cluster)
+        print(
+            bcolors.FAIL
+            + "NOTE: Review this template before using it!\n"
+            + bcolors.ENDC
+            + "\n\n"
+        )
+        print(
+            bcolors.BOLD
+            + "Subject:"
+            + bcolors.ENDC
+            + " %s HDD to Cluster %s %s\n"
+            % (
+                ", ".join(
+                    "%sx %s %s" % (len(disks), size, bus)
+                    for (size, bus), disks in orders
+                ),
+                cluster,
+                datacenter_info[cluster][0],
+            )
+        )
+        print(bcolors.BOLD + "Body:" + bcolors.ENDC)
+        print("\nPlease ship the following disks as per subject please.\n")
+        for (size, bus), disks in orders:
+            print(
+                "=== %sx %s %s disks to Cluster %s %s ==="
+                % (len(disks), size, bus, cluster, datacenter_info[cluster][0])
+            )
+        print("""
+= Address
+%s
+
+= Contact details
+%s
+
+= Replacements""" % (datacenter_info[cluster][3], datacenter_info[cluster][4]))
+        for (size, bus), disks in orders:
+            for host, disk in disks:
+                print(
+                    "%s disk %s (Serial number: %s) %s %s"
+                    % (host, disk[0][0], disk[9][0], size, bus)
+                )
+        print(template_closing)
+        close_section()
+
+
+@timed
+def aggregate_visits(servers, predictive=False):
+    """
+    Group the disks that need a replacement by datacenter, the servers
+    of each datacenter ordered by rack and RU; return a dict, for example:
+    {"DC Location A": [(server_object, [disk, disk]), ...]}
+    The servers whose location is unknown are under None
+    """
+    from hw_inventory import natural
+
+    visits = {}
+    for this_server in servers:
+        disks = pending_disks(this_server, predictive)
+        if disks:
+            location = this_server.server_details.get("Location")
+            visits.setdefault(location, []).append((this_server, disks))
+    for location in visits:
+        visits[location].sort(
+            key=lambda x: (
+                natural(x[0].server_details.get("Rack")),
+                natural(x[0].server_details.get("RU")),
+                x[0].server,
+            )
+        )
+    return visits
+
+
+@timed
+def print_visits(visits):
+    """
+    Print one Smart Hands ticket for each datacenter with all the disks
+    to replace there, in the order of the racks and RUs
+    """
+    if not visits:
+        print("No disks need a replacement.\n")
+        return
+    for location in sorted(visits, key=lambda x: x or ""):
+        servers = visits[location]
+        if location is None:
+            print(
+                bcolors.FAIL
+                + "The location of these servers is unknown, no ticket printed "
+                + "(see hw_inventory.py): "
+                + bcolors.ENDC
+                + " ".join(this_server.server for this_server, disks in servers)
+                + "\n"
+            )
+            continue
+        sizes = {}
+        for this_server, disks in servers:
+            for disk in disks:
+                size = disk[7] + " " + disk[3][0]
+                sizes[size] = sizes.get(size, 0) + 1
+        open_section("Template: Smart hands ticket (%s)" % location)
+        print(
+            bcolors.FAIL
+            + "NOTE: Review this template before using it!\n"
+            + bcolors.ENDC
+        )
+        print("Hello %s,\n" % location)
+        print(
+            "This is a remote hands request for replacing %s HDD(s) in %s server(s). "
+            "Thanks for following these steps:\n" % (sum(sizes.values()), len(servers))
+        )
+        print(
+            "1. take %s from <...>"
+            % ", ".join("%sx %s" % (n, size) for size, n in sorted(sizes.items()))
+        )
+        print(
+            "2. for each server below, in this order, locate the server and "
+            "replace the disk(s) in the bay(s) listed"
+        )
+        print('3. label each broken disk as "FAILED"\n')
+        rack = None
+        for this_server, disks in servers:
+            details = this_server.server_details
+            if details.get("Rack") != rack:
+                rack = details.get("Rack")
+                print("Rack %s" % rack)
+            print(
+                "    RU %-6s %-10s Asset Tag: %s  Model: %s"
+                % (
+                    details.get("RU"),
+                    this_server.server,
+                    details.get("Asset tag"),
+                    details.get("Server model"),
+                )
+            )
+            for disk in disks:
+                print(
+                    "        bay %s (Serial number: %s) %s %s"
+                    % (disk[0][0].split(":")[-1], disk[9][0], disk[7], disk[3][0])
+                )
+        print(template_closing)
+        close_section()
+
+
+def record_inventory(filename, servers):
+    """
+    Record the details of the servers in the inventory database,
+    filename "" means the default database of hw_inventory.py
+    """
+    import hw_inventory
+
+    inventory = hw_inventory.open_inventory(filename or hw_inventory.default_db)
+    hw_inventory.update_inventory(inventory, servers)
+    inventory.close()
+
+
+def submit_tickets(filename, servers, predictive=False):
+    """
+    File the JIRA tickets for the disks of the servers not in an open
+    ticket (see tickets.py) and print them,
+    filename "" means the default index of tickets.py
+    """
+    import tickets
+
+    index = tickets.open_index(filename or tickets.default_db)
+    try:
+        filed = tickets.file_tickets(servers, predictive, index)
+    except OSError as error:
+        sys.exit("ERROR: tracker: %s\n" % error)
+    finally:
+        index.close()
+    tickets.print_filed(*filed)
+
+
+def fill_from_inventory(filename, servers):
+    """
+    Complete the details of the servers whose hinv is missing or
+    incomplete with the inventory database, if there is one
+    """
+    import hw_inventory
+
+    filename = filename or hw_inventory.default_db
+    if not os.path.exists(filename):
+        return
+    inventory = hw_inventory.open_inventory(filename)
+    hw_inventory.fill_details(inventory, servers)
+    inventory.close()
+
+
+def disk_states(this_server):
+    """
+    Return the state of each disk of this_server as a dict
+    {ID: (serial, state, progress, failure predicted)}
+    """
+    return dict(
+        (n[0][0], (n[9][0], n[2][0], n[6][0], n[5][0])) for n in this_server.list_all
+    )
+
+
+def disk_events(this_server, previous, current):
+    """
+    Compare the disk states (see disk_states) of this_server before and
+    after a refresh and return the list of events, each event is a dict:
+    rebuild_started, rebuild_progress, online (again), failed, predictive,
+    removed, unreachable and reachable (the server in SSH)
+
+    previous is None for the first poll, every disk which is not healthy
+    is reported then with "initial": True
+    """
+    now = int(time())
+    events = []
+
+    def event(name, disk_id, state, old_state=None):
+        serial, disk_state, progress, predicted = state
+        events.append(
+            {
+                "time": now,
+                "server": this_server.server,
+                "event": name,
+                "id": disk_id,
+                "serial": serial,
+                "state": disk_state,
+                "progress": progress,
+                "previous": old_state[1] if old_state else None,
+                "initial": previous is None,
+            }
+        )
+
+    for disk_id in sorted(current):
+        state = current[disk_id]
+        old = previous.get(disk_id) if previous else None
+        serial, disk_state, progress, predicted = state
+        old_state = old[1] if old else None
+        if disk_state != old_state:
+            if disk_state == "Rebuilding":
+                event("rebuild_started", disk_id, state, old)
+            elif disk_state == "Online" and old:
+                event("online", disk_id, state, old)
+            elif disk_state not in ("Online", "Ready"):
+                event("failed", disk_id, state, old)
+        elif disk_state == "Rebuilding" and progress != old[2]:
+            event("rebuild_progress", disk_id, state, old)
+        if (
+            predicted != "No"
+            and disk_state == "Online"
+            and (not old or old[3] == "No" or old_state != "Online")
+        ):
+            event("predictive", disk_id, state, old)
+    for disk_id in sorted(previous or {}):
+        if disk_id not in current:
+            event("removed", disk_id, previous[disk_id], previous[disk_id])
+    return events
+
+
+def server_events(this_server, previous, offline):
+    """
+    Return (events, states, offline) for this_server after a refresh;
+    previous and offline are the disk states and the SSH status
+    returned by the previous poll (None and False the first time)
+    """
+    events = []
+    host = this_server.server
+    if this_server.stop_with_error == "SSH":
+        # keep the last known states, a server offline has not
+        # lost its disks
+        if not offline:
+            events.append({"time": int(time()), "server": host, "event": "unreachable"})
+        return events, previous, True
+    if offline:
+        events.append({"time": int(time()), "server": host, "event": "reachable"})
+    current = disk_states(this_server)
+    events += disk_events(this_server, previous, current)
+    return events, current, False
+
+
+def watch(servers, interval):
+    """
+    Poll omreport on the servers every interval seconds and print the
+    changes of the disks as JSON lines (one event per line) on stdout,
+    until interrupted
+    """
+    import json
+    from concurrent.futures import ThreadPoolExecutor
+
+    # host: (disk states, offline) of the last poll
+    last_poll = dict((this_server.server, (None, False)) for this_server in servers)
+    with ThreadPoolExecutor(max_workers=fleet_workers) as pool:
+        first = True
+        try:
+            while True:
+                started = monotonic()
+                if not first:
+                    list(pool.map(lambda x: x.refresh_omreport(), servers))
+                first = False
+                for this_server in servers:
+                    events, states, offline = server_events(
+                        this_server, *last_poll[this_server.server]
+                    )
+                    last_poll[this_server.server] = (states, offline)
+                    for event in events:
+                        sys.stdout.write(json.dumps(event) + "\n")
+                sys.stdout.flush()
+                sleep(max(0, interval - (monotonic() - started)))
+        except KeyboardInterrupt:
+            pass
+
+
+def disk_status(this_server):
+    """
+    Return the publish_test status message of this_server: red with a
+    disk failed, yellow with a disk in predictive failure, rebuilding or
+    not in use, green otherwise; one line for each disk; clear when no
+    disk could be parsed, a missing server is not a healthy one
+    """
+    from datetime import datetime
+
+    if not this_server.list_all:
+        colour = "clear"
+    elif this_server.list_failed:
+        colour = "red"
+    elif (
+        this_server.list_predictive
+        or this_server.list_rebuilding
+        or this_server.list_notinuse
+    ):
+        colour = "yellow"
+    else:
+        colour = "green"
+    lines = [
+        "status %s.%s %s %s %s failed, %s predictive failure, %s rebuilding, "
+        "%s not in use"
+        % (
+            # Xymon wants the commas of the FQDNs
+            this_server.server.replace(".", ","),
+            publish_test,
+            colour,
+            datetime.now().strftime("%a %b %d %H:%M:%S %Y"),
+            len(this_server.list_failed),
+            len(this_server.list_predictive),
+            len(this_server.list_rebuilding),
+            len(this_server.list_notinuse),
+        )
+    ]
+    if not this_server.list_all:
+        lines.append(
+            "No data from Xymon or the server%s"
+            % (", cannot connect to the server" if this_server.stop_with_error else "")
+        )
+    elif this_server.disk_source == "Xymon":
+        lines.append("Cannot connect to the server, the disks come from hw-disk")
+    for key in this_server.hwdisk_list:
+        lines.append("%s: %s" % (key, this_server.hwdisk_data[key]))
+    for n in this_server.list_all:
+        if n in this_server.list_failed:
+            disk_colour, extra = "red", ""
+        elif n in this_server.list_rebuilding:
+            disk_colour, extra = "yellow", " (Progress: %s)" % n[6][0]
+        elif n in this_server.list_predictive:
+            disk_colour, extra = "yellow", ", Failure Predicted"
+        elif n in this_server.list_notinuse:
+            disk_colour, extra = "yellow", " (not in use)"
+        else:
+            disk_colour, extra = "green", ""
+        lines.append(
+            "&%s %s %s %s %s %s %s S/N %s%s"
+            % (
+                disk_colour,
+                n[0][0],
+                n[2][0],
+                n[3][0],
+                n[4][0],
+                n[7],
+                n[8][0],
+                n[9][0],
+                extra,
+            )
+        )
+    # an empty line would end the status inside a combo message
+    return "\n".join(line for line in lines if line.strip())
+
+
+def combo_messages(statuses):
+    """
+    Group the status messages in combo messages of at most
+    publish_batch statuses and publish_max_bytes
+    """
+    messages = []
+    batch = []
+    size = 0
+    for status in statuses:
+        if batch and (
+            len(batch) >= publish_batch or size + len(status) > publish_max_bytes
+        ):
+            messages.append("combo\n" + "\n\n".join(batch) + "\n")
+            batch = []
+            size = 0
+        batch.append(status)
+        size += len(status) + 2
+    if batch:
+        messages.append("combo\n" + "\n\n".join(batch) + "\n")
+    return messages
+
+
+def send_xymon(message):
+    """
+    Send message to Xymon on a new connection, return the answer
+    (nothing for status and combo)
+    """
+    import socket
+
+    start = monotonic()
+    sock = socket.create_connection((xymon_server, xymon_port), timeout=30)
+    try:
+        sock.sendall(message.encode("utf-8", "replace"))
+        sock.shutdown(socket.SHUT_WR)
+        data = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data.append(chunk)
+    finally:
+        sock.close()
+    if timings_enabled or trace_file:
+        record_timing("send_xymon", xymon_server, start, len(message))
+    return b"".join(data)
+
+
+def publish_status(servers):
+    """
+    Send the state of the disks of the servers to Xymon as the
+    publish_test status, many servers in each combo message (one
+    connection for each); return the number of servers published
+    """
+    published = 0
+    messages = combo_messages(disk_status(s) for s in servers)
+    for message in messages:
+        count = message.count("\n\nstatus ") + 1
+        try:
+            send_xymon(message)
+        except OSError as error:
+            sys.stderr.write(
+                "ERROR: Xymon %s:%s: %s, %s servers not published\n"
+                % (xymon_server, xymon_port, error, count)
+            )
+            continue
+        published += count
+    print(
+        "%s of %s servers published to Xymon (%s) in %s messages\n"
+        % (published, len(servers), publish_test, len(messages))
+    )
+    return published
+
+
+def record_history(filename, servers):
+    """
+    Append the disks of the servers to the history database,
+    filename "" means the default database of disk_history.py
+    """
+    import disk_history
+
+    history = disk_history.open_history(filename or disk_history.default_db)
+    disk_history.record_snapshot(history, servers)
+    history.close()
+
+
+def parse_capacity(astring):
+    """
+    Parse a capacity string with units, for example "1,862.50 GB",
+    and return the size in bytes for both the binary (GiB) and the
+    decimal (GB) interpretation of the unit as a tuple (binary, decimal)
+    Return None if the string cannot be parsed
+    """
+    match = re.match(
+        r"^\s*([\d,]+(?:\.\d+)?)\s*([KMGTP]?)i?B\s*$", astring, re.IGNORECASE
+    )
+    if not match:
+        return None
+    value = float(match.group(1).replace(",", ""))
+    exponent = " KMGTP".index(match.group(2).upper() or " ")
+    return (int(value * 1024**exponent), int(value * 1000**exponent))
+
+
+def disk_size_label(size_gb):
+    """
+    Return the label of a marketed size expressed in (decimal) GB, for example:
+    450 to "450 GB", 1000 to "1 TB", 1920 to "1.92 TB"
+    """
+    if size_gb < 1000:
+        return "%s GB" % int(round(size_gb))
+    # format the TB value without trailing zeros (1.20 -> 1.2, 2.00 -> 2)
+    return "%s TB" % ("%.2f" % (size_gb / 1000.0)).rstrip("0").rstrip(".")
+
+
+@lru_cache(maxsize=None)
+def normalise_capacity(astring):
+    """
+    Map a raw capacity string, for example "558.38 GB", to the nearest
+    marketed disk size, for example "600 GB"
+
+    omreport shows binary units (GiB) labelled as GB while the disks are
+    sold in decimal units, therefore both interpretations are tested
+    against disksize_marketed and the closest one within
+    disksize_tolerance wins; if nothing is close enough return the
+    decimal size rounded, so that a disk is never left without a size
+
+    The result is memoised for each unique raw string, a fleet report
+    costs one computation for each distinct disk model
+    """
+    sizes = parse_capacity(astring)
+    if sizes is None:
+        return ""
+    best = None  # (relative distance, marketed size)
+    for size_bytes in sizes:
+        for marketed in disksize_marketed:
+            distance = abs(size_bytes - marketed * 10**9) / (marketed * 10**9)
+            if best is None or distance < best[0]:
+                best = (distance, marketed)
+    if best[0] <= disksize_tolerance:
+        return disk_size_label(best[1])
+    # unknown size, use the decimal interpretation
+    return disk_size_label(sizes[1] / 10**9)
+
+
 def hr_disk_size(alist):
     """
     Convert the disk size to human readable format, for example:
     "558.38 GB" to "600 GB"
     """
-    # This dictionary contains the conversion
-    disksize_info = {
-        "418.63 GB": "450 GB",
-        "558.38 GB": "600 GB",
-        "931.00 GB": "1 TB",
-        "1,862.50 GB": "2 TB",
-        "2,794.00 GB": "3 TB",
-        "3,725.50 GB": "4 TB",
-    }
     # we need to do a bit of error check as alist could be empty
     astring = ""  # astring is empty
     if alist:  # the list is not empty
         astring = alist[0]  # extract the string from the list
-    # check if astring is contained in the dict
-    if astring in disksize_info:
-        return disksize_info[astring]
-    else:
-        return ""
+    return normalise_capacity(astring)
 
 
 def open_section(string):
@@ -921,41 +2208,175 @@ def close_section():
     print(bcolors.BOLD + "-" * 80 + bcolors.ENDC + "\n\n")
 
 
-if __name__ == "__main__":
-    # execute only if run as a script
+def print_report(this_server, serial_yes=False, compact_yes=False):
+    """
+    Print the report for this_server as requested by the user
+    with the arguments -s/-c or the full result
+    """
+    if compact_yes:
+        this_server.print_compact()
+        return
+    # print the server location
+    this_server.print_location()
+    # decide if we are going to just print the serial numbers
+    # or the full result
+    if serial_yes:
+        this_server.print_serialn()
+    else:
+        this_server.print_result()
+
+
+def main():
+    """
+    Run the script for one server or for a fleet
+    """
+    global server, letter, stop_with_error, template_yes
+    global timings_enabled, trace_file, archive_dir
     # set this variable if we need to stop the execution
     stop_with_error = ""
     # check the args and assign the variable server that contains $server
-    server, template_yes, serial_yes, progress_yes, compact_yes = arguments()
+    (
+        server,
+        template_yes,
+        serial_yes,
+        progress_yes,
+        compact_yes,
+        fleet_file,
+        order_yes,
+        predictive_yes,
+        history_file,
+        timings_yes,
+        trace_yes,
+        watch_yes,
+        watch_interval,
+        xymon_only,
+        visit_yes,
+        inventory_file,
+        from_dir,
+        archive_dir,
+        tickets_file,
+        agents_yes,
+        publish_yes,
+    ) = arguments()
+    # the command line wins over the environment variables
+    timings_enabled = timings_enabled or timings_yes
+    trace_file = trace_yes or trace_file
+    if timings_enabled or trace_file:
+        import atexit
+
+        atexit.register(report_timings)
+    if watch_yes:
+        # headless watch mode, stdout is only for the events
+        hosts = read_hosts(fleet_file) if fleet_file else [server]
+        watch(collect_fleet(hosts), watch_interval)
+        sys.exit()  # exit with 0
+    if fleet_file or (from_dir and not server):
+        # fleet mode: collect all the servers in one go
+        if from_dir:
+            # offline: parse the captures instead
+            hosts = read_hosts(fleet_file) if fleet_file else capture_hosts(from_dir)
+            print(
+                "Replaying disks information for %s servers from %s\n"
+                % (len(hosts), from_dir)
+            )
+            servers = replay_fleet(from_dir, hosts, not xymon_only)
+        elif agents_yes:
+            # each cluster collected in its datacenter
+            import fleet_agent
+
+            try:
+                agents = fleet_agent.get_agents()
+            except ValueError as error:
+                sys.exit("ERROR: FLEET_AGENTS: %s" % error)
+            hosts = read_hosts(fleet_file)
+            print(
+                "Gathering disks information for %s servers through the agents\n"
+                % len(hosts)
+            )
+            servers = fleet_agent.sweep(hosts, not xymon_only, agents)
+        else:
+            hosts = read_hosts(fleet_file)
+            print("Gathering disks information for %s servers\n" % len(hosts))
+            servers = collect_fleet(hosts, not xymon_only)
+        if history_file is not None:
+            record_history(history_file, servers)
+        if inventory_file is not None:
+            record_inventory(inventory_file, servers)
+        if tickets_file is not None:
+            submit_tickets(tickets_file, servers, predictive_yes)
+        if publish_yes:
+            publish_status(servers)
+        if visit_yes:
+            # print the consolidated Smart Hands tickets,
+            # one for each datacenter visit
+            fill_from_inventory(inventory_file, servers)
+            print_visits(aggregate_visits(servers, predictive_yes))
+            sys.exit()  # exit with 0
+        if order_yes:
+            # print the consolidated delivery requests,
+            # one for each datacenter
+            print_bulk_order(aggregate_demand(servers, predictive_yes))
+            sys.exit()  # exit with 0
+        # batch mode: print the report of each server as if the script
+        # was run for each of them, in the same interpreter
+        for this_server in servers:
+            print(
+                "Disks information for "
+                + bcolors.BOLD
+                + this_server.server
+                + bcolors.ENDC
+                + "\n"
+            )
+            get_cluster_info(this_server.server)
+            try:
+                print_report(this_server, serial_yes, compact_yes)
+            except Exception as error:
+                # an incomplete hinv, the other servers are still reported
+                sys.stderr.write(
+                    "ERROR: %s: %s: %s\n"
+                    % (this_server.server, type(error).__name__, error)
+                )
+        sys.exit()  # exit with 0
     # get the cluster information for server and
     # print a header with some initial information
     print(
         "Gathering disks information for " + bcolors.BOLD + server + bcolors.ENDC + "\n"
     )
     letter = get_cluster_info(server)
-    # query Xymon for $server.hw-disk and store the raw result in result_hwdisk
-    result_hwdisk = query_xymon(server, "hw-disk")
-    # query Xymon for $server.hinv and store the raw result in result_hinv
-    result_hinv = query_xymon(server, "hinv")
-    # connect to server, see the comment above about not using paramiko
-    # pull the result of omreport storage pdisk controller=0
-    omreport = pull_omreport(server)
-    this_server = server_object(result_hwdisk, result_hinv, omreport)
-    # if option(s) -p/-c have been selected
+    if from_dir:
+        # offline: parse the captures of server instead
+        try:
+            this_server = replay_server(from_dir, server, not xymon_only)
+        except OSError as error:
+            sys.exit("ERROR: %s\n" % error)
+    else:
+        # query Xymon for $server.hw-disk and store the raw result in result_hwdisk
+        result_hwdisk = query_xymon(server, "hw-disk")
+        # query Xymon for $server.hinv and store the raw result in result_hinv
+        result_hinv = query_xymon(server, "hinv")
+        # connect to server, see the comment above about not using paramiko
+        # pull the result of omreport storage pdisk controller=0
+        omreport = None if xymon_only else pull_omreport(server, get_rack(result_hinv))
+        if archive_dir:
+            archive_server(archive_dir, server, result_hwdisk, result_hinv, omreport)
+        this_server = server_object(result_hwdisk, result_hinv, omreport)
+    if history_file is not None:
+        record_history(history_file, [this_server])
+    if inventory_file is not None:
+        record_inventory(inventory_file, [this_server])
+    if tickets_file is not None:
+        submit_tickets(tickets_file, [this_server], predictive_yes)
+    if publish_yes:
+        publish_status([this_server])
+    # if option -p has been selected
     # call the appropriate function and then exit
     if progress_yes:
         this_server.print_progress()
         sys.exit()  # exit with 0
-    elif compact_yes:
-        this_server.print_compact()
-        sys.exit()  # exit with 0
-    # if not, continue with the normal logic
-    # print the server location
-    this_server.print_location()
-    # decide if we are going to just print the serial numbers
-    # or the full result
-    if serial_yes:
-        this_server.print_serialn()
-    else:
-        this_server.print_result()
+    print_report(this_server, serial_yes, compact_yes)
     # That's all folks!
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
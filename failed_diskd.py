@@ -0,0 +1,409 @@
+#!/usr/bin/python3
+
+"""
+Daemon mode for failed_disk.py
+
+The daemon keeps in memory the parsed information of the servers
+(server_object) and answers the requests on a local UNIX socket, so the
+monitoring hooks and the ticket bots asking again and again about the
+same servers do not pay the interpreter start-up, the Xymon queries and
+the SSH connection every time
+
+- the SSH connections are shared and kept open (ControlMaster, see
+  ssh_runner.py) between the refreshes of the same server
+- a server is refreshed when the information in memory is older than
+  --ttl seconds, the servers listed with --hosts are refreshed in the
+  background every --refresh seconds
+
+The protocol is one request per connection, a line "command server",
+the answer is the same report printed by failed_disk.py; progress
+sends one JSON line per refresh until the client disconnects, watch
+sends the changes of the disks (failed_disk.py --watch) as JSON lines;
+all the watchers of a server share the same poller
+
+Usage:
+failed_diskd.py serve [--socket PATH] [--hosts FILE] [--refresh S] [--ttl S]
+failed_diskd.py compact|serial|report|templates|progress|watch|refresh SERVER
+"""
+
+import argparse
+import io
+import json
+import os
+import queue
+import select
+import socketserver
+import sys
+import threading
+import time
+from contextlib import redirect_stdout
+
+import failed_disk
+
+default_socket = os.path.expanduser("~/.failed_disk/daemon.sock")
+commands = ["compact", "serial", "report", "templates", "progress", "watch", "refresh"]
+# the SSH connections are shared by ssh_runner, keep the connection
+# to each server open between the refreshes
+ssh_persist = ["-o", "ControlPersist=15m"]
+
+
+class snapshot_cache:
+    """
+    The server_object of each server with the time it was collected;
+    only one refresh at a time for each server, the requests arriving
+    during a refresh wait for it and share the result
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.servers = {}  # host: (time collected, server_object)
+        self.locks = {}  # host: lock held during the refresh
+        self.lock = threading.Lock()
+
+    def host_lock(self, host):
+        with self.lock:
+            return self.locks.setdefault(host, threading.Lock())
+
+    def get(self, host, max_age=None):
+        """
+        Return the server_object of host, refresh it if older than max_age
+        """
+        if max_age is None:
+            max_age = self.ttl
+        with self.host_lock(host):
+            collected, this_server = self.servers.get(host, (0, None))
+            if time.time() - collected > max_age:
+                this_server = failed_disk.collect_server(host)
+                self.servers[host] = (time.time(), this_server)
+            return this_server
+
+    def refresh(self, hosts):
+        """
+        Refresh all the hosts, fleet_workers at a time; the failures are
+        written on stderr, the last good snapshot of the host is kept
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        with ThreadPoolExecutor(max_workers=failed_disk.fleet_workers) as pool:
+            futures = dict((pool.submit(self.get, host, 0), host) for host in hosts)
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as error:
+                    sys.stderr.write(
+                        "ERROR: refresh %s: %s: %s\n"
+                        % (futures[future], type(error).__name__, error)
+                    )
+
+
+class host_poller:
+    """
+    Poll omreport on one server every interval seconds and send the
+    events (see failed_disk.server_events) to all the subscribers;
+    the poller runs only while somebody is subscribed
+    """
+
+    def __init__(self, host, interval):
+        self.host = host
+        self.interval = interval
+        self.subscribers = set()  # a queue.Queue for each subscriber
+        self.this_server = None
+        self.last_poll = (None, False)  # (disk states, offline)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        """
+        Return a queue where the events will arrive, starting with the
+        disks which are not healthy right now
+        """
+        events = queue.Queue()
+        with self.lock:
+            self.subscribers.add(events)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            elif self.last_poll[0] is not None:
+                # the poller is already running, catch up
+                for event in failed_disk.disk_events(
+                    self.this_server, None, self.last_poll[0]
+                ):
+                    events.put(event)
+        return events
+
+    def unsubscribe(self, events):
+        with self.lock:
+            self.subscribers.discard(events)
+
+    def run(self):
+        try:
+            self.poll()
+        finally:
+            # if the loop dies the next subscriber starts a new poller
+            with self.lock:
+                if self.thread is threading.current_thread():
+                    self.thread = None
+
+    def poll(self):
+        while True:
+            started = time.time()
+            try:
+                if self.this_server is None:
+                    self.this_server = failed_disk.collect_server(self.host)
+                else:
+                    self.this_server.refresh_omreport()
+                events, states, offline = failed_disk.server_events(
+                    self.this_server, *self.last_poll
+                )
+            except Exception as error:
+                # cannot reach the server, or the data is garbage: keep
+                # polling, the subscribers see the error
+                events = [{"server": self.host, "event": "error", "error": str(error)}]
+            else:
+                self.last_poll = (states, offline)
+            with self.lock:
+                for event in events:
+                    for subscriber in self.subscribers:
+                        subscriber.put(event)
+                if not self.subscribers:
+                    # nobody is listening, stop and start afresh next time
+                    self.thread = None
+                    self.this_server = None
+                    self.last_poll = (None, False)
+                    return
+            time.sleep(max(0, self.interval - (time.time() - started)))
+
+
+class poller_pool:
+    """
+    One host_poller for each server
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.pollers = {}
+        self.lock = threading.Lock()
+
+    def get(self, host):
+        with self.lock:
+            if host not in self.pollers:
+                self.pollers[host] = host_poller(host, self.interval)
+            return self.pollers[host]
+
+
+# print_* write on stdout, render one report at a time
+render_lock = threading.Lock()
+
+
+def render(this_server, command):
+    """
+    Return the report of this_server as failed_disk.py prints it
+    """
+    output = io.StringIO()
+    with render_lock, redirect_stdout(output):
+        failed_disk.template_yes = command == "templates"
+        try:
+            failed_disk.get_cluster_info(this_server.server)
+            failed_disk.print_report(
+                this_server, command == "serial", command == "compact"
+            )
+        finally:
+            failed_disk.template_yes = False
+    return output.getvalue()
+
+
+def rebuilding(this_server):
+    """
+    Return the progress of the disks rebuilding as a dict
+    """
+    return {
+        "server": this_server.server,
+        "time": int(time.time()),
+        "offline": this_server.stop_with_error == "SSH",
+        "rebuilding": [
+            {"id": n[0][0], "serial": n[9][0], "progress": n[6][0]}
+            for n in this_server.list_rebuilding
+        ],
+    }
+
+
+class request_handler(socketserver.StreamRequestHandler):
+    """
+    Handle one request: a line "command server"
+    """
+
+    def handle(self):
+        try:
+            command, host = self.rfile.readline().decode().split()
+        except ValueError:
+            self.reply("ERROR: the request is 'command server'\n")
+            return
+        error = failed_disk.check_host(host)
+        if command not in commands:
+            error = "Unknown command %s" % command
+        if error:
+            self.reply("ERROR: %s\n" % error)
+            return
+        cache = self.server.cache
+        try:
+            if command == "refresh":
+                cache.get(host, 0)
+                self.reply("OK\n")
+            elif command == "watch":
+                self.watch(host)
+            elif command == "progress":
+                # one JSON line each refresh until the client goes away
+                while True:
+                    this_server = cache.get(host, self.server.progress_rate)
+                    self.reply(json.dumps(rebuilding(this_server)) + "\n")
+                    time.sleep(self.server.progress_rate)
+            else:
+                self.reply(render(cache.get(host), command))
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client has gone away
+        except Exception as error:
+            # cannot reach Xymon, the data is garbage or the hinv incomplete
+            self.reply("ERROR: %s: %s: %s\n" % (host, type(error).__name__, error))
+
+    def watch(self, host):
+        """
+        Send the events of host as JSON lines until the client goes away
+        """
+        poller = self.server.pollers.get(host)
+        events = poller.subscribe()
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=1)
+                except queue.Empty:
+                    # nothing to send, check if the client has gone away
+                    readable = select.select([self.connection], [], [], 0)[0]
+                    if readable and not self.connection.recv(1):
+                        return
+                    continue
+                self.reply(json.dumps(event) + "\n")
+        finally:
+            poller.unsubscribe(events)
+
+    def reply(self, string):
+        self.wfile.write(string.encode())
+        self.wfile.flush()
+
+
+class daemon_server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def background_refresh(cache, hosts, refresh):
+    """
+    Refresh the hosts every refresh seconds, forever
+    """
+    while True:
+        started = time.time()
+        cache.refresh(hosts)
+        time.sleep(max(0, refresh - (time.time() - started)))
+
+
+def serve(socket_path, hosts, refresh, ttl, progress_rate):
+    """
+    Run the daemon until it is killed
+    """
+    failed_disk.ssh_options = failed_disk.ssh_options + ssh_persist
+    directory = os.path.dirname(socket_path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = daemon_server(socket_path, request_handler)
+    # only this user can talk to the daemon
+    os.chmod(socket_path, 0o600)
+    server.cache = snapshot_cache(ttl)
+    server.progress_rate = progress_rate
+    server.pollers = poller_pool(progress_rate)
+    if hosts:
+        threading.Thread(
+            target=background_refresh, args=(server.cache, hosts, refresh), daemon=True
+        ).start()
+    print("Listening on %s" % socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+def client(socket_path, command, host):
+    """
+    Send the request to the daemon and print the answer as it arrives
+    """
+    import socket
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError as error:
+        sys.exit("ERROR: cannot connect to the daemon on %s: %s" % (socket_path, error))
+    sock.sendall(("%s %s\n" % (command, host)).encode())
+    try:
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            sys.stdout.write(chunk.decode())
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    sock.close()
+
+
+def arguments():
+    """
+    Parse arguments and return help message if the script is invoked with -h
+    """
+    parser = argparse.ArgumentParser(
+        description="Daemon mode for failed_disk.py and its client",
+        prog="failed_diskd",
+    )
+    parser.add_argument("command", choices=["serve"] + commands)
+    parser.add_argument("server", nargs="?", help="The server hostname, ex: prx11a")
+    parser.add_argument("--socket", default=default_socket, help="default %(default)s")
+    parser.add_argument(
+        "--hosts",
+        metavar="FILE",
+        help="(serve) refresh the servers in FILE in the background",
+    )
+    parser.add_argument(
+        "--refresh",
+        type=int,
+        default=300,
+        help="(serve) background refresh every REFRESH seconds (default %(default)s)",
+    )
+    parser.add_argument(
+        "--ttl",
+        type=int,
+        default=60,
+        help="(serve) refresh a server older than TTL seconds (default %(default)s)",
+    )
+    parser.add_argument(
+        "--progress-rate",
+        type=int,
+        default=60,
+        help="(serve) seconds between the progress updates and "
+        "the watch polls (default %(default)s)",
+    )
+    args = parser.parse_args()
+    if args.command != "serve" and not args.server:
+        sys.exit("ERROR: %s needs a server\n" % args.command)
+    return args
+
+
+if __name__ == "__main__":
+    args = arguments()
+    if args.command == "serve":
+        hosts = failed_disk.read_hosts(args.hosts) if args.hosts else []
+        serve(args.socket, hosts, args.refresh, args.ttl, args.progress_rate)
+    else:
+        client(args.socket, args.command, args.server)
+    # That's all folks!
@@ -0,0 +1,328 @@
+#!/usr/bin/python3
+
+"""
+Sweep the fleet from agents close to each datacenter
+
+Sweeping all the servers from one admin box pays the WAN round trip
+on every Xymon query and every SSH connection. An agent runs in each
+site (fleet_agent.py serve on a box of the datacenter), collects and
+parses its servers there (failed_disk.collect_server) and sends back
+only the parsed information (server_object.to_dict), compressed, over
+one connection. failed_disk.py --fleet FILE --agents is the
+coordinator: it splits the servers by cluster letter, sends each share
+to the agent of the cluster at the same time and runs the usual
+reports (--order, --visit, --history, --tickets, ...) on the merged
+servers. The servers of a cluster without an agent, or whose agent
+cannot be reached, are collected by the coordinator as usual
+
+The protocol is one request per connection, a JSON line
+{"command": "sweep", "hosts": [...], "ssh": true, "token": "..."}
+(or "ping"); the answer is a zlib stream of JSON lines, one
+{"server": {...}} or {"host": ..., "error": ...} for each server in
+the order they are collected and a last {"done": N, "seconds": S}
+
+Usage:
+fleet_agent.py serve [--listen HOST:PORT] [--workers N]
+fleet_agent.py ping
+failed_disk.py --fleet FILE --agents
+"""
+
+import argparse
+import hmac
+import json
+import os
+import socketserver
+import sys
+import time
+import zlib
+
+import failed_disk
+
+# the agent of each cluster (the datacenter_info keys), host:port;
+# FLEET_AGENTS="A=host:port,B=host:port" overrides it #CHANGEME
+agents = {
+    "A": "Cluster A agent:11985",
+    "B": "Cluster B agent:11985",
+    "C": "Cluster C agent:11985",
+}
+agent_port = 11985
+# shared by the coordinator and the agents, the agents refuse the
+# requests without it when it is set
+agent_token = os.environ.get("FLEET_AGENT_TOKEN", "")
+# seconds to connect to an agent, seconds for a whole share
+connect_timeout = 10
+sweep_deadline = 3600
+
+
+def parse_agents(string):
+    """
+    Parse "A=host:port,B=host" into {"A": "host:port", "B": "host:11985"}
+    """
+    result = {}
+    for item in string.split(","):
+        if not item.strip():
+            continue
+        letter, sep, address = item.partition("=")
+        if not sep or not address:
+            raise ValueError("expected LETTER=HOST:PORT, not %s" % item)
+        if ":" not in address:
+            address = "%s:%s" % (address, agent_port)
+        result[letter.strip().upper()] = address.strip()
+    return result
+
+
+def get_agents():
+    """
+    Return the agents, from FLEET_AGENTS if set
+    """
+    if os.environ.get("FLEET_AGENTS"):
+        return parse_agents(os.environ["FLEET_AGENTS"])
+    return agents
+
+
+def split_address(address):
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
+class agent_handler(socketserver.StreamRequestHandler):
+    """
+    Handle one request: a JSON line, see the protocol above
+    """
+
+    def handle(self):
+        self.compressor = zlib.compressobj()
+        try:
+            request = json.loads(self.rfile.readline())
+            command = request["command"]
+        except (ValueError, KeyError, TypeError):
+            self.send({"error": "the request is a JSON line with a command"}, True)
+            return
+        if agent_token and not hmac.compare_digest(
+            str(request.get("token", "")), agent_token
+        ):
+            self.send({"error": "wrong token"}, True)
+            return
+        try:
+            if command == "ping":
+                self.send({"done": 0, "seconds": 0.0, "pid": os.getpid()}, True)
+            elif command == "sweep":
+                self.sweep(request.get("hosts", []), request.get("ssh", True))
+            else:
+                self.send({"error": "unknown command %s" % command}, True)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the coordinator has gone away
+
+    def sweep(self, hosts, ssh):
+        """
+        Collect the hosts, fleet_workers at a time, and send each server
+        as soon as it is parsed
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=failed_disk.fleet_workers) as pool:
+            futures = dict(
+                (pool.submit(failed_disk.collect_server, host, ssh), host)
+                for host in hosts
+            )
+            for future in as_completed(futures):
+                try:
+                    self.send({"server": future.result().to_dict()})
+                except (OSError, IndexError) as error:
+                    # cannot reach Xymon or the data is garbage
+                    self.send({"host": futures[future], "error": str(error)})
+        self.send({"done": len(hosts), "seconds": time.monotonic() - start}, True)
+
+    def send(self, message, last=False):
+        data = self.compressor.compress((json.dumps(message) + "\n").encode())
+        if last:
+            data += self.compressor.flush()
+        if data:
+            self.wfile.write(data)
+
+
+class agent_server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def make_server(address):
+    """
+    Return the agent server listening on address (host:port, port 0
+    for any free port), serve_forever runs it
+    """
+    return agent_server(split_address(address), agent_handler)
+
+
+def request(address, message, deadline=sweep_deadline):
+    """
+    Send message to the agent on address and yield the answers
+    """
+    import socket
+
+    sock = socket.create_connection(split_address(address), timeout=connect_timeout)
+    try:
+        sock.settimeout(deadline)
+        sock.sendall((json.dumps(dict(message, token=agent_token)) + "\n").encode())
+        sock.shutdown(socket.SHUT_WR)
+        decompressor = zlib.decompressobj()
+        pending = b""
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            pending += decompressor.decompress(chunk)
+            lines = pending.split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                yield json.loads(line)
+        if not decompressor.eof:
+            raise OSError("the answer is truncated")
+    finally:
+        sock.close()
+
+
+def sweep_share(address, hosts, ssh=True):
+    """
+    Send hosts to the agent on address; return (the server_objects by
+    host, the hosts not collected); the hosts the agent could not
+    collect are reported on stderr as collect_fleet does
+    """
+    servers = {}
+    errors = set()
+    start = time.monotonic()
+    for answer in request(address, {"command": "sweep", "hosts": hosts, "ssh": ssh}):
+        if "server" in answer:
+            this_server = failed_disk.server_object(
+                None, None, None, parsed=answer["server"]
+            )
+            servers[this_server.server] = this_server
+        elif "host" in answer:
+            sys.stderr.write("ERROR: %s: %s\n" % (answer["host"], answer["error"]))
+            errors.add(answer["host"])
+        elif "error" in answer:
+            raise OSError(answer["error"])
+        elif "done" in answer:
+            if failed_disk.timings_enabled or failed_disk.trace_file:
+                failed_disk.record_timing("fleet_agent.share", address, start)
+            return servers, [h for h in hosts if h not in servers and h not in errors]
+    raise OSError("agent %s: the answer is truncated" % address)
+
+
+def sweep(hosts, ssh=True, agents=None):
+    """
+    Collect the hosts through the agent of their cluster, all the
+    clusters at the same time; the hosts without an agent, or whose
+    agent fails, are collected here with collect_fleet
+    Return the server_objects in the order of hosts, as collect_fleet
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if agents is None:
+        agents = get_agents()
+    shares = {}
+    for host in hosts:
+        shares.setdefault(failed_disk.get_cluster_letter(host), []).append(host)
+    local = []
+    collected = {}
+    with ThreadPoolExecutor(max_workers=max(len(shares), 1)) as pool:
+        futures = []
+        for letter, share in sorted(shares.items()):
+            if letter in agents:
+                futures.append(
+                    (
+                        agents[letter],
+                        share,
+                        pool.submit(sweep_share, agents[letter], share, ssh),
+                    )
+                )
+            else:
+                local += share
+        if local:
+            # collect meanwhile the hosts without an agent
+            for this_server in failed_disk.collect_fleet(local, ssh):
+                collected[this_server.server] = this_server
+        for address, share, future in futures:
+            try:
+                servers, missing = future.result()
+            except (OSError, ValueError, zlib.error) as error:
+                sys.stderr.write(
+                    "ERROR: agent %s: %s, collecting its %s servers from here\n"
+                    % (address, error, len(share))
+                )
+                servers, missing = {}, share
+            collected.update(servers)
+            if missing:
+                for this_server in failed_disk.collect_fleet(missing, ssh):
+                    collected[this_server.server] = this_server
+    return [collected[host] for host in hosts if host in collected]
+
+
+def ping(agents):
+    """
+    Check the agents, return the number which do not answer
+    """
+    failures = 0
+    for letter, address in sorted(agents.items()):
+        start = time.monotonic()
+        try:
+            answers = list(request(address, {"command": "ping"}, connect_timeout))
+            if "error" in answers[-1]:
+                raise OSError(answers[-1]["error"])
+            print(
+                "%s %-30s ok, %.0f ms"
+                % (letter, address, 1000 * (time.monotonic() - start))
+            )
+        except (OSError, ValueError, IndexError, zlib.error) as error:
+            print("%s %-30s ERROR: %s" % (letter, address, error))
+            failures += 1
+    return failures
+
+
+def arguments():
+    """
+    Parse arguments and return help message if the script is invoked with -h
+    """
+    parser = argparse.ArgumentParser(
+        description="Agents collecting the servers close to each datacenter",
+        prog="fleet_agent",
+    )
+    parser.add_argument("command", choices=["serve", "ping"])
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=failed_disk.fleet_workers,
+        help="(serve) servers collected at the same time (default %(default)s)",
+    )
+    parser.add_argument(
+        "--listen",
+        default="127.0.0.1:%s" % agent_port,
+        help="(serve) HOST:PORT, the address on the datacenter network "
+        "(default %(default)s)",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = arguments()
+    if args.command == "ping":
+        try:
+            sys.exit(1 if ping(get_agents()) else 0)
+        except ValueError as error:
+            sys.exit("ERROR: FLEET_AGENTS: %s" % error)
+    failed_disk.fleet_workers = args.workers
+    try:
+        server = make_server(args.listen)
+    except (OSError, ValueError) as error:
+        sys.exit("ERROR: cannot listen on %s: %s" % (args.listen, error))
+    if not agent_token and not args.listen.startswith("127."):
+        sys.stderr.write("WARNING: FLEET_AGENT_TOKEN is not set, anybody can sweep\n")
+    print("Listening on %s:%s" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    # That's all folks!
@@ -4,11 +4,42 @@ Provide a wrapper for creating/printing info/deleting nodes
 """
 
 import argparse
-import subprocess
+import json
+import os
+import shlex
 import sys
 import time
 import re
 
+import placement
+import ssh_runner
+
+# seconds for a hammer-cli or a shell command to complete
+command_deadline = 600
+# hosts fetched with each hammer host list, the pages are printed as
+# they arrive and only two of them are in memory at the same time
+list_per_page = 100
+# columns of --list when --fields is not given
+list_fields = ["Id", "Name", "Operating System", "Host Group", "IP", "MAC"]
+# the oVirt cluster and storage domain used when the placement is fixed
+# or there is no utilisation to choose from (see placement.py) #CHANGEME
+default_cluster = "aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa"
+default_storage = "aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa"
+# the steps of --create, --delete and --rebuild done on each node,
+# --resume skips them
+journal_file = os.path.expanduser("~/.hammer-cli-wrapper/journal.jsonl")
+# seconds for a node to start building before node_add
+build_wait = 300
+# --info: hammer host info run at the same time, seconds the answers
+# are cached, nodes looked up with each hammer host list, columns of
+# --table when --fields is not given (those of hammer host list, the
+# table is then filled without hammer host info)
+info_parallel = 8
+info_ttl = 300
+info_cache = os.path.expanduser("~/.hammer-cli-wrapper/info")
+info_batch = 100
+info_fields = ["Name", "IP", "Operating System", "Host Group", "MAC"]
+
 
 def arguments():
     """
@@ -25,53 +56,180 @@ def arguments():
     )
     # NOTE: hostname NOT fqdn; memory and disk are expressed in GB
     # Example: --create testvm 192.168.1.200 1 2 10
+    parser.add_argument(
+        "--manifest",
+        metavar="FILE",
+        help="create the nodes in FILE, one per line: hostname IP vCPU memory disk",
+    )
+    parser.add_argument(
+        "--placement",
+        choices=placement.policies + ["fixed"],
+        default=placement.policies[0],
+        help="with --create or --manifest, how the cluster and the storage "
+        "domain are chosen (default %(default)s)",
+    )
+    parser.add_argument(
+        "--capacity",
+        metavar="FILE",
+        help="with --create or --manifest, the utilisation of the clusters "
+        "and storage domains as JSON (see placement.py)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="with --create, --manifest, --delete or --rebuild, continue the "
+        "last run on the node(s), skipping the steps already done",
+    )
+    parser.add_argument(
+        "--pending",
+        action="store_true",
+        help="print the operations not completed, see --resume",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="with --create or --manifest, only print where the nodes would go",
+    )
     parser.add_argument("--delete", nargs=1, help="delete a node, requires node FQDN")
     parser.add_argument(
-        "--info", nargs=1, help="print information about a node, requires node FQDN"
+        "--info",
+        nargs="*",
+        metavar="FQDN",
+        help="print information about one or more nodes, requires node FQDN(s)",
+    )
+    parser.add_argument(
+        "--hosts",
+        metavar="FILE",
+        help="with --info, read the FQDNs from FILE, one per line",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=info_parallel,
+        help="with --info, hammer commands run at the same time "
+        "(default %(default)s)",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="with --info, do not use the answers cached in the last %ss" % info_ttl,
+    )
+    parser.add_argument(
+        "--table",
+        action="store_true",
+        help="with --info, print a table with a row per node",
     )
     parser.add_argument(
         "--list", action="store_true", help="print information about all the nodes"
     )
+    # filters of --list, applied by Foreman (hammer host list --search)
+    parser.add_argument(
+        "--name", help="with --list, only the nodes whose name contains NAME"
+    )
+    parser.add_argument(
+        "--subnet",
+        help="with --list, only the nodes in SUBNET, a subnet name or "
+        "a network like 192.168.1.0/24",
+    )
+    parser.add_argument(
+        "--build",
+        choices=["yes", "no"],
+        help="with --list, only the nodes marked (or not) for build",
+    )
+    parser.add_argument(
+        "--search", help="with --list, a Foreman search query, ex: 'os = CentOS'"
+    )
+    parser.add_argument(
+        "--fields",
+        help="with --list or --info --table, the columns to print, ex: Name,IP "
+        "(default %s)" % ",".join(list_fields),
+    )
+    parser.add_argument(
+        "--page",
+        type=int,
+        help="with --list, print only this page instead of all the nodes",
+    )
+    parser.add_argument(
+        "--per-page",
+        type=int,
+        default=list_per_page,
+        help="with --list, nodes in each page (default %(default)s)",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="with --list or --info, print a JSON object per node, one per line",
+    )
     parser.add_argument(
         "--rebuild", nargs=1, help="trigger rebuilding of a node, requires node FQDN"
     )
     args = parser.parse_args()
     # args is a namespace
     # Namespace(create=None, delete=None, info=None, list=False, rebuild=None)
-    return args.create, args.delete, args.info, args.list, args.rebuild
+    if args.per_page < 1 or (args.page is not None and args.page < 1):
+        parser.error("--page and --per-page start from 1")
+    if args.hosts:
+        with open(args.hosts) as hosts_file:
+            args.info = (args.info or []) + [
+                line.strip()
+                for line in hosts_file
+                if line.strip() and not line.startswith("#")
+            ]
+    if args.info is not None and not args.info:
+        parser.error("--info requires node FQDN(s) or --hosts FILE")
+    if args.parallel < 1:
+        parser.error("--parallel must be at least 1")
+    if args.table and args.json:
+        parser.error("--table and --json are alternative")
+    if args.create and args.manifest:
+        parser.error("--create and --manifest are alternative")
+    try:
+        search = list_search(args.name, args.subnet, args.build, args.search)
+    except ValueError as error:
+        parser.error(str(error))
+    fields = args.fields.split(",") if args.fields else None
+    return (
+        args.create,
+        args.delete,
+        args.info,
+        args.list,
+        args.rebuild,
+        search,
+        fields,
+        args.page,
+        args.per_page,
+        args.json,
+        args.parallel,
+        args.refresh,
+        args.table,
+        args.manifest,
+        args.placement,
+        args.capacity,
+        args.dry_run,
+        args.resume,
+        args.pending,
+    )
     # print(args)  # DEBUG
 
 
 def remote_reboot(server):
     """
-    Use subprocess to connect to $server and reboot it
+    Use ssh_runner to connect to $server and reboot it
     """
     #
     print("Rebooting %s" % server)
     command = 'shutdown -r +1 "Reboot to rebuild the node"'
-    ssh = subprocess.Popen(
-        ["ssh", "%s" % server, command],
-        shell=False,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-
-    result = ssh.stdout.readlines()  # it's a list
-    error = ssh.stderr.readlines()  # it's a list
-    hr_result = " ".join(map(str, result))
-    hr_error = " ".join(map(str, error))
-
+    # bounded connection time and deadline, retries on connection failures
+    ssh = ssh_runner.run(server, command, deadline=60)
+    hr_result = b"".join(ssh.stdout).decode(errors="replace")
+    hr_error = b"".join(ssh.stderr).decode(errors="replace")
     #
     # NOTE: SSH print some information (such as "The system is going
     # down for reboot at") to stderr;
     # we need to catch the exit code to assess if there is an error
-    while ssh.poll() is None:
-        # subprocess has not exited yet, wait
-        time.sleep(0.5)
-    # now it's time to get the return code
     # print("SSH return code: %s" % ssh.returncode)  # DEBUG
-    if ssh.returncode > 0:  # print the error and exit gracefully
-        sys.stderr.write("ERROR: %s\n" % str(hr_error))
+    if ssh.returncode != 0:  # print the error and exit gracefully
+        sys.stderr.write("ERROR: %s\n" % ssh.error())
         # if cannot ssh to the server do NOT exit
         # print the error
         #
@@ -85,54 +243,332 @@ def remote_reboot(server):
         return hr_result + hr_error
 
 
+def checked_reboot(server):
+    """
+    remote_reboot for the journal: raise if the reboot failed, so that
+    the step is recorded as failed
+    """
+    output = remote_reboot(server)
+    if output is None:
+        raise OSError("cannot reboot %s" % server)
+    return output
+
+
+def read_journal(filename=None):
+    """
+    Return the records of the journal, the last line is skipped if it
+    was cut by a crash
+    """
+    records = []
+    try:
+        with open(filename or journal_file) as journal:
+            for line in journal:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass  # cut by a crash
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def last_runs(records):
+    """
+    Return {(operation, node): records of its last run}
+    """
+    runs = {}
+    for record in records:
+        key = (record["operation"], record["node"])
+        if key not in runs or runs[key][0]["run"] != record["run"]:
+            runs[key] = []
+        runs[key].append(record)
+    return runs
+
+
+class operation:
+    """
+    An operation (create, delete, rebuild) on a node; each step is
+    appended to the journal when it completes (or fails) and, with
+    resume, the steps done by the last run are skipped and return the
+    output they recorded
+    """
+
+    def __init__(self, name, node, resume=False, filename=None):
+        self.name = name
+        self.node = node
+        self.filename = filename or journal_file
+        self.done = {}
+        self.finished = False
+        last = last_runs(read_journal(self.filename)).get((name, node), [])
+        if resume and last:
+            self.run = last[0]["run"]
+            for record in last:
+                if record["status"] == "done":
+                    self.done[record["step"]] = record["output"]
+            self.finished = "finished" in self.done
+        else:
+            if last and not any(r["step"] == "finished" for r in last):
+                print(
+                    "NOTE: the last %s of %s did not complete, --resume continues it"
+                    % (name, node)
+                )
+            self.run = "%d-%d" % (time.time() * 1000, os.getpid())
+
+    def append(self, step, status, output=None, error=None):
+        record = {
+            "time": round(time.time(), 3),
+            "run": self.run,
+            "operation": self.name,
+            "node": self.node,
+            "step": step,
+            "status": status,
+            "output": output,
+            "error": error,
+        }
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.filename, "a+b") as journal:
+            line = json.dumps(record).encode() + b"\n"
+            if journal.seek(0, os.SEEK_END):
+                # a line cut by a crash must not swallow this one
+                journal.seek(-1, os.SEEK_END)
+                if journal.read(1) != b"\n":
+                    line = b"\n" + line
+            journal.write(line)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def step(self, step, func, *args):
+        """
+        Run func(*args) unless step is done, return its output
+        """
+        if step in self.done:
+            print("%s %s: %s already done" % (self.name, self.node, step))
+            return self.done[step]
+        try:
+            output = func(*args)
+        except (Exception, SystemExit) as error:
+            if isinstance(error, SystemExit):
+                # the message is already on stderr
+                message = "exit code %s" % error.code
+            else:
+                message = str(error) or type(error).__name__
+            self.append(step, "failed", error=message)
+            raise
+        self.append(step, "done", output)
+        self.done[step] = output
+        return output
+
+    def wait(self, step, seconds):
+        """
+        Sleep seconds, on resume only the time left
+        """
+        started = self.step(step + "_started", time.time)
+        left = seconds - (time.time() - started)
+        if left > 0 and step not in self.done:
+            time.sleep(left)
+        self.step(step, lambda: None)
+
+    def finish(self):
+        self.step("finished", lambda: None)
+
+
+def print_pending(filename=None):
+    """
+    Print the operations whose last run did not complete
+    """
+    pending = 0
+    for (name, node), records in sorted(last_runs(read_journal(filename)).items()):
+        done = [r["step"] for r in records if r["status"] == "done"]
+        if "finished" in done:
+            continue
+        failed = [r for r in records if r["status"] == "failed"]
+        print(
+            "%-8s %-30s %s done: %s%s"
+            % (
+                name,
+                node,
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(records[0]["time"])),
+                ", ".join(done) or "-",
+                (
+                    "; failed: %s (%s)" % (failed[-1]["step"], failed[-1]["error"])
+                    if failed
+                    else ""
+                ),
+            )
+        )
+        pending += 1
+    print("%s operation(s) not completed" % pending)
+
+
 def run_hammer(hmmr_args, shallweprint=True):
     """
-    Use subprocess to nicely wrap the hammer-cli command
+    Use ssh_runner to nicely wrap the hammer-cli command
     """
     # print("type:" % type(hmmr_args))  # DEBUG
     # print("args:" % hmmr_args)  # DEBUG
-    hammer = subprocess.Popen(
-        ["hammer %s" % hmmr_args],
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    result = hammer.stdout.readlines()  # it's a list
-    error = hammer.stderr.readlines()  # it's a list
-    hr_result = " ".join(map(str, result))
-    hr_error = " ".join(map(str, error))
+    hammer = ssh_runner.run_local("hammer %s" % hmmr_args, deadline=command_deadline)
+    result = hammer.stdout  # it's a list
+    error = hammer.stderr  # it's a list
+    hr_result = b"".join(result).decode(errors="replace")
+    hr_error = b"".join(error).decode(errors="replace")
     if shallweprint:
         print("hammer-cli output: \n%s" % hr_result)
-    if error:
-        sys.stderr.write("hammer-cli error: %s\n" % hr_error)
+    if error or hammer.timed_out:
+        sys.stderr.write("hammer-cli error: %s\n" % (hr_error or hammer.error()))
         sys.exit(1)
     return hr_result
 
 
 def run_command(run_args, shallweprint=True):
     """
-    Use subprocess to nicely wrap a shell command
+    Use ssh_runner to nicely wrap a shell command
     """
-    r_command = subprocess.Popen(
-        [run_args], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
-    result = r_command.stdout.readlines()  # it's a list
-    error = r_command.stderr.readlines()  # it's a list
-    hr_result = " ".join(map(str, result))
-    hr_error = " ".join(map(str, error))
+    r_command = ssh_runner.run_local(run_args, deadline=command_deadline)
+    result = r_command.stdout  # it's a list
+    error = r_command.stderr  # it's a list
+    hr_result = b"".join(result).decode(errors="replace")
+    hr_error = b"".join(error).decode(errors="replace")
     if shallweprint:
         print("CMD output: \n%s" % hr_result)
-    while r_command.poll() is None:
-        # subprocess has not exited yet, wait
-        time.sleep(0.5)
     if error or r_command.returncode:
         # sys.stderr.write("Exit code: %s\n" % r_command.returncode)  # DEBUG
-        sys.stderr.write("CMD error: %s\n" % hr_error)
+        sys.stderr.write("CMD error: %s\n" % (hr_error or r_command.error()))
         sys.exit(1)
     return hr_result
 
 
-def func_create(node_create, IP_create, vCPU_create, memory_create, disk_create):
+def hammer_output(hmmr_args):
+    """
+    Run hammer with JSON output, return (decoded output, None)
+    or (None, error)
+    """
+    hammer = ssh_runner.run_local(
+        "hammer --output json %s" % hmmr_args, deadline=command_deadline
+    )
+    if hammer.returncode or hammer.timed_out:
+        return None, hammer.error() or "exit code %s" % hammer.returncode
+    try:
+        return json.loads(hammer.output() or "[]"), None
+    except ValueError:
+        return None, "unexpected output"
+
+
+def hammer_json(hmmr_args):
+    """
+    Run hammer with JSON output and return the decoded output
+    """
+    output, error = hammer_output(hmmr_args)
+    if error:
+        sys.stderr.write("hammer-cli error: %s\n" % error)
+        sys.exit(1)
+    return output
+
+
+def list_search(name=None, subnet=None, build=None, search=None):
+    """
+    Return the Foreman search query for the filters of --list
+    """
+    import ipaddress
+
+    terms = []
+    if name:
+        terms.append('name ~ "%s"' % name)
+    if subnet:
+        if re.match(r"^[\d.]+/\d+$", subnet):
+            # a network: Foreman matches the IP as a string (with the
+            # wildcard, the start of the string), so only the networks
+            # on a byte boundary can be searched
+            network = ipaddress.ip_network(subnet, strict=False)
+            if network.prefixlen % 8:
+                raise ValueError("--subnet: use a /8, /16 or /24 network")
+            octets = str(network.network_address).split(".")
+            if network.prefixlen:
+                terms.append('ip ~ "%s.*"' % ".".join(octets[: network.prefixlen // 8]))
+        else:
+            terms.append('subnet = "%s"' % subnet)
+    if build:
+        terms.append("build = %s" % ("true" if build == "yes" else "false"))
+    if search:
+        terms.append("(%s)" % search)
+    return " and ".join(terms)
+
+
+def list_hosts(search="", fields=None, page=None, per_page=list_per_page):
+    """
+    Generate the pages of hammer host list, a list of dicts each;
+    the next page is fetched while the caller prints the current one
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    hmmr_args = "host list --per-page %s" % per_page
+    if search:
+        hmmr_args += " --search %s" % shlex.quote(search)
+    if fields:
+        hmmr_args += " --fields %s" % shlex.quote(",".join(fields))
+
+    def fetch(number):
+        return hammer_json("%s --page %s" % (hmmr_args, number))
+
+    if page:
+        yield fetch(page)
+        return
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        number = 1
+        next_page = pool.submit(fetch, number)
+        while True:
+            hosts = next_page.result()
+            if len(hosts) == per_page:
+                # a full page, there may be more
+                number += 1
+                next_page = pool.submit(fetch, number)
+            yield hosts
+            if len(hosts) < per_page:
+                break
+
+
+def print_hosts(pages, fields, json_yes=False):
+    """
+    Print the hosts as they arrive, a table or a JSON object per host;
+    the width of the columns is taken from the first page
+    """
+    widths = None
+    count = 0
+    for hosts in pages:
+        for host in hosts:
+            if json_yes:
+                print(json.dumps(host))
+                continue
+            if widths is None:
+                widths = [
+                    max([len(field)] + [len(str(h.get(field, ""))) for h in hosts])
+                    for field in fields
+                ]
+                print("  ".join(f.ljust(w) for f, w in zip(fields, widths)).rstrip())
+                print("  ".join("-" * w for w in widths))
+            print(
+                "  ".join(
+                    str(host.get(field, "")).ljust(w)
+                    for field, w in zip(fields, widths)
+                ).rstrip()
+            )
+        count += len(hosts)
+        sys.stdout.flush()
+    if not json_yes:
+        print("%s node(s)" % count)
+
+
+def func_create(
+    node_create,
+    IP_create,
+    vCPU_create,
+    memory_create,
+    disk_create,
+    cluster=default_cluster,
+    storage=default_storage,
+    op=None,
+):
     # hammer host create --help
     #
     # create needs 5 args: hostname, IP, vCPU, memory (GB), disk (GB)
@@ -150,8 +586,15 @@ def func_create(node_create, IP_create, vCPU_create, memory_create, disk_create)
     # gather information from the build server:
     # we need the FQDN and the domain, example:
     # [foreman.[test.mydomain.com]]
-    foreman_fqdn = run_command("hostname -f", False).strip()
-    foreman_domain = run_command("hostname -d", False).strip()
+    if op is None:
+        op = operation("create", node_create)
+    foreman_fqdn, foreman_domain = op.step(
+        "foreman",
+        lambda: [
+            run_command("hostname -f", False).strip(),
+            run_command("hostname -d", False).strip(),
+        ],
+    )
     # assign args to variables
     IP = IP_create
     vCPU = vCPU_create
@@ -161,28 +604,9 @@ def func_create(node_create, IP_create, vCPU_create, memory_create, disk_create)
     # for example: 2 GB correspond to 2147483648
     # 2 * 1024 * 1024 * 1024
     #
-    # before proceeding we need to check the IP address
-    output = run_hammer("host list", False)
-    if IP in output:
-        regexIP = IP.replace(".", "\.")
-        # in Python 3 this will work
-        # matchedline = re.search(r'^(.*)' + regexIP,
-        #                         output, re.MULTILINE)[0]
-        # but in Python 2 we need to use group(0) instead
-        matchedline = re.search(r"^(.*)" + regexIP, output, re.MULTILINE).group(0)
-        ID = matchedline.split()[0]
-        node = matchedline.split()[2]
-        print(
-            "%s is already used by an existing node: %s (ID %s)\nStopping execution"
-            % (IP, node, ID)
-        )
-        sys.exit(1)
-    # and the hostname
-    if node_create in output:
-        print(
-            "%s is already used by an existing node\nStopping execution" % node_create
-        )
-        sys.exit(1)
+    # before proceeding we need to check the IP address and the hostname
+    # (not again on resume, the node may be there already)
+    op.step("check", check_free, node_create, IP)
     #
     # as we need to replace multiple variables we will use string concat
     # here, also it should help with cleanliness
@@ -191,7 +615,9 @@ def func_create(node_create, IP_create, vCPU_create, memory_create, disk_create)
         + foreman_fqdn
         + '" --puppet-ca-proxy="'
         + foreman_fqdn
-        + "\" --compute-resource=ovirt --compute-attributes=\"cluster='aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa',cores="
+        + '" --compute-resource=ovirt --compute-attributes="cluster=\''
+        + cluster
+        + "',cores="
         + vCPU
         + ",memory="
         + memory
@@ -199,65 +625,303 @@ def func_create(node_create, IP_create, vCPU_create, memory_create, disk_create)
         + IP
         + ',subnet_id=1,domain_id=1" --volume="size_gb='
         + disk
-        + ",storage_domain='aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa',bootable=1\" --domain=\""
+        + ",storage_domain='"
+        + storage
+        + '\',bootable=1" --domain="'
         + foreman_domain
         + '" --architecture="x86_64" --operatingsystem-id="1" --provision-method="build" --build="1" --medium="CentOS mirror" --partition-table="Kickstart default" --root-password="'
         + "DOESNTMATTER"
         + '" --parameters "selinux-mode=permissive, package_upgrade=true, enable-puppetlabs-repo=true, force-puppet=true"'
     )
     print("CMD: hammer host create --name=%s %s" % (node_create, create_str))  # DEBUG
-    run_hammer("host create --name=%s %s" % (node_create, create_str))
+    op.step(
+        "hammer_create",
+        run_hammer,
+        "host create --name=%s %s" % (node_create, create_str),
+    )
     # wait some to give the node time to start rebuilding
-    time.sleep(300)
+    op.wait("build_wait", build_wait)
     # as in this case we provide ONLY the node hostname on the command line we
     # need to build the FQDN for the playbook
     nodefqdn = node_create + "." + foreman_domain
     # run the Ansible playbook node_add
-    run_command(
+    op.step(
+        "node_add",
+        run_command,
         'ansible-playbook ansible/node_add.yaml --extra-vars "node_fqdn=%s node_ip=%s"'
-        % (nodefqdn, IP)
+        % (nodefqdn, IP),
     )
+    op.finish()
     # better error handling, if anything fails before this point
     # it will sys.exit(1) and this line will never be printed
     print("Provisioned %s" % nodefqdn)
 
 
-def func_delete(fqdn_delete):
+def check_free(node_create, IP):
+    """
+    Exit if the IP address or the hostname is used by a node,
+    Foreman searches them instead of listing all the nodes
+    """
+    existing = [
+        host
+        for hosts in list_hosts(
+            'ip = "%s" or name ~ "%s"' % (IP, node_create), ["Id", "Name", "IP"]
+        )
+        for host in hosts
+    ]
+    for host in existing:
+        if host.get("IP") == IP:
+            print(
+                "%s is already used by an existing node: %s (ID %s)\nStopping execution"
+                % (IP, host.get("Name"), host.get("Id"))
+            )
+            sys.exit(1)
+    # and the hostname, ~ is a substring match: web10 is not web1
+    for host in existing:
+        if str(host.get("Name", "")).split(".")[0].lower() == node_create.lower():
+            print(
+                "%s is already used by an existing node: %s (ID %s)\n"
+                "Stopping execution" % (node_create, host.get("Name"), host.get("Id"))
+            )
+            sys.exit(1)
+
+
+def place_nodes(requests, policy="least-loaded", capacity_file=None):
+    """
+    Choose the cluster and the storage domain of the nodes to create,
+    jointly (see placement.place); return (request, cluster id, storage
+    domain id) for each node, exit if one of them does not fit
+    """
+    capacity = None
+    if policy != "fixed":
+        try:
+            capacity = placement.load_capacity(capacity_file)
+        except (OSError, ValueError) as error:
+            sys.stderr.write("ERROR: utilisation: %s\n" % error)
+            sys.exit(1)
+    if capacity is None:
+        if policy != "fixed":
+            print("No utilisation available, using the default cluster and storage")
+        return [(r, default_cluster, default_storage) for r in requests]
+    placements = placement.place(requests, capacity, policy)[0]
+    placement.print_placements(placements)
+    if any(cluster is None for request, cluster, domain in placements):
+        print("Not enough capacity\nStopping execution")
+        sys.exit(1)
+    return [
+        (request, cluster["id"], domain["id"])
+        for request, cluster, domain in placements
+    ]
+
+
+def func_delete(fqdn_delete, resume=False):
     # hammer host delete --help
     #
+    op = operation("delete", fqdn_delete, resume)
+    if op.finished:
+        print("%s already deleted" % fqdn_delete)
+        return
     # get the IP address
-    IP = run_command("dig +short @127.0.0.1 %s" % fqdn_delete)
+    IP = op.step(
+        "dig", lambda: run_command("dig +short @127.0.0.1 %s" % fqdn_delete).strip()
+    )
     #
     # hammer host delete --name=testvm.test.mydomain.com
     print("CMD: hammer host delete --name=%s" % fqdn_delete)  # DEBUG
-    run_hammer("host delete --name=%s" % fqdn_delete)
+    op.step("hammer_delete", run_hammer, "host delete --name=%s" % fqdn_delete)
     # run the Ansible playbook node_remove
-    run_command(
+    op.step(
+        "node_remove",
+        run_command,
         'ansible-playbook ansible/node_remove.yaml --extra-vars "node_fqdn=%s node_ip=%s"'
-        % (fqdn_delete, IP)
+        % (fqdn_delete, IP),
     )
+    op.finish()
+
+
+def flatten(info, prefix=""):
+    """
+    Flatten the nested answer of hammer host info,
+    {"Status": {"Build Status": "Installed"}} -> {"Status/Build Status": ...}
+    """
+    flat = {}
+    items = enumerate(info) if isinstance(info, list) else info.items()
+    for key, value in items:
+        key = "%s%s" % (prefix, key)
+        if isinstance(value, (dict, list)) and value:
+            flat.update(flatten(value, key + "/"))
+        else:
+            flat[key] = value
+    return flat
 
 
-def func_info(fqdn_info):
+def host_info(fqdn, refresh=False, cached_only=False):
+    """
+    Return (fqdn, info, error) for fqdn, info is the answer of hammer host
+    info; the answers are cached for info_ttl seconds, with cached_only
+    info is None if fqdn is not cached
+    """
+    cached = os.path.join(info_cache, fqdn + ".json")
+    if not refresh:
+        try:
+            if time.time() - os.stat(cached).st_mtime < info_ttl:
+                with open(cached) as cache_file:
+                    return fqdn, json.load(cache_file), None
+        except (OSError, ValueError):
+            pass  # not cached, too old or garbage
+    if cached_only:
+        return fqdn, None, None
+    info, error = hammer_output("host info --name %s" % shlex.quote(fqdn))
+    if error:
+        return fqdn, None, error
+    try:
+        os.makedirs(info_cache, exist_ok=True)
+        # write and rename, the others never read a half written answer
+        with open(cached + ".tmp", "w") as cache_file:
+            json.dump(info, cache_file)
+        os.replace(cached + ".tmp", cached)
+    except OSError:
+        pass  # no cache, the answer is still good
+    return fqdn, info, None
+
+
+def info_lookup(fqdns):
+    """
+    Return {fqdn: the answer of hammer host list} for the fqdns Foreman
+    knows, with one hammer host list for all of them; None if hammer
+    host list fails
+    """
+    search = " or ".join('name = "%s"' % fqdn for fqdn in fqdns)
+    hosts, error = hammer_output(
+        "host list --per-page %s --search %s" % (len(fqdns) + 1, shlex.quote(search))
+    )
+    if error:
+        sys.stderr.write("hammer-cli error: %s\n" % error)
+        return None
+    found = dict((str(host.get("Name", "")).lower(), host) for host in hosts)
+    return dict((fqdn, found[fqdn.lower()]) for fqdn in fqdns if fqdn.lower() in found)
+
+
+def func_info(
+    fqdns,
+    parallel=info_parallel,
+    refresh=False,
+    json_yes=False,
+    table_yes=False,
+    fields=None,
+):
     # hammer host info --help
     #
     # hammer host info --name=testvm.test.mydomain.com
-    print("CMD: hammer host info --name=%s" % fqdn_info)  # DEBUG
-    run_hammer("host info --name=%s" % fqdn_info)
+    # hammer spends most of the time starting: the nodes are looked up
+    # info_batch at a time with hammer host list, which answers the
+    # --table of its columns and the unknown nodes; hammer host info is
+    # run (parallel at the same time) only for the other nodes and
+    # fields, or if hammer host list fails; the answers are printed in
+    # the same order as fqdns
+    from concurrent.futures import ThreadPoolExecutor
 
+    if not (json_yes or table_yes):
+        print("CMD: hammer host info --name=%s" % ",".join(fqdns))  # DEBUG
+    answers = {}
+    if not refresh:
+        for fqdn in fqdns:
+            answer = host_info(fqdn, cached_only=True)
+            if answer[1] is not None:
+                answers[fqdn] = answer
+    missing = [fqdn for fqdn in dict.fromkeys(fqdns) if fqdn not in answers]
+    batches = [missing[i : i + info_batch] for i in range(0, len(missing), info_batch)]
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        listed = {}
+        unknown = set()
+        for batch, found in zip(batches, pool.map(info_lookup, batches)):
+            if found is not None:
+                listed.update(found)
+                unknown.update(fqdn for fqdn in batch if fqdn not in found)
+        detail = []
+        for fqdn in missing:
+            if fqdn in unknown:
+                answers[fqdn] = (fqdn, None, "Host not found")
+            elif (
+                fqdn in listed
+                and table_yes
+                and all(f in listed[fqdn] for f in fields or info_fields)
+            ):
+                answers[fqdn] = (fqdn, listed[fqdn], None)
+            else:
+                detail.append(fqdn)
+        for answer in pool.map(lambda fqdn: host_info(fqdn, refresh), detail):
+            answers[answer[0]] = answer
+    return [answers[fqdn] for fqdn in fqdns]
 
-def func_list():
+
+def print_info(answers, fields=None, json_yes=False, table_yes=False):
+    """
+    Print the answers of func_info: a block per node, a table
+    or a JSON object per node
+    """
+    if table_yes:
+        fields = ["FQDN"] + (fields or info_fields)
+        rows = [
+            [fqdn]
+            + (
+                [str(flatten(info).get(f, "")) for f in fields[1:]]
+                if info is not None
+                else ["ERROR: %s" % error]
+            )
+            for fqdn, info, error in answers
+        ]
+        widths = [
+            max(len(r[i]) for r in rows + [fields] if i < len(r))
+            for i in range(len(fields))
+        ]
+        print("  ".join(f.ljust(w) for f, w in zip(fields, widths)).rstrip())
+        print("  ".join("-" * w for w in widths))
+        for row in rows:
+            print("  ".join(c.ljust(w) for c, w in zip(row, widths)).rstrip())
+    for fqdn, info, error in answers:
+        if json_yes:
+            print(json.dumps({"fqdn": fqdn, "info": info, "error": error}))
+        elif table_yes:
+            continue
+        elif error:
+            print("\n%s\nERROR: %s" % (fqdn, error))
+        else:
+            print("\n%s" % fqdn)
+            for key, value in flatten(info).items():
+                print("%-40s %s" % (key + ":", value))
+    failed = len([a for a in answers if a[2]])
+    if not json_yes:
+        print("\n%s node(s), %s error(s)" % (len(answers), failed))
+
+
+def func_list(
+    search="", fields=None, page=None, per_page=list_per_page, json_yes=False
+):
     # hammer host list --help
     #
-    print("CMD: hammer host list")  # DEBUG
-    run_hammer("host list")
+    # the filters are applied by Foreman, the pages are printed as they
+    # arrive instead of waiting for the whole list
+    fields = fields or list_fields
+    if not json_yes:
+        print(
+            "CMD: hammer host list%s"
+            % (" --search %s" % shlex.quote(search) if search else "")
+        )  # DEBUG
+    print_hosts(list_hosts(search, fields, page, per_page), fields, json_yes)
 
 
-def func_rebuild(fqdn_rebuild):
+def func_rebuild(fqdn_rebuild, resume=False):
     # hammer host update --help
     #
+    op = operation("rebuild", fqdn_rebuild, resume)
+    if op.finished:
+        print("%s already rebuilt" % fqdn_rebuild)
+        return
     # get the IP address
-    IP = run_command("dig +short @127.0.0.1 %s" % fqdn_rebuild)
+    IP = op.step(
+        "dig", lambda: run_command("dig +short @127.0.0.1 %s" % fqdn_rebuild).strip()
+    )
     #
     # rebuild consists of three separate tasks
     # 1) mark the host for rebuild in foreman
@@ -266,29 +930,67 @@ def func_rebuild(fqdn_rebuild):
     #    both IP and FQDN
     update_str = '--parameters "selinux-mode=permissive, package_upgrade=true, enable-puppetlabs-repo=true, force-puppet=true" --build 1'
     print("CMD: hammer host update %s --name=%s" % (update_str, fqdn_rebuild))  # DEBUG
-    run_hammer("host update %s --name=%s" % (update_str, fqdn_rebuild))
-    remote_reboot(fqdn_rebuild)
+    op.step(
+        "hammer_update",
+        run_hammer,
+        "host update %s --name=%s" % (update_str, fqdn_rebuild),
+    )
+    try:
+        op.step("reboot", checked_reboot, fqdn_rebuild)
+        rebooted = True
+    except OSError:
+        # do NOT exit (see remote_reboot); the node is not rebuilding,
+        # --resume reboots it and goes on from there
+        rebooted = False
     #
     # delegate this part to Ansible playbook, leaving it here for reference
     # run_command("ssh-keygen -R %s" % fqdn_rebuild)
     # run_command("ssh-keygen -R %s" % IP)
     #
     # run the Ansible playbook node_remove
-    run_command(
+    op.step(
+        "node_remove",
+        run_command,
         'ansible-playbook ansible/node_remove.yaml --extra-vars "node_fqdn=%s node_ip=%s"'
-        % (fqdn_rebuild, IP)
+        % (fqdn_rebuild, IP),
     )
+    if not rebooted:
+        print("%s not rebooted, see --pending and --resume" % fqdn_rebuild)
+        return
     # wait some to give the node time to start rebuilding
-    time.sleep(300)
+    op.wait("build_wait", build_wait)
     # run the Ansible playbook node_add
-    run_command(
+    op.step(
+        "node_add",
+        run_command,
         'ansible-playbook ansible/node_add.yaml --extra-vars "node_fqdn=%s node_ip=%s"'
-        % (fqdn_rebuild, IP)
+        % (fqdn_rebuild, IP),
     )
+    op.finish()
 
 
 if __name__ == "__main__":
-    arg_create, arg_delete, arg_info, arg_list, arg_rebuild = arguments()
+    (
+        arg_create,
+        arg_delete,
+        arg_info,
+        arg_list,
+        arg_rebuild,
+        arg_search,
+        arg_fields,
+        arg_page,
+        arg_per_page,
+        arg_json,
+        arg_parallel,
+        arg_refresh,
+        arg_table,
+        arg_manifest,
+        arg_placement,
+        arg_capacity,
+        arg_dry_run,
+        arg_resume,
+        arg_pending,
+    ) = arguments()
     # print("create=%s delete=%s info=%s list=%s rebuild=%s" % (arg_create,
     #                                                           arg_delete,
     #                                                           arg_info,
@@ -298,27 +1000,81 @@ if __name__ == "__main__":
 
     # in order to reuse the nodes_wrapper script for the heavy lifting
     # each action is now in a separate function
-    if arg_create:
-        # --create has been requested
-        func_create(
-            arg_create[0], arg_create[1], arg_create[2], arg_create[3], arg_create[4]
+    if arg_create or arg_manifest:
+        # --create or --manifest has been requested
+        if arg_manifest:
+            try:
+                requests = placement.read_manifest(arg_manifest)
+            except (OSError, ValueError) as error:
+                sys.stderr.write("ERROR: %s\n" % error)
+                sys.exit(1)
+        else:
+            requests = [
+                {
+                    "name": arg_create[0],
+                    "ip": arg_create[1],
+                    "vcpu": int(arg_create[2]),
+                    "memory_gb": int(arg_create[3]),
+                    "disk_gb": int(arg_create[4]),
+                }
+            ]
+        # on resume the nodes keep the cluster and the storage domain
+        # chosen by the last run, only the others are placed
+        ops = [operation("create", r["name"], arg_resume) for r in requests]
+        placed = dict(
+            (request["name"], [cluster, storage])
+            for request, cluster, storage in place_nodes(
+                [r for r, op in zip(requests, ops) if "place" not in op.done],
+                arg_placement,
+                arg_capacity,
+            )
         )
+        if arg_dry_run:
+            sys.exit()
+        for request, op in zip(requests, ops):
+            if op.finished:
+                print("%s already created" % request["name"])
+                continue
+            cluster, storage = op.step("place", lambda: placed[request["name"]])
+            func_create(
+                request["name"],
+                request["ip"],
+                str(request["vcpu"]),
+                str(request["memory_gb"]),
+                str(request["disk_gb"]),
+                cluster,
+                storage,
+                op,
+            )
+            if not arg_capacity and arg_placement != "fixed":
+                # the next runs see the node even before the utilisation
+                # is fetched again
+                placement.reserve(request, cluster, storage)
         sys.exit()
     if arg_delete:
         # --delete has been requested
-        func_delete(arg_delete[0])
+        func_delete(arg_delete[0], arg_resume)
         sys.exit()
     if arg_info:
         # --info has been requested
-        func_info(arg_info[0])
+        answers = func_info(
+            arg_info, arg_parallel, arg_refresh, arg_json, arg_table, arg_fields
+        )
+        print_info(answers, arg_fields, arg_json, arg_table)
+        if any(error for fqdn, info, error in answers):
+            sys.exit(1)
         sys.exit()
     if arg_list:
         # --list has been requested
-        func_list()
+        func_list(arg_search, arg_fields, arg_page, arg_per_page, arg_json)
+        sys.exit()
+    if arg_pending:
+        # --pending has been requested
+        print_pending()
         sys.exit()
     if arg_rebuild:
         # --rebuild has been requested
-        func_rebuild(arg_rebuild[0])
+        func_rebuild(arg_rebuild[0], arg_resume)
         sys.exit()
     # no args have been provided, print a short help
     print("No args provided. Try -h for help.")
@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+
+"""
+Keep an inventory of the servers (datacenter, rack, RU, asset tag,
+model, warranty) built from the Xymon hinv test in a SQLite database
+
+The inventory is refreshed incrementally: failed_disk.py --inventory
+records the servers it has just collected, refresh queries Xymon only
+for the servers not refreshed in the last --max-age seconds, and only
+the servers whose details changed are written again
+
+failed_disk.py --fleet FILE --visit uses it for the servers whose hinv
+is missing or incomplete
+
+Usage:
+hw_inventory.py refresh --hosts FILE [--max-age S]
+hw_inventory.py list [--location LOCATION]
+hw_inventory.py host HOST
+"""
+
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import time
+
+# where the inventory is stored if not specified otherwise
+default_db = os.path.expanduser("~/.failed_disk/inventory.sqlite")
+
+schema = """
+CREATE TABLE IF NOT EXISTS server (
+    host TEXT PRIMARY KEY,
+    cluster TEXT NOT NULL,
+    location TEXT NOT NULL,
+    rack TEXT NOT NULL,
+    ru TEXT NOT NULL,
+    asset_tag TEXT NOT NULL,
+    model TEXT NOT NULL,
+    warranty TEXT NOT NULL,
+    changed INTEGER NOT NULL,
+    seen INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS server_position ON server (location, rack, ru);
+"""
+
+# the columns with the details, in the same order as the keys of
+# server_object.server_details they come from
+columns = ["location", "rack", "ru", "asset_tag", "model", "warranty"]
+details_keys = ["Location", "Rack", "RU", "Asset tag", "Server model", "Warranty epoch"]
+
+
+def open_inventory(filename=default_db):
+    """
+    Open (and create if needed) the inventory database, return the connection
+    """
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    conn = sqlite3.connect(filename)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(schema)
+    return conn
+
+
+def natural(string):
+    """
+    Sort key for racks and RUs: R2 before R10, 9 before 10,11
+    """
+    return [int(s) if s.isdigit() else s for s in re.split(r"(\d+)", string or "")]
+
+
+def update_inventory(conn, servers, timestamp=None):
+    """
+    Record the details of the server_objects, write only the servers
+    new or changed and mark the others as seen; the servers without a
+    location (hinv missing) are skipped
+    Return the number of servers written
+    """
+    if timestamp is None:
+        timestamp = int(time.time())
+    known = dict(
+        (row[0], tuple(row[1:]))
+        for row in conn.execute("SELECT host, %s FROM server" % ", ".join(columns))
+    )
+    changed = []
+    seen = []
+    for this_server in servers:
+        details = this_server.server_details
+        if not details.get("Location"):
+            continue
+        values = tuple(details.get(key, "") for key in details_keys)
+        if known.get(this_server.server) == values:
+            seen.append((timestamp, this_server.server))
+        else:
+            changed.append(
+                (this_server.server, this_server.letter)
+                + values
+                + (timestamp, timestamp)
+            )
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO server VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            changed,
+        )
+        conn.executemany("UPDATE server SET seen = ? WHERE host = ?", seen)
+    return len(changed)
+
+
+def stale_hosts(conn, hosts, max_age, now=None):
+    """
+    Return the hosts not in the inventory or not seen in max_age seconds
+    """
+    if now is None:
+        now = time.time()
+    seen = dict(conn.execute("SELECT host, seen FROM server"))
+    return [host for host in hosts if now - seen.get(host, 0) > max_age]
+
+
+def lookup(conn, host):
+    """
+    Return the details of host as server_object.server_details, or None
+    """
+    row = conn.execute(
+        "SELECT %s FROM server WHERE host = ?" % ", ".join(columns), (host,)
+    ).fetchone()
+    return dict(zip(details_keys, row)) if row else None
+
+
+def fill_details(conn, servers):
+    """
+    Complete the details of the servers whose hinv is missing or
+    incomplete with the inventory; return the hosts completed
+    """
+    filled = []
+    for this_server in servers:
+        if all(this_server.server_details.get(key) for key in details_keys[:3]):
+            continue
+        details = lookup(conn, this_server.server)
+        if details:
+            for key, value in details.items():
+                if not this_server.server_details.get(key):
+                    this_server.server_details[key] = value
+            filled.append(this_server.server)
+    return filled
+
+
+def list_servers(conn, location=None):
+    """
+    Return the servers as tuples (location, rack, RU, host, model,
+    asset tag), ordered by location, rack and RU
+    """
+    query = "SELECT location, rack, ru, host, model, asset_tag FROM server"
+    params = []
+    if location:
+        query += " WHERE location = ?"
+        params.append(location)
+    return sorted(
+        conn.execute(query, params),
+        key=lambda x: (x[0], natural(x[1]), natural(x[2]), x[3]),
+    )
+
+
+class inventory_entry:
+    """
+    The part of server_object the inventory needs, parsed from hinv alone
+    """
+
+    def __init__(self, host, hinv):
+        import failed_disk
+
+        self.server = host
+        self.letter = failed_disk.get_cluster_letter(host)
+        # same fix as server_object.parse_hinv
+        hinv = failed_disk.strip(hinv).replace("\", b'", "")
+        self.server_details = failed_disk.hinv_details(hinv)
+
+
+def refresh(conn, hosts, max_age):
+    """
+    Query Xymon for the hinv of the stale hosts and update the inventory;
+    return (hosts queried, servers written)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    import failed_disk
+
+    stale = stale_hosts(conn, hosts, max_age)
+
+    def collect(host):
+        try:
+            return host, failed_disk.query_xymon(host, "hinv")
+        except OSError as error:
+            sys.stderr.write("ERROR: %s: %s\n" % (host, error))
+            return host, None
+
+    servers = []
+    with ThreadPoolExecutor(max_workers=failed_disk.fleet_workers) as pool:
+        for host, hinv in pool.map(collect, stale):
+            if hinv is not None:
+                servers.append(inventory_entry(host, hinv))
+    return len(stale), update_inventory(conn, servers)
+
+
+def arguments():
+    """
+    Parse arguments and return help message if the script is invoked with -h
+    """
+    parser = argparse.ArgumentParser(
+        description="Inventory of the servers built from the Xymon hinv test",
+        prog="hw_inventory",
+    )
+    parser.add_argument(
+        "--db", default=default_db, help="inventory database (default %(default)s)"
+    )
+    parser.add_argument("command", choices=["refresh", "list", "host"])
+    parser.add_argument("host", nargs="?", help="(host) the server")
+    parser.add_argument("--hosts", metavar="FILE", help="(refresh) the servers")
+    parser.add_argument(
+        "--max-age",
+        type=int,
+        default=86400,
+        help="(refresh) query the servers not refreshed in MAX_AGE "
+        "seconds (default %(default)s)",
+    )
+    parser.add_argument("--location", help="(list) only this datacenter")
+    args = parser.parse_args()
+    if args.command == "refresh" and not args.hosts:
+        parser.error("refresh needs --hosts FILE")
+    if args.command == "host" and not args.host:
+        parser.error("host needs a server")
+    return args
+
+
+if __name__ == "__main__":
+    args = arguments()
+    inventory = open_inventory(args.db)
+    if args.command == "refresh":
+        import failed_disk
+
+        queried, written = refresh(
+            inventory, failed_disk.read_hosts(args.hosts), args.max_age
+        )
+        print("%s servers queried, %s new or changed" % (queried, written))
+    elif args.command == "host":
+        details = lookup(inventory, args.host)
+        if not details:
+            sys.exit("ERROR: %s is not in the inventory" % args.host)
+        for key in details_keys:
+            print("%-20s %s" % (key + ":", details[key]))
+    else:
+        print(
+            "%-20s %-6s %-6s %-10s %-20s %s"
+            % ("Location", "Rack", "RU", "Server", "Model", "Asset tag")
+        )
+        for location, rack, ru, host, model, asset_tag in list_servers(
+            inventory, args.location
+        ):
+            print(
+                "%-20s %-6s %-6s %-10s %-20s %s"
+                % (location, rack, ru, host, model, asset_tag)
+            )
+    inventory.close()
+    # That's all folks!
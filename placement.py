@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+
+"""
+Choose the oVirt cluster and the storage domain of new VMs from their
+utilisation, used by hammer-cli-wrapper.py --create and --manifest
+
+The utilisation comes from capacity_command (a script asking oVirt,
+its output is cached for capacity_ttl seconds) or from a JSON file:
+{
+  "clusters": [{"id": "...", "name": "...", "cpus": 64, "cpus_used": 40,
+                "memory_gb": 512, "memory_used_gb": 300}],
+  "storage_domains": [{"id": "...", "name": "...", "size_gb": 4000,
+                       "used_gb": 3500}]
+}
+A VM fits in a cluster if the vCPUs stay within cpu_overcommit times
+the cores and the memory within the memory minus memory_reserve; it
+fits in a storage domain if the disk leaves storage_reserve free
+- least-loaded: the target with the lowest utilisation after the VM
+  is placed, the VMs are spread
+- best-fit: the fullest target where the VM still fits, the free space
+  is kept in big blocks for the big VMs
+A manifest is placed jointly, biggest VMs first (first fit decreasing),
+each VM sees the utilisation left by the previous ones
+
+Usage:
+placement.py [--capacity FILE] [--policy POLICY] show
+placement.py [--capacity FILE] [--policy POLICY] place MANIFEST
+"""
+
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+
+# the command printing the utilisation as JSON (see above) #CHANGEME
+capacity_command = None
+capacity_ttl = 120
+capacity_cache = os.path.expanduser("~/.hammer-cli-wrapper/capacity.json")
+# vCPUs per core, fraction of the memory and of the storage kept free
+cpu_overcommit = 4.0
+memory_reserve = 0.1
+storage_reserve = 0.15
+policies = ["least-loaded", "best-fit"]
+
+
+def cached_capacity():
+    """
+    Return the cached utilisation, None when it is missing, garbage or
+    fetched more than capacity_ttl seconds ago
+    """
+    try:
+        with open(capacity_cache) as capacity_file:
+            capacity = json.load(capacity_file)
+        if time.time() - capacity["fetched"] < capacity_ttl:
+            return capacity
+    except (OSError, ValueError, KeyError, TypeError):
+        pass  # not cached, too old or garbage
+    return None
+
+
+def load_capacity(filename=None, refresh=False):
+    """
+    Return the utilisation: from filename if given, otherwise from the
+    cache or, when it is older than capacity_ttl, from capacity_command;
+    None when there is no source
+    """
+    if filename:
+        with open(filename) as capacity_file:
+            return json.load(capacity_file)
+    if not refresh:
+        capacity = cached_capacity()
+        if capacity is not None:
+            return capacity
+    if not capacity_command:
+        return None
+    import ssh_runner
+
+    done = ssh_runner.run_local(capacity_command, deadline=120)
+    if done.returncode or done.timed_out:
+        raise OSError("%s: %s" % (capacity_command, done.error()))
+    capacity = json.loads(done.output())
+    # the age of the cache is the age of the utilisation, not of the
+    # last save (see reserve)
+    capacity["fetched"] = time.time()
+    save_capacity(capacity)
+    return capacity
+
+
+def save_capacity(capacity, filename=None):
+    """
+    Save the utilisation in the cache (or in filename), write and rename
+    """
+    filename = filename or capacity_cache
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(filename + ".tmp", "w") as capacity_file:
+        json.dump(capacity, capacity_file, indent=2)
+    os.replace(filename + ".tmp", filename)
+
+
+def reserve(request, cluster_id, domain_id):
+    """
+    Add the VM of request, created on cluster_id and domain_id, to the
+    cached utilisation so that the next runs see it before the cache
+    expires; the time it was fetched is kept
+    """
+    capacity = cached_capacity()
+    if capacity is None:
+        return  # the next fetch counts the VM
+    for cluster in capacity["clusters"]:
+        if cluster["id"] == cluster_id:
+            cluster["cpus_used"] += request["vcpu"]
+            cluster["memory_used_gb"] += request["memory_gb"]
+    for domain in capacity["storage_domains"]:
+        if domain["id"] == domain_id:
+            domain["used_gb"] += request["disk_gb"]
+    save_capacity(capacity)
+
+
+def cluster_load(cluster, vcpu=0, memory_gb=0):
+    """
+    Return the utilisation of cluster with the VM, the highest of CPU
+    and memory (1.0 = full); above 1.0 the VM does not fit
+    """
+    cpus = cluster["cpus"] * cpu_overcommit
+    memory = cluster["memory_gb"] * (1 - memory_reserve)
+    if not cpus or not memory:
+        return float("inf")
+    return max(
+        (cluster["cpus_used"] + vcpu) / cpus,
+        (cluster["memory_used_gb"] + memory_gb) / memory,
+    )
+
+
+def storage_load(domain, disk_gb=0):
+    """
+    Return the utilisation of the storage domain with the disk
+    (1.0 = full); above 1.0 the disk does not fit
+    """
+    size = domain["size_gb"] * (1 - storage_reserve)
+    if not size:
+        return float("inf")
+    return (domain["used_gb"] + disk_gb) / size
+
+
+def choose(targets, load, policy):
+    """
+    Return the target chosen by policy among the ones where load(target)
+    is at most 1.0, None if the VM fits nowhere
+    """
+    fitting = [(load(t), t["name"], t) for t in targets if load(t) <= 1.0]
+    if not fitting:
+        return None
+    if policy == "best-fit":
+        return max(fitting, key=lambda x: (x[0], x[1]))[2]
+    return min(fitting, key=lambda x: (x[0], x[1]))[2]
+
+
+def place(requests, capacity, policy="least-loaded"):
+    """
+    Place the requests, dicts with name, vcpu, memory_gb and disk_gb,
+    jointly: biggest first, each one on the utilisation left by the
+    previous ones
+    Return (placements, capacity after): placements are (request,
+    cluster, storage domain) in the order of requests, cluster and
+    storage domain are None for the requests which do not fit
+    """
+    capacity = copy.deepcopy(capacity)
+    clusters = capacity["clusters"]
+    domains = capacity["storage_domains"]
+
+    # the biggest VMs first, by the share of the largest cluster
+    # and storage domain they take
+    cores = max([c["cpus"] * cpu_overcommit for c in clusters] or [1]) or 1
+    memory = max([c["memory_gb"] for c in clusters] or [1]) or 1
+    space = max([d["size_gb"] for d in domains] or [1]) or 1
+    order = sorted(
+        range(len(requests)),
+        key=lambda i: max(
+            requests[i]["vcpu"] / cores,
+            requests[i]["memory_gb"] / memory,
+            requests[i]["disk_gb"] / space,
+        ),
+        reverse=True,
+    )
+    chosen = {}
+    for index in order:
+        request = requests[index]
+        cluster = choose(
+            clusters,
+            lambda c: cluster_load(c, request["vcpu"], request["memory_gb"]),
+            policy,
+        )
+        domain = choose(domains, lambda d: storage_load(d, request["disk_gb"]), policy)
+        if cluster is None or domain is None:
+            chosen[index] = (request, None, None)
+            continue
+        cluster["cpus_used"] += request["vcpu"]
+        cluster["memory_used_gb"] += request["memory_gb"]
+        domain["used_gb"] += request["disk_gb"]
+        chosen[index] = (request, cluster, domain)
+    placements = [
+        (
+            request,
+            dict(id=cluster["id"], name=cluster["name"]) if cluster else None,
+            dict(id=domain["id"], name=domain["name"]) if domain else None,
+        )
+        for request, cluster, domain in (chosen[i] for i in range(len(requests)))
+    ]
+    return placements, capacity
+
+
+def read_manifest(filename):
+    """
+    Read the VMs to create, one per line: hostname IP vCPU memory disk
+    (memory and disk in GB, as --create); the empty lines and the lines
+    starting with # are skipped
+    """
+    requests = []
+    with open(filename) as manifest:
+        for number, line in enumerate(manifest, 1):
+            if not line.strip() or line.startswith("#"):
+                continue
+            try:
+                name, ip, vcpu, memory, disk = line.split()
+                requests.append(
+                    {
+                        "name": name,
+                        "ip": ip,
+                        "vcpu": int(vcpu),
+                        "memory_gb": int(memory),
+                        "disk_gb": int(disk),
+                    }
+                )
+            except ValueError:
+                raise ValueError(
+                    "%s:%s: expected hostname IP vCPU memory disk" % (filename, number)
+                )
+    return requests
+
+
+def print_capacity(capacity):
+    print("%-20s %8s %10s %8s" % ("Cluster", "vCPU", "Memory GB", "Load"))
+    for cluster in sorted(capacity["clusters"], key=lambda c: c["name"]):
+        print(
+            "%-20s %8s %10s %7.0f%%"
+            % (
+                cluster["name"],
+                "%s/%s" % (cluster["cpus_used"], int(cluster["cpus"] * cpu_overcommit)),
+                "%s/%s" % (cluster["memory_used_gb"], cluster["memory_gb"]),
+                100 * cluster_load(cluster),
+            )
+        )
+    print("\n%-20s %19s %8s" % ("Storage domain", "Used GB", "Load"))
+    for domain in sorted(capacity["storage_domains"], key=lambda d: d["name"]):
+        print(
+            "%-20s %19s %7.0f%%"
+            % (
+                domain["name"],
+                "%s/%s" % (domain["used_gb"], domain["size_gb"]),
+                100 * storage_load(domain),
+            )
+        )
+
+
+def print_placements(placements):
+    for request, cluster, domain in placements:
+        if cluster is None:
+            print(
+                "%-20s %3s vCPU %4s GB %5s GB  does not fit"
+                % (
+                    request["name"],
+                    request["vcpu"],
+                    request["memory_gb"],
+                    request["disk_gb"],
+                )
+            )
+        else:
+            print(
+                "%-20s %3s vCPU %4s GB %5s GB  %s, %s"
+                % (
+                    request["name"],
+                    request["vcpu"],
+                    request["memory_gb"],
+                    request["disk_gb"],
+                    cluster["name"],
+                    domain["name"],
+                )
+            )
+
+
+def arguments():
+    """
+    Parse arguments and return help message if the script is invoked with -h
+    """
+    parser = argparse.ArgumentParser(
+        description="Choose the oVirt cluster and storage domain of new VMs",
+        prog="placement",
+    )
+    parser.add_argument("--capacity", metavar="FILE", help="utilisation as JSON")
+    parser.add_argument("--policy", choices=policies, default=policies[0])
+    parser.add_argument("command", choices=["show", "place"])
+    parser.add_argument("manifest", nargs="?", help="(place) the VMs")
+    args = parser.parse_args()
+    if args.command == "place" and not args.manifest:
+        parser.error("place needs a manifest")
+    return args
+
+
+if __name__ == "__main__":
+    args = arguments()
+    try:
+        capacity = load_capacity(args.capacity)
+    except (OSError, ValueError) as error:
+        sys.exit("ERROR: %s" % error)
+    if capacity is None:
+        sys.exit("ERROR: no utilisation, set capacity_command or use --capacity")
+    if args.command == "show":
+        print_capacity(capacity)
+        sys.exit()
+    try:
+        requests = read_manifest(args.manifest)
+    except (OSError, ValueError) as error:
+        sys.exit("ERROR: %s" % error)
+    placements, after = place(requests, capacity, args.policy)
+    print_placements(placements)
+    print("")
+    print_capacity(after)
+    if any(cluster is None for request, cluster, domain in placements):
+        sys.exit(1)
+    # That's all folks!
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+
+"""
+Restart a service on many servers, a batch at a time
+
+This is the Python version of restartservice:
+- the servers of a batch are restarted at the same time, --batch is the
+  maximum number of servers restarted together (see ssh_runner.py)
+- systemd or init is detected on each server
+- after the restart a health probe is run on the server until it passes
+  or --probe-timeout expires (by default systemctl is-active or the
+  status of the init script, --probe runs a different command)
+- the rollout stops, before the next batch, when the servers failed so
+  far are more than --max-failures (a fraction of the servers done)
+
+Usage:
+restartservice.py [--hosts FILE] [--batch N] [--max-failures RATE]
+                  [--probe CMD] [--probe-timeout S] service [server ...]
+"""
+
+import argparse
+import asyncio
+import re
+import sys
+import time
+
+import ssh_runner
+
+RED = "\033[0;31m"
+GREEN = "\033[0;32m"
+NC = "\033[0m"  # No Color
+
+ssh_options = [
+    "-o",
+    "StrictHostKeyChecking=no",
+    "-o",
+    "UserKnownHostsFile=/dev/null",
+]
+# seconds between the runs of the health probe
+probe_interval = 2
+
+# the first line printed by the remote commands is the init system
+systemd_test = (
+    "if [ -d /run/systemd/system ]; then echo systemd; %s; else echo init; %s; fi"
+)
+
+
+def restart_command(service):
+    return systemd_test % (
+        "sudo systemctl restart %s" % service,
+        "sudo /etc/init.d/%s restart" % service,
+    )
+
+
+def probe_command(service):
+    return systemd_test % (
+        "systemctl is-active --quiet %s" % service,
+        "sudo /etc/init.d/%s status" % service,
+    )
+
+
+async def restart_host(core, host, service, probe=None, probe_timeout=60):
+    """
+    Restart service on host and wait for the health probe to pass;
+    return a dict with host, ok, init (systemd/init), error and seconds
+    core is the ssh_runner.runner, the coroutine runs in its loop
+    """
+    start = time.monotonic()
+    result = {"host": host, "ok": False, "init": None, "error": None}
+    ssh = await core.run(host, restart_command(service), options=ssh_options)
+    if ssh.stdout:
+        result["init"] = ssh.stdout[0].decode().strip()
+    if ssh.returncode != 0:
+        result["error"] = "restart failed: %s" % ssh.error()
+    else:
+        # poll the probe until it passes or the time is up
+        command = probe if probe else probe_command(service)
+        while True:
+            ssh = await core.run(
+                host, command, options=ssh_options, deadline=30, breaker=False
+            )
+            if ssh.returncode == 0:
+                result["ok"] = True
+                break
+            if time.monotonic() - start > probe_timeout:
+                result["error"] = "health probe failed: %s" % (
+                    ssh.error() or "exit code %s" % ssh.returncode
+                )
+                break
+            await asyncio.sleep(probe_interval)
+    result["seconds"] = round(time.monotonic() - start, 1)
+    return result
+
+
+async def restart_batch(hosts, service, probe, probe_timeout):
+    """
+    Restart service on all the hosts at the same time
+    """
+    core = ssh_runner.get_runner()
+    return await asyncio.gather(
+        *[restart_host(core, host, service, probe, probe_timeout) for host in hosts]
+    )
+
+
+def rollout(hosts, service, batch=5, max_failures=0.1, probe=None, probe_timeout=60):
+    """
+    Restart service on the hosts, batch at a time; stop when the
+    fraction of the hosts failed so far is more than max_failures
+    Return the results (see restart_host) and the hosts not restarted
+    """
+    results = []
+    for first in range(0, len(hosts), batch):
+        batch_hosts = hosts[first : first + batch]
+        for result in ssh_runner.submit(
+            restart_batch(batch_hosts, service, probe, probe_timeout)
+        ):
+            print_result(result)
+            results.append(result)
+        failed = len([r for r in results if not r["ok"]])
+        if failed > max_failures * len(results):
+            return results, hosts[first + batch :]
+    return results, []
+
+
+def print_result(result):
+    if result["ok"]:
+        print(
+            "%s%s%s restarted (%s, %ss)"
+            % (GREEN, result["host"], NC, result["init"], result["seconds"])
+        )
+    else:
+        print("%s%s%s %s" % (RED, result["host"], NC, result["error"]))
+    sys.stdout.flush()
+
+
+def read_hosts(filename):
+    with open(filename) as hosts_file:
+        return [
+            line.strip()
+            for line in hosts_file
+            if line.strip() and not line.startswith("#")
+        ]
+
+
+def arguments():
+    """
+    Parse arguments and return help message if the script is invoked with -h
+    """
+    parser = argparse.ArgumentParser(
+        description="Restart a service on many servers, a batch at a time",
+        prog="restartservice",
+    )
+    parser.add_argument("service")
+    parser.add_argument("servers", nargs="*")
+    parser.add_argument("--hosts", metavar="FILE", help="the servers, one per line")
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=5,
+        help="servers restarted at the same time (default %(default)s)",
+    )
+    parser.add_argument(
+        "--max-failures",
+        type=float,
+        default=0.1,
+        help="stop when more than this fraction of the servers "
+        "failed (default %(default)s)",
+    )
+    parser.add_argument("--probe", metavar="CMD", help="health probe run on the server")
+    parser.add_argument(
+        "--probe-timeout",
+        type=int,
+        default=60,
+        help="seconds for the service to become healthy (default %(default)s)",
+    )
+    args = parser.parse_args()
+    # the service name ends up in a remote shell
+    if not re.match(r"^[\w@.-]+$", args.service):
+        parser.error("invalid service name %s" % args.service)
+    if args.hosts:
+        args.servers += read_hosts(args.hosts)
+    if not args.servers:
+        parser.error("give at least one server or --hosts FILE")
+    if args.batch < 1:
+        parser.error("--batch must be at least 1")
+    return args
+
+
+if __name__ == "__main__":
+    args = arguments()
+    print(
+        "%sRestarting %s%s%s on %s server(s), %s at a time%s"
+        % (
+            GREEN,
+            RED,
+            args.service,
+            GREEN,
+            len(args.servers),
+            args.batch,
+            NC,
+        )
+    )
+    results, not_done = rollout(
+        args.servers,
+        args.service,
+        args.batch,
+        args.max_failures,
+        args.probe,
+        args.probe_timeout,
+    )
+    failed = [r["host"] for r in results if not r["ok"]]
+    if not_done:
+        print(
+            "%sRollout stopped%s, %s failed, not restarted: %s"
+            % (RED, NC, len(failed), " ".join(not_done))
+        )
+        sys.exit(1)
+    if failed:
+        print("%sDone%s, failed: %s" % (GREEN, NC, " ".join(failed)))
+        sys.exit(1)
+    print("%sDone%s" % (GREEN, NC))
+    # That's all folks!
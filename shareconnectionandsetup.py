@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+
+"""
+Share the connection and set up the proxy and the VMs,
+Python version of shareconnectionandsetup
+
+Each step checks the current state first and changes only what is
+missing, so running it again on a configured environment is quick:
+- the iptables rules are checked with iptables -C and added if missing
+  (nothing is flushed, unless --flush)
+- IPv4 forwarding is enabled only if it is off
+- the default route of the proxy and of the VMs is replaced only if it
+  does not go through the right gateway
+- squid is started only if it is not active, then the script waits for
+  it to be active instead of sleeping
+The steps on the proxy and on the VMs run at the same time; the update
+playbook runs once at the end, only if something changed or with --update
+
+Usage:
+shareconnectionandsetup.py [--update] [--flush] [--dry-run]
+"""
+
+import argparse
+import shlex
+import sys
+import time
+
+import ssh_runner
+
+RED = "\033[0;31m"
+GREEN = "\033[0;32m"
+NC = "\033[0m"  # No Color
+
+# iptables rules for sharing, (table, chain, rule)
+iptables_rules = [
+    ("nat", "POSTROUTING", ["-o", "enp0s3", "-j", "MASQUERADE"]),
+    ("filter", "FORWARD", "-p udp -s 192.168.2.3 -d 8.8.8.8 --dport 53".split()),
+    ("filter", "FORWARD", "-p tcp -s 192.168.2.3 -d 8.8.8.8 --dport 53".split()),
+]
+ip_forward = "/proc/sys/net/ipv4/ip_forward"
+# ansible group: default gateway
+# CHANGE ME change vms if adding VM2 to /etc/ansible/hosts
+routes = {"proxy": "192.168.2.2", "vms": "192.168.3.2"}
+playbook = "/root/playbooks/update.yaml"
+# seconds to wait for squid to be active
+squid_timeout = 30
+# the remote commands print this when they change something
+changed_marker = "SETUP-CHANGED"
+
+
+def run(argv, dry_run=False, timeout=300):
+    """
+    Run a local command (see ssh_runner.run_local), return
+    (return code, output)
+    """
+    if dry_run:
+        print("  would run: %s" % " ".join(argv))
+        return 0, changed_marker
+    done = ssh_runner.run_local(
+        # stderr with stdout, as the shell script shows them
+        "%s 2>&1" % shlex.join(argv),
+        deadline=timeout,
+    )
+    if done.timed_out:
+        return 124, "%s: timed out after %ss" % (argv[0], timeout)
+    return done.returncode, done.output()
+
+
+def ansible(group, command, dry_run=False, timeout=300):
+    """
+    Run a shell command with ansible on group, return (ok, changed, output)
+    """
+    rc, output = run(["ansible", group, "-m", "shell", "-a", command], dry_run, timeout)
+    return rc == 0, changed_marker in output, output
+
+
+def setup_iptables(flush=False, dry_run=False):
+    """
+    Add the iptables rules which are missing, return True if something changed
+    """
+    changed = False
+    if flush:
+        run(["iptables", "-F"], dry_run)
+        changed = True
+    for table, chain, rule in iptables_rules:
+        # iptables -C exits with 0 if the rule is already there
+        if not flush and run(["iptables", "-t", table, "-C", chain] + rule)[0] == 0:
+            continue
+        rc, output = run(["iptables", "-t", table, "-A", chain] + rule, dry_run)
+        if rc != 0:
+            raise RuntimeError("iptables: %s" % output.strip())
+        changed = True
+    with open(ip_forward) as forward:
+        enabled = forward.read().strip() == "1"
+    if not enabled:
+        # enable IPv4 forwarding
+        if dry_run:
+            print("  would enable IPv4 forwarding")
+        else:
+            with open(ip_forward, "w") as forward:
+                forward.write("1\n")
+        changed = True
+    return changed
+
+
+def route_command(gateway):
+    return (
+        "ip route show default | grep -q 'via %s ' || "
+        "(ip route replace default via %s && echo %s)"
+        % (gateway, gateway, changed_marker)
+    )
+
+
+def squid_command():
+    # start squid if needed and wait until it is active
+    return (
+        "systemctl is-active --quiet squid || "
+        "(systemctl start squid && echo %s); "
+        "for i in $(seq %s); do systemctl is-active --quiet squid && exit 0; "
+        "sleep 1; done; exit 1" % (changed_marker, squid_timeout)
+    )
+
+
+def setup_proxy(dry_run=False):
+    """
+    Default route and squid on the proxy, return True if something changed
+    """
+    changed = False
+    for step, command in (
+        ("default route", route_command(routes["proxy"])),
+        ("squid", squid_command()),
+    ):
+        ok, step_changed, output = ansible("proxy", command, dry_run)
+        if not ok:
+            raise RuntimeError("proxy %s: %s" % (step, output.strip()))
+        changed = changed or step_changed
+    return changed
+
+
+def setup_vms(dry_run=False):
+    """
+    Default route on the VMs, return True if something changed
+    """
+    ok, changed, output = ansible("vms", route_command(routes["vms"]), dry_run)
+    if not ok:
+        raise RuntimeError("vms default route: %s" % output.strip())
+    return changed
+
+
+def arguments():
+    """
+    Parse arguments and return help message if the script is invoked with -h
+    """
+    parser = argparse.ArgumentParser(
+        description="Share the connection and set up the proxy and the VMs",
+        prog="shareconnectionandsetup",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="run the update playbook even if nothing changed",
+    )
+    parser.add_argument(
+        "--flush",
+        action="store_true",
+        help="flush the iptables rules first (as the shell script does)",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only print what would change"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from concurrent.futures import ThreadPoolExecutor
+
+    args = arguments()
+    start = time.time()
+    print("%sStart connection sharing%s" % (RED, NC))
+    try:
+        changed = setup_iptables(args.flush, args.dry_run)
+    except (RuntimeError, OSError) as error:
+        sys.exit("ERROR: %s" % error)
+    print("%sSetting default route and squid on proxy and vms%s" % (RED, NC))
+    errors = []
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [
+            pool.submit(setup_proxy, args.dry_run),
+            pool.submit(setup_vms, args.dry_run),
+        ]
+        for future in futures:
+            try:
+                changed = future.result() or changed
+            except (RuntimeError, OSError) as error:
+                errors.append(str(error))
+    if errors:
+        sys.exit("ERROR: %s" % "\nERROR: ".join(errors))
+    if changed or args.update:
+        print("%sStarting the update on proxy/VM1%s" % (RED, NC))
+        rc, output = run(
+            ["ansible-playbook", playbook, "--verbose"], args.dry_run, 3600
+        )
+        print(output)
+        if rc != 0:
+            sys.exit("ERROR: the update playbook failed")
+    else:
+        print("Nothing changed, update skipped (--update to run it)")
+    print("%sFinished all tasks%s in %.1fs" % (GREEN, NC, time.time() - start))
+    # That's all folks!
@@ -0,0 +1,684 @@
+#!/usr/bin/python3
+
+"""
+Run commands on the servers (and locally), the remote execution shared
+by failed_disk.py, failed_diskd.py, hammer-cli-wrapper.py, checkserver.py,
+restartservice.py and shareconnectionandsetup.py
+
+All the runs go through one asyncio event loop in a background thread,
+the scripts call the blocking functions (run, run_many, run_local,
+submit) from any thread:
+- at most max_parallel commands run at the same time, at most per_host
+  on the same server
+- the SSH connections are shared (ControlMaster), the runs on the same
+  server after the first one skip the handshake
+- ssh gives up connecting after connect_timeout seconds (ConnectTimeout)
+  and never waits for a password (BatchMode)
+- the whole run, retries included, ends within the deadline: the process
+  is killed when the time is up
+- only the connection failures (ssh exits with 255) are retried, after
+  a random pause growing with each attempt (jitter, so that a sweep does
+  not hammer a struggling network in lockstep)
+- a circuit breaker, saved in a file and shared by all the runs, skips
+  the servers which failed to connect recently and all the servers of
+  a rack where several servers failed to connect recently (a rack
+  without power); after the cooldown one attempt is let through, if it
+  connects the server (and its rack) are closed again
+- the output can be streamed, on_line is called with each line of stdout
+- the result of a run is a ssh_result (return code, stdout, stderr,
+  duration, ...)
+
+The transport runs the commands: ssh_transport (the default),
+local_transport (the commands run here, through the shell) and
+fake_transport (canned answers, for the tests and the benchmarks)
+
+Usage:
+ssh_runner.py [--state FILE] status
+ssh_runner.py [--state FILE] reset [HOST|rack:LOCATION/RACK]
+"""
+
+import argparse
+import asyncio
+import atexit
+import json
+import os
+import random
+import signal
+import sys
+import threading
+import time
+
+# where the state of the circuit breaker is stored
+default_state = os.path.expanduser("~/.ssh_runner/breaker.json")
+connect_timeout = 10  # seconds to establish the connection
+deadline = 120  # seconds for the whole run, retries included
+retries = 2  # attempts after the first one, only on connection failures
+backoff = 1.0  # seconds, the pause before the retry n is about backoff * 2**n
+# the breaker opens for a server after host_threshold runs failed to
+# connect, for a rack when rack_threshold servers of the rack are open;
+# it stays open for cooldown seconds
+host_threshold = 1
+rack_threshold = 3
+cooldown = 300
+# seconds between the writes of the breaker state
+flush_delay = 1.0
+# commands running at the same time, in total and on the same server
+max_parallel = 64
+per_host = 4
+
+ssh_defaults = [
+    "-o",
+    "BatchMode=yes",
+    "-o",
+    "ServerAliveInterval=5",
+    "-o",
+    "ServerAliveCountMax=2",
+]
+# share the connections to the same server
+ssh_multiplexing = [
+    "-o",
+    "ControlMaster=auto",
+    "-o",
+    "ControlPath=~/.ssh/ssh_runner-%C",
+    "-o",
+    "ControlPersist=5m",
+]
+
+
+class ssh_result:
+    """
+    The outcome of a run: the return code, the lines (bytes) printed
+    on stdout and stderr and how it went
+    """
+
+    def __init__(self, host, command):
+        self.host = host
+        self.command = command
+        self.transport = None  # the name of the transport
+        self.returncode = None
+        self.stdout = []
+        self.stderr = []
+        self.attempts = 0
+        self.timed_out = False  # killed at the deadline
+        self.skipped = False  # not run, the circuit breaker is open
+        self.started = None  # time.monotonic() when the last attempt started
+        self.first_line = None  # seconds to the first line of stdout
+        self.duration = 0.0
+
+    def connected(self):
+        """
+        True if ssh reached the server (the command may have failed)
+        """
+        return not self.skipped and not self.timed_out and self.returncode != 255
+
+    def error(self):
+        """
+        The error as a string, for the messages
+        """
+        if self.skipped:
+            return (
+                "%s: skipped, recently unreachable (circuit breaker open)" % self.host
+            )
+        if self.timed_out:
+            return "%s: no answer within the deadline" % self.host
+        return b" ".join(line.strip() for line in self.stderr).decode(errors="replace")
+
+    def output(self):
+        """
+        stdout as a string
+        """
+        return b"".join(self.stdout).decode(errors="replace")
+
+    def to_dict(self):
+        return {
+            "host": self.host,
+            "command": self.command,
+            "returncode": self.returncode,
+            "stdout": self.output(),
+            "stderr": b"".join(self.stderr).decode(errors="replace"),
+            "duration": round(self.duration, 3),
+            "attempts": self.attempts,
+            "timed_out": self.timed_out,
+            "skipped": self.skipped,
+        }
+
+
+class circuit_breaker:
+    """
+    Failures to connect per server and per rack, kept in a JSON file
+    {key: {"failures": N, "opened": epoch, "rack": rack}}, the key is the
+    hostname or "rack:" followed by the rack
+    The file is read at the first use and the state kept in memory, with
+    the servers indexed by rack; the file is read again when another
+    process changes it (checked at most every flush_delay seconds) and
+    the changes are merged into it by a background thread at most every
+    flush_delay seconds (and at exit), the runs in the event loop never
+    wait for the disk
+    """
+
+    def __init__(self, filename=default_state):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.state = None  # read at the first use
+        self.racks = {}  # rack: the servers of the rack in the state
+        self.changes = set()  # the keys changed and not written yet
+        self.cleared = False  # reset of all the keys not written yet
+        self.mtime = None  # of the file when it was last read or written
+        self.checked = 0  # when the file was last checked for changes
+        self.flusher = None
+        atexit.register(self.flush)
+
+    def load(self):
+        try:
+            with open(self.filename) as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, state):
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # write and rename, a run reading the file never sees half of it
+        temporary = "%s.%s" % (self.filename, os.getpid())
+        with open(temporary, "w") as state_file:
+            json.dump(state, state_file, indent=1, sort_keys=True)
+        os.replace(temporary, self.filename)
+
+    def file_mtime(self):
+        try:
+            return os.stat(self.filename).st_mtime_ns
+        except OSError:
+            return None
+
+    def current(self):
+        """
+        Return the state in memory, read it the first time and when the
+        file was changed by another process; self.lock held
+        """
+        now = time.monotonic()
+        if self.state is None or now - self.checked >= flush_delay:
+            self.checked = now
+            mtime = self.file_mtime()
+            if self.state is None or mtime != self.mtime:
+                self.mtime = mtime
+                self.adopt(self.load())
+        return self.state
+
+    def adopt(self, state):
+        """
+        Replace the state in memory with state, read from the file, and
+        apply again the changes not written yet; self.lock held
+        """
+        if self.cleared:
+            state = {}
+        for key in self.changes:
+            if key in self.state:
+                state[key] = self.state[key]
+            else:
+                state.pop(key, None)
+        self.state = state
+        self.racks = {}
+        for key, entry in state.items():
+            if not key.startswith("rack:") and entry.get("rack"):
+                self.racks.setdefault(entry["rack"], set()).add(key)
+
+    def changed(self, *keys):
+        """
+        Schedule the write of the keys; self.lock held
+        """
+        self.changes.update(key for key in keys if key)
+        if self.flusher is None:
+            self.flusher = threading.Timer(flush_delay, self.flush)
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def flush(self):
+        """
+        Merge the changes into the file, written meanwhile by the other
+        processes (ssh_runner.py reset, the other tools), and read it back
+        """
+        with self.save_lock:
+            with self.lock:
+                self.flusher = None
+                if not (self.changes or self.cleared):
+                    return
+                cleared = self.cleared
+                changes = dict(
+                    (key, dict(self.state[key]) if key in self.state else None)
+                    for key in self.changes
+                )
+                self.changes = set()
+                self.cleared = False
+            state = {} if cleared else self.load()
+            for key, entry in changes.items():
+                if entry is None:
+                    state.pop(key, None)
+                else:
+                    state[key] = entry
+            try:
+                self.save(state)
+            except OSError as error:
+                sys.stderr.write("ERROR: %s: %s\n" % (self.filename, error))
+                with self.lock:
+                    # written with the next changes
+                    self.changes.update(changes)
+                    self.cleared = self.cleared or cleared
+                return
+            with self.lock:
+                self.mtime = self.file_mtime()
+                self.adopt(state)
+
+    def forget(self, host):
+        """
+        Remove host from the state and from the index; self.lock held
+        """
+        entry = self.state.pop(host, None)
+        if entry and entry.get("rack") in self.racks:
+            self.racks[entry["rack"]].discard(host)
+        return entry
+
+    def is_open(self, host, rack=None):
+        """
+        True if host (or its rack) must be skipped; after the cooldown
+        the first caller gets a trial run and the others keep skipping
+        """
+        with self.lock:
+            state = self.current()
+            now = time.time()
+            keys = [host] + (["rack:%s" % rack] if rack else [])
+            opened = [k for k in keys if state.get(k, {}).get("opened")]
+            if any(now - state[k]["opened"] < cooldown for k in opened):
+                return True
+            if opened:
+                # half open: let this one through, push the others back
+                for key in opened:
+                    state[key]["opened"] = now
+                self.changed(*opened)
+            return False
+
+    def record(self, host, rack, connected):
+        """
+        Record the outcome of a run on host
+        """
+        with self.lock:
+            state = self.current()
+            now = time.time()
+            rack_key = "rack:%s" % rack if rack else None
+            if connected:
+                if self.forget(host) is None and rack_key not in state:
+                    return  # nothing to update, spare the write
+                # the rack is up if one of its servers answers
+                if rack_key:
+                    state.pop(rack_key, None)
+                self.changed(host, rack_key)
+            else:
+                entry = state.setdefault(host, {"failures": 0, "opened": 0})
+                entry["failures"] += 1
+                if entry.get("rack") != rack and entry.get("rack") in self.racks:
+                    self.racks[entry["rack"]].discard(host)
+                entry["rack"] = rack
+                if entry["failures"] >= host_threshold:
+                    entry["opened"] = now
+                if rack_key:
+                    self.racks.setdefault(rack, set()).add(host)
+                    down = [
+                        key
+                        for key in self.racks[rack]
+                        if now - state[key].get("opened", 0) < cooldown
+                    ]
+                    if len(down) >= rack_threshold:
+                        state[rack_key] = {"failures": len(down), "opened": now}
+                self.changed(host, rack_key)
+
+    def reset(self, key=None):
+        with self.lock:
+            state = self.current()
+            if key:
+                self.forget(key)
+                self.changes.add(key)
+            else:
+                state.clear()
+                self.racks = {}
+                self.changes = set()
+                self.cleared = True
+        self.flush()
+
+
+# one breaker for each state file, shared by the threads of a sweep
+breakers = {}
+
+
+def get_breaker(filename=default_state):
+    if filename not in breakers:
+        breakers[filename] = circuit_breaker(filename)
+    return breakers[filename]
+
+
+async def run_process(result, argv, timeout, on_line=None):
+    """
+    Run argv once, kill it after timeout seconds; fill result
+    """
+    # own process group, the kill reaches also the children
+    # (ProxyCommand, the shell) which would keep the pipes open
+    process = await asyncio.create_subprocess_exec(
+        *argv,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
+    )
+    result.started = start = time.monotonic()
+    result.stdout = []
+    result.first_line = None
+
+    async def read_stdout():
+        async for line in process.stdout:
+            if result.first_line is None:
+                # the first line arrives after the SSH handshake and once
+                # the command has done its job on the server
+                result.first_line = time.monotonic() - start
+            result.stdout.append(line)
+            if on_line:
+                on_line(result.host, line)
+
+    async def read_stderr():
+        return (await process.stderr.read()).splitlines(True)
+
+    try:
+        result.stderr = (
+            await asyncio.wait_for(
+                asyncio.gather(read_stdout(), read_stderr(), process.wait()),
+                max(timeout, 0),
+            )
+        )[1]
+        result.timed_out = False
+    except asyncio.TimeoutError:
+        result.timed_out = True
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass  # already gone
+        await process.wait()
+    result.returncode = process.returncode
+
+
+class ssh_transport:
+    """
+    Run the commands with ssh
+    """
+
+    name = "ssh"
+
+    def __init__(self, multiplexing=True):
+        self.options = list(ssh_defaults)
+        if multiplexing:
+            self.options += ssh_multiplexing
+            # ssh does not create the directory of the ControlPath
+            ssh_dir = os.path.expanduser("~/.ssh")
+            if not os.path.isdir(ssh_dir):
+                os.makedirs(ssh_dir, 0o700)
+
+    async def execute(self, result, options, connect_timeout, timeout, on_line):
+        # ssh uses the first value given for an option,
+        # the options of the caller go first
+        argv = (
+            ["ssh"]
+            + (options or [])
+            + ["-o", "ConnectTimeout=%s" % connect_timeout]
+            + self.options
+            + [result.host, result.command]
+        )
+        await run_process(result, argv, timeout, on_line)
+
+
+class local_transport:
+    """
+    Run the commands here, through the shell; the host is only a label
+    """
+
+    name = "local"
+
+    async def execute(self, result, options, connect_timeout, timeout, on_line):
+        await run_process(result, ["/bin/sh", "-c", result.command], timeout, on_line)
+
+
+class fake_transport:
+    """
+    Answer without running anything, for the tests and the benchmarks;
+    responder(host, command) returns (return code, stdout, stderr) in bytes
+    and optionally the seconds to wait before answering (the default
+    is latency); return code 255 is a server which cannot be reached
+    All the runs are recorded in calls as (host, command)
+    """
+
+    name = "fake"
+
+    def __init__(self, responder=None, latency=0.0):
+        self.responder = responder if responder else lambda host, command: (0, b"", b"")
+        self.latency = latency
+        self.calls = []
+
+    async def execute(self, result, options, connect_timeout, timeout, on_line):
+        self.calls.append((result.host, result.command))
+        answer = self.responder(result.host, result.command)
+        delay = answer[3] if len(answer) > 3 else self.latency
+        result.started = time.monotonic()
+        if delay > timeout:
+            await asyncio.sleep(max(timeout, 0))
+            result.timed_out = True
+            result.returncode = -signal.SIGKILL
+            result.stdout, result.stderr = [], []
+            return
+        await asyncio.sleep(delay)
+        result.timed_out = False
+        result.returncode = answer[0]
+        result.stdout = answer[1].splitlines(True)
+        result.stderr = answer[2].splitlines(True)
+        result.first_line = delay if result.stdout else None
+        if on_line:
+            for line in result.stdout:
+                on_line(result.host, line)
+
+
+class runner:
+    """
+    Run the commands through a transport, with the concurrency limits,
+    the deadlines, the retries and the circuit breaker; the coroutines
+    must run in the loop of the core (see submit)
+    """
+
+    def __init__(
+        self,
+        transport=None,
+        max_parallel=max_parallel,
+        per_host=per_host,
+        breaker=None,
+        retries=retries,
+    ):
+        self.transport = transport if transport else ssh_transport()
+        self.max_parallel = max_parallel
+        self.per_host = per_host
+        # None: the default breaker, False: no breaker
+        self.breaker = get_breaker() if breaker is None else breaker
+        self.retries = retries
+        # created in the loop of the core at the first run
+        self.slots = None
+        self.host_slots = {}
+
+    def host_slot(self, host):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_parallel)
+        if host not in self.host_slots:
+            self.host_slots[host] = asyncio.Semaphore(self.per_host)
+        return self.host_slots[host]
+
+    async def run(
+        self,
+        host,
+        command,
+        options=None,
+        rack=None,
+        connect_timeout=connect_timeout,
+        deadline=deadline,
+        retries=None,
+        breaker=None,
+        on_line=None,
+    ):
+        """
+        Run command on host, return a ssh_result; rack (any string naming
+        the rack, for example "DC Location A/R12") lets the breaker skip
+        the whole rack when it is down; breaker=False disables the breaker
+        """
+        if breaker is None:
+            breaker = self.breaker
+        if retries is None:
+            retries = self.retries
+        result = ssh_result(host, command)
+        result.transport = self.transport.name
+        if breaker and breaker.is_open(host, rack):
+            result.skipped = True
+            result.returncode = 255
+            return result
+        async with self.host_slot(host), self.slots:
+            # the deadline is for the run, not for the wait for a slot
+            start = time.monotonic()
+            while True:
+                remaining = deadline - (time.monotonic() - start)
+                await self.transport.execute(
+                    result, options, connect_timeout, remaining, on_line
+                )
+                result.attempts += 1
+                # retry only if ssh could not connect and there is time left;
+                # a command which started is not run twice
+                if result.returncode != 255 or result.attempts > retries:
+                    break
+                pause = backoff * 2 ** (result.attempts - 1) * random.uniform(0.5, 1.5)
+                if time.monotonic() - start + pause + connect_timeout > deadline:
+                    break
+                await asyncio.sleep(pause)
+        result.duration = time.monotonic() - start
+        if breaker and not result.timed_out:
+            # a run cut off by the deadline says nothing about the host
+            breaker.record(host, rack, result.connected())
+        return result
+
+    async def run_many(self, hosts, command, **kwargs):
+        """
+        Run command on all the hosts at the same time (within the
+        limits), return the results in the same order as hosts
+        """
+        return await asyncio.gather(
+            *[self.run(host, command, **kwargs) for host in hosts]
+        )
+
+
+# the event loop of the core, it runs in a background thread
+core = None
+core_lock = threading.Lock()
+# the runner used by run/run_many and the one used by run_local
+default_runner = None
+local_runner = None
+
+
+def core_loop():
+    """
+    Return the event loop of the core, start it the first time
+    """
+    global core
+    with core_lock:
+        if core is None:
+            core = asyncio.new_event_loop()
+            threading.Thread(
+                target=core.run_forever, name="ssh_runner", daemon=True
+            ).start()
+        return core
+
+
+def submit(coroutine):
+    """
+    Run coroutine in the loop of the core and return its result,
+    can be called from any thread (but not from the loop itself)
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, core_loop()).result()
+
+
+def configure(transport=None, max_parallel=max_parallel, per_host=per_host, **kwargs):
+    """
+    Replace the default runner, for example with a fake_transport or
+    with different limits; return the new runner
+    """
+    global default_runner
+    default_runner = runner(transport, max_parallel, per_host, **kwargs)
+    return default_runner
+
+
+def get_runner():
+    if default_runner is None:
+        configure()
+    return default_runner
+
+
+def run(host, command, **kwargs):
+    """
+    Run command on host with the default runner, see runner.run
+    """
+    return submit(get_runner().run(host, command, **kwargs))
+
+
+def run_many(hosts, command, **kwargs):
+    """
+    Run command on all the hosts with the default runner, see runner.run_many
+    """
+    return submit(get_runner().run_many(hosts, command, **kwargs))
+
+
+def run_local(command, deadline=deadline, on_line=None):
+    """
+    Run command here through the shell, return a ssh_result
+    """
+    global local_runner
+    if local_runner is None:
+        # all the local commands run on "localhost", the limit per host
+        # would be the limit of the whole runner
+        local_runner = runner(
+            local_transport(), per_host=max_parallel, breaker=False, retries=0
+        )
+    return submit(
+        local_runner.run("localhost", command, deadline=deadline, on_line=on_line)
+    )
+
+
+def arguments():
+    """
+    Parse arguments and return help message if the script is invoked with -h
+    """
+    parser = argparse.ArgumentParser(
+        description="Show or reset the SSH circuit breaker", prog="ssh_runner"
+    )
+    parser.add_argument(
+        "--state", default=default_state, help="breaker state (default %(default)s)"
+    )
+    parser.add_argument("action", choices=["status", "reset"])
+    parser.add_argument("key", nargs="?", help="(reset) a hostname or rack:RACK")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = arguments()
+    breaker = get_breaker(args.state)
+    if args.action == "reset":
+        breaker.reset(args.key)
+        sys.exit()
+    now = time.time()
+    for key, entry in sorted(breaker.load().items()):
+        left = cooldown - (now - entry.get("opened", 0))
+        print(
+            "%-30s failures %3s  %s"
+            % (
+                key,
+                entry["failures"],
+                "open for %ds" % left if left > 0 else "half open",
+            )
+        )
+    # That's all folks!
@@ -0,0 +1,506 @@
+#!/usr/bin/python3
+
+"""
+File the JIRA tickets for the disks to replace through the tracker REST API
+
+failed_disk.py --tickets turns the JIRA template of each server with disks
+to replace (see server_object.jira_ticket) into an issue:
+- the index of the tickets filed is kept in a SQLite database keyed by
+  server and disk serial number, the disks already in an open ticket are
+  skipped; the index is local, so before each batch the tracker is also
+  searched for the open issues with the label of each disk (one per
+  server and serial), filed by another engineer or from another box
+  maybe with other disks, and those disks are recorded in the index
+  instead of being filed again
+- the issues are created in batches (the bulk API of JIRA) over one
+  persistent HTTP connection
+- the requests refused with 429/5xx are retried after Retry-After or a
+  backoff with jitter; when the connection breaks during a request the
+  batch may have been created, so before sending it again the issues
+  already there are searched by their label (one per server and serials)
+
+benchmarks/tracker_stub.py is a local tracker with the same API, for the
+tests (TICKETS_URL=http://127.0.0.1:8080)
+
+Usage:
+tickets.py list [--all]
+tickets.py close KEY
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+
+# the tracker and the project the tickets are filed in #CHANGEME
+tracker_url = os.environ.get("TICKETS_URL", "http://127.0.0.1:8080")
+tracker_token = os.environ.get("TICKETS_TOKEN", "")
+project = "OPS"
+issue_type = "Task"
+# issues created with each request, seconds for each request
+batch_size = 50
+request_timeout = 30
+# attempts after the first one, seconds before the first retry (doubled
+# at each attempt)
+retries = 4
+backoff = 1.0
+# where the index is stored if not specified otherwise
+default_db = os.path.expanduser("~/.failed_disk/tickets.sqlite")
+
+schema = """
+CREATE TABLE IF NOT EXISTS ticket (
+    host TEXT NOT NULL,
+    serial TEXT NOT NULL,
+    key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created INTEGER NOT NULL,
+    PRIMARY KEY (host, serial)
+);
+CREATE INDEX IF NOT EXISTS ticket_key ON ticket (key);
+"""
+
+
+def open_index(filename=default_db):
+    """
+    Open (and create if needed) the index of the tickets, return the connection
+    """
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    conn = sqlite3.connect(filename)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(schema)
+    return conn
+
+
+def open_disks(conn):
+    """
+    Return the (host, serial) of the disks with an open ticket
+    """
+    return set(conn.execute("SELECT host, serial FROM ticket WHERE status = 'open'"))
+
+
+def record_tickets(conn, filed, timestamp=None):
+    """
+    Record the tickets filed, a list of (host, serials, key)
+    """
+    if timestamp is None:
+        timestamp = int(time.time())
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO ticket VALUES (?, ?, ?, 'open', ?)",
+            [
+                (host, serial, key, timestamp)
+                for host, serials, key in filed
+                for serial in serials
+            ],
+        )
+
+
+def close_ticket(conn, key):
+    """
+    Mark the ticket as closed, its disks are filed again if still failed;
+    return the number of disks of the ticket
+    """
+    with conn:
+        return conn.execute(
+            "UPDATE ticket SET status = 'closed' WHERE key = ?", (key,)
+        ).rowcount
+
+
+def list_tickets(conn, everything=False):
+    """
+    Return the tickets as tuples (key, host, serials, status, created),
+    the open ones only unless everything
+    """
+    query = "SELECT key, host, serial, status, created FROM ticket"
+    if not everything:
+        query += " WHERE status = 'open'"
+    tickets = {}
+    for key, host, serial, status, created in conn.execute(query):
+        ticket = tickets.setdefault(key, [key, host, [], status, created])
+        ticket[2].append(serial)
+    return sorted((tuple(t) for t in tickets.values()), key=lambda t: t[4])
+
+
+def ticket_label(host, serials):
+    """
+    The label which identifies the issue of host and serials in the tracker
+    """
+    digest = hashlib.sha1((host + " " + " ".join(sorted(serials))).encode())
+    return "failed-disk-" + digest.hexdigest()[:12]
+
+
+def disk_label(host, serial):
+    """
+    The label of each disk of an issue, an issue for other disks of the
+    same server is found too
+    """
+    digest = hashlib.sha1(("disk %s %s" % (host, serial)).encode())
+    return "failed-disk-sn-" + digest.hexdigest()[:12]
+
+
+def issue_payload(this_server, serials):
+    """
+    Return the fields of the issue for this_server, serials are the
+    disks not in a ticket yet
+    """
+    return {
+        "fields": {
+            "project": {"key": project},
+            "issuetype": {"name": issue_type},
+            "summary": "Disk(s) to replace on %s: %s"
+            % (this_server.server, ", ".join(serials)),
+            "description": this_server.jira_ticket(),
+            # the label of the issue last, see create_batch
+            "labels": ["failed_disk"]
+            + [disk_label(this_server.server, serial) for serial in serials]
+            + [ticket_label(this_server.server, serials)],
+        }
+    }
+
+
+def new_tickets(servers, known, predictive=False):
+    """
+    Return (server_object, serials) for the servers with disks to replace
+    not in known (see open_disks) and the number of disks skipped
+    """
+    import failed_disk
+
+    tickets = []
+    skipped = 0
+    for this_server in servers:
+        serials = []
+        for disk in failed_disk.pending_disks(this_server, predictive):
+            serial = disk[9][0]
+            if (this_server.server, serial) in known or serial in serials:
+                skipped += 1
+            else:
+                serials.append(serial)
+        if serials:
+            tickets.append((this_server, serials))
+    return tickets, skipped
+
+
+class tracker_session:
+    """
+    A persistent connection to the tracker, opened again when it breaks
+    """
+
+    def __init__(self, url=None, token=None, timeout=request_timeout):
+        from urllib.parse import urlsplit
+
+        url = urlsplit(url or tracker_url)
+        self.https = url.scheme == "https"
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip("/")
+        self.token = tracker_token if token is None else token
+        self.timeout = timeout
+        self.conn = None
+
+    def request(self, method, path, body=None):
+        """
+        Send a request, return (status, headers, decoded JSON reply);
+        the errors of the connection are raised (OSError, HTTPException)
+        """
+        import http.client
+
+        if self.conn is None:
+            if self.https:
+                self.conn = http.client.HTTPSConnection(
+                    self.netloc, timeout=self.timeout
+                )
+            else:
+                self.conn = http.client.HTTPConnection(
+                    self.netloc, timeout=self.timeout
+                )
+        headers = {"Accept": "application/json"}
+        if self.token:
+            headers["Authorization"] = "Bearer " + self.token
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        try:
+            self.conn.request(method, self.prefix + path, data, headers)
+            response = self.conn.getresponse()
+            raw = response.read()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+        if response.getheader("Connection", "").lower() == "close":
+            self.close()
+        try:
+            reply = json.loads(raw) if raw else {}
+        except ValueError:
+            reply = {"errorMessages": [raw[:200].decode(errors="replace")]}
+        return response.status, response.headers, reply
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def search_labels(session, labels, open_only=False):
+    """
+    Return {label: issue key} for the issues with one of the labels,
+    with open_only only the issues not done
+    """
+    from urllib.parse import urlencode
+
+    jql = "labels in (%s)" % ", ".join('"%s"' % label for label in labels)
+    if open_only:
+        jql += " AND statusCategory != Done"
+    status, headers, reply = session.request(
+        "GET",
+        "/rest/api/2/search?"
+        + urlencode({"jql": jql, "fields": "labels", "maxResults": len(labels)}),
+    )
+    if status != 200:
+        raise OSError("search failed with status %s" % status)
+    found = {}
+    for issue in reply.get("issues", []):
+        for label in issue["fields"]["labels"]:
+            if label in labels:
+                found[label] = issue["key"]
+    return found
+
+
+def search_retried(session, labels, open_only=False):
+    """
+    search_labels, retried as create_batch when the tracker fails
+    """
+    import http.client
+
+    last_error = ""
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(retry_delay(attempt))
+        try:
+            return search_labels(session, labels, open_only)
+        except (OSError, http.client.HTTPException) as error:
+            last_error = "%s: %s" % (type(error).__name__, error)
+    raise OSError(
+        "cannot search the issues after %s attempts (%s)" % (retries + 1, last_error)
+    )
+
+
+def retry_delay(attempt, headers=None):
+    """
+    Seconds to wait before the attempt, Retry-After if the tracker sent it
+    """
+    if headers is not None and headers.get("Retry-After", "").isdigit():
+        return int(headers["Retry-After"])
+    return backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+
+
+def create_batch(session, payloads):
+    """
+    Create the issues of payloads with one request (retried if needed);
+    return a list with the key, or the error, of each payload
+    """
+    import http.client
+
+    labels = [p["fields"]["labels"][-1] for p in payloads]
+    results = [None] * len(payloads)
+    pending = list(range(len(payloads)))
+    uncertain = False
+    headers = None
+    last_error = ""
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(retry_delay(attempt, headers))
+        try:
+            if uncertain:
+                # the last request may have reached the tracker
+                found = search_labels(session, [labels[i] for i in pending])
+                for i in pending:
+                    if labels[i] in found:
+                        results[i] = found[labels[i]]
+                pending = [i for i in pending if results[i] is None]
+                if not pending:
+                    break
+            headers = None
+            status, headers, reply = session.request(
+                "POST",
+                "/rest/api/2/issue/bulk",
+                {"issueUpdates": [payloads[i] for i in pending]},
+            )
+        except (OSError, http.client.HTTPException) as error:
+            uncertain = True
+            headers = None
+            last_error = "%s: %s" % (type(error).__name__, error)
+            continue
+        uncertain = False
+        if status == 429 or status >= 500:
+            last_error = "status %s" % status
+            continue
+        if status >= 400 and not reply.get("errors"):
+            # the whole request was refused (authentication, bad project)
+            message = "; ".join(reply.get("errorMessages", [])) or "status %s" % status
+            for i in pending:
+                results[i] = "ERROR: %s" % message
+            pending = []
+            break
+        # 201 all created, 400 some of them (or none) created
+        failed = dict((e["failedElementNumber"], e) for e in reply.get("errors", []))
+        created = iter(reply.get("issues", []))
+        for number, i in enumerate(pending):
+            if number in failed:
+                messages = failed[number].get("elementErrors", {})
+                results[i] = "ERROR: %s" % (
+                    "; ".join(messages.get("errorMessages", []))
+                    or json.dumps(messages.get("errors", {}))
+                )
+            else:
+                issue = next(created, None)
+                results[i] = issue["key"] if issue else "ERROR: status %s" % status
+        pending = []
+        break
+    if pending:
+        raise OSError(
+            "cannot create the issues after %s attempts (%s)"
+            % (retries + 1, last_error)
+        )
+    return results
+
+
+def file_tickets(servers, predictive=False, conn=None, session=None):
+    """
+    File the tickets for the disks of the servers not in an open ticket,
+    batch_size issues at a time; each batch is recorded in the index as
+    soon as it is created
+    Return (filed, skipped, errors): the tickets filed as (host, serials,
+    key), the disks skipped and the errors as (host, message)
+    """
+    close_conn = conn is None
+    close_session = session is None
+    if conn is None:
+        conn = open_index()
+    if session is None:
+        session = tracker_session()
+    filed = []
+    errors = []
+    try:
+        tickets, skipped = new_tickets(servers, open_disks(conn), predictive)
+        for first in range(0, len(tickets), batch_size):
+            batch = tickets[first : first + batch_size]
+            # filed meanwhile by somebody else, not in this index, maybe
+            # with other disks of the server
+            found = search_retried(
+                session,
+                [
+                    disk_label(s.server, serial)
+                    for s, serials in batch
+                    for serial in serials
+                ],
+                True,
+            )
+            existing = {}
+            payloads = []
+            pending = []
+            for this_server, serials in batch:
+                left = []
+                for serial in serials:
+                    key = found.get(disk_label(this_server.server, serial))
+                    if key:
+                        existing.setdefault((this_server.server, key), []).append(
+                            serial
+                        )
+                    else:
+                        left.append(serial)
+                if not left:
+                    continue
+                try:
+                    payloads.append(issue_payload(this_server, left))
+                except Exception as error:
+                    # an incomplete hinv, the other servers are still filed
+                    errors.append(
+                        (this_server.server, "%s: %s" % (type(error).__name__, error))
+                    )
+                    continue
+                pending.append((this_server.server, left))
+            record_tickets(
+                conn,
+                [(host, serials, key) for (host, key), serials in existing.items()],
+            )
+            skipped += sum(len(serials) for serials in existing.values())
+            if not pending:
+                continue
+            results = create_batch(session, payloads)
+            done = []
+            for (host, serials), key in zip(pending, results):
+                if key.startswith("ERROR: "):
+                    errors.append((host, key[len("ERROR: ") :]))
+                else:
+                    done.append((host, serials, key))
+            record_tickets(conn, done)
+            filed += done
+    finally:
+        if close_session:
+            session.close()
+        if close_conn:
+            conn.close()
+    return filed, skipped, errors
+
+
+def print_filed(filed, skipped, errors):
+    for host, serials, key in filed:
+        print("%-12s %-10s %s" % (key, host, " ".join(serials)))
+    for host, message in errors:
+        print("ERROR %-10s %s" % (host, message))
+    print(
+        "\n%s ticket(s) filed, %s disk(s) already in a ticket, %s error(s)"
+        % (len(filed), skipped, len(errors))
+    )
+
+
+def arguments():
+    """
+    Parse arguments and return help message if the script is invoked with -h
+    """
+    parser = argparse.ArgumentParser(
+        description="Index of the JIRA tickets filed for the disks to replace",
+        prog="tickets",
+    )
+    parser.add_argument(
+        "--db", default=default_db, help="index database (default %(default)s)"
+    )
+    parser.add_argument("command", choices=["list", "close"])
+    parser.add_argument("key", nargs="?", help="(close) the ticket")
+    parser.add_argument(
+        "--all", action="store_true", help="(list) the closed tickets too"
+    )
+    args = parser.parse_args()
+    if args.command == "close" and not args.key:
+        parser.error("close needs a ticket")
+    return args
+
+
+if __name__ == "__main__":
+    args = arguments()
+    index = open_index(args.db)
+    if args.command == "close":
+        if not close_ticket(index, args.key):
+            sys.exit("ERROR: %s is not in the index" % args.key)
+        print("%s closed" % args.key)
+    else:
+        for key, host, serials, status, created in list_tickets(index, args.all):
+            print(
+                "%-12s %-10s %-6s %s %s"
+                % (
+                    key,
+                    host,
+                    status,
+                    time.strftime("%Y-%m-%d", time.localtime(created)),
+                    " ".join(serials),
+                )
+            )
+    index.close()
+    # That's all folks!